@@ -1,98 +1,237 @@
 #!/usr/bin/env python3
 
+import logging
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
+import frametrace
+import kernels
 from scipy import signal
-from zcsequence import zcsequence_f, zcsequence_t
-from helpers import corr, fshift, tfft, itfft, with_sample_offset, NFFT, MAXNCARRIERS, NCARRIERS, MAXNCARRIERS_c2, NCARRIERS_c2, CP_LENGTHS_legacy, ZC_SYMBOL_IDX_legacy, CP_LENGTHS, CP_LENGTHS_C2, ZC_SYMBOL_IDX, ZC_SYMBOL_IDX_c2
+from zcsequence import zcsequence_f
+from equalizer import Equalizer
+from numerology import get_plan
+from helpers import corr, fshift, fractional_delay, integer_sample_offset
+
+logger = logging.getLogger(__name__)
+
+
+# upstream dependencies of every lazy Packet stage (parameters or other stages)
+STAGE_DEPENDS = {}
+
+def stage(*depends):
+    """Lazily computed Packet stage, cached until invalidate() hits it or anything upstream"""
+    def wrap(fn):
+        name = fn.__name__
+        STAGE_DEPENDS[name] = depends
+
+        def getter(self):
+            if name not in self._stages:
+                with frametrace.span(name):
+                    self._stages[name] = fn(self)
+            return self._stages[name]
+        return property(getter, doc=fn.__doc__)
+    return wrap
+
+
+class ZCNotFoundError(ValueError):
+    """The fine sync ZC sequence is missing, the frame is not (or too badly received) Drone-ID"""
 
 
 class Packet:
-    """Demodulate frames from raw samples to QPSK data"""
+    """Demodulate frames from raw samples to QPSK data
+
+    Every estimation step is a lazy stage that is only computed on first
+    access, see STAGE_DEPENDS for the dependency graph. Changing a parameter
+    (raw_samples, Fs, enable_zc_detection) invalidates the stages below it.
+    Symbol layout, FFT size and ZC sequences come from the numerology plan
+    of the frame type (see numerology.py).
+    """
     def __init__(self, raw_samples, Fs=15.36e6, enable_zc_detection=True, debug=False, legacy = False, packet_type = "droneid"):
         self.debug = debug
-        self.NCARRIERS = NCARRIERS
-        self.MAXNCARRIERS = MAXNCARRIERS
-
-        if legacy and packet_type == "droneid":
-            self.CP_LENGTHS = CP_LENGTHS_legacy
-            self.ZC_SYMBOL_IDX = ZC_SYMBOL_IDX_legacy
-        elif packet_type == "droneid":
-            self.CP_LENGTHS = CP_LENGTHS
-            self.ZC_SYMBOL_IDX = ZC_SYMBOL_IDX
-        elif packet_type == "c2":
-            self.CP_LENGTHS = CP_LENGTHS_C2
-            self.ZC_SYMBOL_IDX = ZC_SYMBOL_IDX_c2
-            self.NCARRIERS = NCARRIERS_c2
-            self.MAXNCARRIERS = MAXNCARRIERS_c2          
+        self.packet_type = packet_type
+        self.plan = get_plan(packet_type, legacy)
 
-        # sample rate
-        self.Fs = Fs
+        # kept for compatibility, the plan has everything
+        self.CP_LENGTHS = self.plan.cp_lengths
+        self.ZC_SYMBOL_IDX = self.plan.zc_symbol_idx
+        self.NCARRIERS = self.plan.ncarriers
+        self.MAXNCARRIERS = self.plan.ncarriers
 
-        # carrier frequency offset
-        self.detected_ffo = 0
+        # computed stages, see stage()
+        self._stages = {}
 
-        # first sample start
-        self.start = 0
+        # last get_symbol_data() intermediate results, keyed by their tweaks
+        self._tweaks = {}
 
-        # normalize amplitudes
+        # sample rate
+        self.Fs = Fs
+        self.enable_zc_detection = enable_zc_detection
         self.raw_samples = raw_samples
-        self.raw_samples /= np.max(np.abs(raw_samples))
 
-        # keep the original data in case we have to correct some operations
-        self.raw_samples_orig = self.raw_samples
+        # fail early: frames without the expected ZC sequences are not worth keeping
+        zc_seq_1, zc_seq_2 = self.zc_roots
+        logger.debug("First Symbol at Sample %i, FFO %f", self.start, self.detected_ffo)
+        logger.debug("Found ZC sequences: %i %i", zc_seq_1, zc_seq_2)
+        frametrace.record(zc_root_1=zc_seq_1, zc_root_2=zc_seq_2)
 
-        self.start, self.detected_ffo = self.find_fine_start(self.raw_samples)
         if self.debug:
-            print("First Symbol at Sample %i, FFO %f" % (self.start, self.detected_ffo))
+            # equalized time domain data without CPs
+            import matplotlib.pyplot as plt
+            nfft = self.plan.nfft
+            yfake = np.zeros(self.plan.nsymbols*nfft, dtype=np.complex64)
+            for i, symbol_f in enumerate(self.symbols_equalized):
+                yfake[i*nfft:(i+1)*nfft] = self.plan.itfft(symbol_f)
+
+            plt.title("Channel-Equalized Packet")
+            plt.specgram(yfake, Fs=Fs)
+            plt.show()
 
-        # coarsely extract symbols
-        self.symbols_time_domain, self.symbols_freq_domain = self.raw_data_to_symbols(self.raw_samples_orig, self.start, ffo=self.detected_ffo)
+    def __setattr__(self, name, value):
+        # parameters feeding the stages: drop everything computed from them
+        if name in ("raw_samples", "Fs", "enable_zc_detection") and "_stages" in self.__dict__:
+            self.invalidate(name)
+        super().__setattr__(name, value)
+
+    def invalidate(self, name):
+        """Forget stage (or parameter) name and every stage computed from it"""
+        self._stages.pop(name, None)
+        self._tweaks.clear()
+        for downstream, depends in STAGE_DEPENDS.items():
+            if name in depends and downstream in self._stages:
+                self.invalidate(downstream)
+
+    @property
+    def raw_samples(self):
+        return self.__dict__["raw_samples"]
+
+    @raw_samples.setter
+    def raw_samples(self, raw_samples):
+        # normalize amplitudes (without touching the caller's array)
+        self.__dict__["raw_samples"] = raw_samples / np.max(np.abs(raw_samples))
+
+    @property
+    def raw_samples_orig(self):
+        # kept for compatibility, raw_samples is never modified in place
+        return self.raw_samples
+
+    @stage("raw_samples", "Fs")
+    def fine_start(self):
+        """First symbol start and fractional frequency offset"""
+        return self.find_fine_start(self.raw_samples)
+
+    @property
+    def start(self):
+        return self.fine_start[0]
+
+    @property
+    def detected_ffo(self):
+        return self.fine_start[1]
+
+    @stage("fine_start")
+    def coarse_symbols_freq_domain(self):
+        """Symbols with frequency offset corrected only"""
+        _, symbols_f = self.raw_data_to_symbols(self.raw_samples, self.start, ffo=self.detected_ffo)
+        return symbols_f
 
-        if enable_zc_detection:
+    @stage("coarse_symbols_freq_domain", "enable_zc_detection")
+    def zc_roots(self):
+        """Roots of both ZC sequences, raises ZCNotFoundError if the second one is not the expected one (147)"""
+        expected = self.plan.zc_roots
+        if self.enable_zc_detection:
             # make sure that we actually found the ZC sequence
-            zc_seq_1 = self.find_zc_seq(self.symbols_freq_domain[self.ZC_SYMBOL_IDX[0]])
-            zc_seq_2 = self.find_zc_seq(self.symbols_freq_domain[self.ZC_SYMBOL_IDX[1]])
+            zc_seq_1 = self.find_zc_seq(self.coarse_symbols_freq_domain[self.ZC_SYMBOL_IDX[0]])
+            zc_seq_2 = self.find_zc_seq(self.coarse_symbols_freq_domain[self.ZC_SYMBOL_IDX[1]])
+        elif expected is None:
+            raise ValueError("ZC roots of %s frames are unknown, ZC detection is required" % self.plan.name)
         else:
-            zc_seq_1 = 600
-            zc_seq_2 = 147
+            zc_seq_1, zc_seq_2 = expected
 
         # first ZC is variable (coarse sync) so not predictable
-        # second ZC for fine sync, must be 147
-        if not (zc_seq_2 == 147) and packet_type == "droneid":
-            #print("ZC Sequence not found. Expected: 600 and 147, Found: %i and %i" % (zc_seq_1, zc_seq_2))
-            raise ValueError("ZC Sequence not found. Expected: 600 and 147, Found: %i and %i" % (zc_seq_1, zc_seq_2))
-
-        print("Found ZC sequences:",zc_seq_1, zc_seq_2)
-        self.channel = self.estimate_channel(self.ZC_SYMBOL_IDX[0], zc_seq_1)
-        self.channel += self.estimate_channel(self.ZC_SYMBOL_IDX[1], zc_seq_2)
-        self.channel *= 0.5
-
+        # second ZC for fine sync, must match
+        if expected is not None and zc_seq_2 != expected[1]:
+            raise ZCNotFoundError("ZC Sequence not found. Expected: %i and %i, Found: %i and %i" % (*expected, zc_seq_1, zc_seq_2))
+
+        return zc_seq_1, zc_seq_2
+
+    @property
+    def reference_root(self):
+        """Root of the first ZC sequence for the offset and phase estimation"""
+        if self.plan.zc_roots is not None:
+            return self.plan.zc_roots[0]
+        return self.zc_roots[0]
+
+    @stage("fine_start", "zc_roots")
+    def sampling_offset(self):
+        """Fractional sampling offset from the first ZC symbol"""
         #zc_cyc = self.find_zc_shift(self.symbol_equalized(ZC_SYMBOL_IDX[0], self.channel), 600)
         #print("ZC Cyclic Shift: %i" % zc_cyc)
 
         zc_cyc = 0
 
         # why do we this just for the first ZC?
-        self.sampling_offset = self.find_zc_offset(self.ZC_SYMBOL_IDX[0], 600, zc_cyc)
-        print("ZC Offset: %f" % self.sampling_offset)
+        sampling_offset = self.find_zc_offset(self.ZC_SYMBOL_IDX[0], self.reference_root, zc_cyc)
+        logger.debug("ZC Offset: %f", sampling_offset)
+        frametrace.record(sampling_offset=sampling_offset)
+        return sampling_offset
+
+    @stage("sampling_offset")
+    def offset_symbols_freq_domain(self):
+        """Symbols with frequency and sampling offset corrected"""
+        _, symbols_f = self.raw_data_to_symbols(self.raw_samples, self.start, ffo=self.detected_ffo, sampling_offset=self.sampling_offset)
+        return symbols_f
 
-        self.symbols_time_domain, self.symbols_freq_domain = self.raw_data_to_symbols(self.raw_samples, self.start, ffo=self.detected_ffo, sampling_offset=self.sampling_offset)
+    @stage("offset_symbols_freq_domain")
+    def phase(self):
+        """Phase of the DC carrier of the first ZC symbol"""
+        phase = self.find_zc_angle(self.offset_symbols_freq_domain[self.ZC_SYMBOL_IDX[0]], self.reference_root)
+        frametrace.record(phase=phase)
+        return phase
+
+    @stage("phase")
+    def symbols(self):
+        """Time and frequency domain symbols with all corrections applied"""
+        return self.raw_data_to_symbols(self.raw_samples, self.start, ffo=self.detected_ffo, sampling_offset=self.sampling_offset, angle=self.phase)
+
+    @property
+    def symbols_time_domain(self):
+        return self.symbols[0]
+
+    @property
+    def symbols_freq_domain(self):
+        return self.symbols[1]
+
+    @stage("symbols", "zc_roots")
+    def equalizer(self):
+        """Channel estimated on the fully corrected ZC symbols"""
+        equalizer = Equalizer(self.ZC_SYMBOL_IDX, self.zc_roots, self.NCARRIERS)
+        equalizer.estimate(self.symbols_freq_domain)
+
+        if frametrace.tracing():
+            # flat channel: magnitude varies little over the carriers of the ZC symbols
+            magnitude = np.abs(equalizer.channel[self.ZC_SYMBOL_IDX])
+            frametrace.record(channel_flatness=float(np.mean(np.std(magnitude, axis=-1) / np.mean(magnitude, axis=-1))),
+                              snr_db=float(10 * np.log10(np.mean(equalizer.snr))))
 
-        angle = self.find_zc_angle(self.symbols_freq_domain[self.ZC_SYMBOL_IDX[0]], 600)
+        if self.debug:
+            import matplotlib.pyplot as plt
+            plt.title("Channel Estimation")
+            plt.plot(np.abs(equalizer.channel).T)
+            plt.show()
 
-        self.symbols_time_domain, self.symbols_freq_domain = self.raw_data_to_symbols(self.raw_samples, self.start, ffo=self.detected_ffo, sampling_offset=self.sampling_offset, angle=angle)
+        return equalizer
 
-        # equalized time domain data without CPs
-        yfake = np.zeros(len(self.CP_LENGTHS)*NFFT, dtype=np.complex64)
-        for i, symbol_f in enumerate(self.symbols_freq_domain):
-            yfake[i*NFFT:(i+1)*NFFT] = itfft(self.symbol_equalized(symbol_f, self.channel))
+    @property
+    def channel(self):
+        """Channel per symbol and carrier"""
+        return self.equalizer.channel
 
-        if self.debug:
-            plt.title("Channel-Equalized Packet")
-            plt.specgram(yfake, Fs=Fs)
-            plt.show()
+    @property
+    def snr(self):
+        """SNR per carrier (linear), e.g. for soft demapping or quality metrics"""
+        return self.equalizer.snr
+
+    @stage("equalizer")
+    def symbols_equalized(self):
+        """MMSE channel-equalized frequency domain symbols"""
+        return list(self.equalizer.equalize(self.symbols_freq_domain))
 
     def raw_data_to_symbols(self, samples, first_symbol_offset, ffo = None, sampling_offset = None, angle = None, linear_rotation=None):
         """Convert raw samples into OFDM symbols"""
@@ -102,66 +241,65 @@ class Packet:
         if ffo != None:
             samples = fshift(samples, -ffo, self.Fs)
 
-        symbols_time_domain = []
-        symbols_freq_domain = []
-
+        # integer part of the sampling offset in time domain, fraction as phase ramp after the FFT
         if sampling_offset != None:
-            samples = with_sample_offset(samples, sampling_offset)
+            sampling_offset_int = int(np.floor(sampling_offset))
+            samples = integer_sample_offset(samples, sampling_offset_int)
 
+        # samples may still be a view of the caller's raw_data, never modify in place
         if angle != None:
-            samples *= np.exp(-1j * angle)
-        
-        sample_offset = 0
-        for i, cp_len in enumerate(CP_LENGTHS):
-            symbols_time_domain.append(samples[sample_offset:sample_offset+NFFT+cp_len])
-            sample_offset = sample_offset + NFFT + cp_len
+            samples = samples * np.exp(-1j * angle)
+
+        # all symbols in one FFT, CPs skipped
+        symbols_time_domain = self.plan.symbols_t(samples)
+        symbols_freq_domain = self.plan.symbols_f(samples)
 
-        for i, _ in enumerate(symbols_time_domain):
-            # skip CP for FFT
-            sym = symbols_time_domain[i][CP_LENGTHS[i]:]
-            symbols_freq_domain.append(tfft(sym))
+        if sampling_offset != None and sampling_offset != sampling_offset_int:
+            symbols_freq_domain = fractional_delay(symbols_freq_domain, sampling_offset - sampling_offset_int, self.plan.nfft)
+        symbols_freq_domain = list(symbols_freq_domain)
 
         if linear_rotation != None:
-            for i, symbol in enumerate(symbols_freq_domain):
-                x = np.linspace(-.5 * linear_rotation * len(symbol), .5 *
-                            linear_rotation * len(symbol), len(symbol))
-                symbols_freq_domain[i] *= np.exp(x * 2j * np.pi)
+            symbols_freq_domain = self.rotate_linear(symbols_freq_domain, linear_rotation)
 
         return symbols_time_domain, symbols_freq_domain
 
+    def rotate_linear(self, symbols_f, linear_rotation):
+        """Apply a phase rotation linear over the carriers to every symbol"""
+        rotated = []
+        for symbol in symbols_f:
+            x = np.linspace(-.5 * linear_rotation * len(symbol), .5 *
+                        linear_rotation * len(symbol), len(symbol))
+            rotated.append(symbol * np.exp(x * 2j * np.pi))
+        return rotated
+
     def estimate_channel(self, sym_index, zc_seq):
+        """Least-squares channel estimate on a single (coarsely corrected) ZC symbol"""
         if sym_index not in self.ZC_SYMBOL_IDX:
             raise ValueError("Bad ZC Symbol Index")
 
-        # if sym_index == ZC_SYMBOL_IDX[0]:
-        #     zc_seq = 600
-        # if sym_index == ZC_SYMBOL_IDX[1]:
-        #     zc_seq = 147
-
-        expected_signal = zcsequence_f(zc_seq, NCARRIERS)
-        received_signal = self.symbols_freq_domain[sym_index]
+        # the ZC sequence is mapped directly onto the carriers
+        expected_signal = self.plan.zc_reference(zc_seq)
+        received_signal = self.coarse_symbols_freq_domain[sym_index]
 
-        expected_signal[NCARRIERS//2] = 1
         channel = np.divide(received_signal, expected_signal)
-
-        if self.debug:
-            plt.title("Channel Estimation")
-            plt.plot(np.abs(channel))
-            plt.show()
-
+        channel[self.NCARRIERS//2] = 0.5 * (channel[self.NCARRIERS//2-1] + channel[self.NCARRIERS//2+1])
         return channel
 
-    def symbol_equalized(self, symbol_f, channel):
-        return np.divide(symbol_f, channel)
+    def symbol_equalized(self, symbol_f, channel, noise_var=None):
+        """MMSE-equalize a symbol, noise_var defaults to the estimated noise variance"""
+        if noise_var is None:
+            noise_var = self.equalizer.noise_var
+        return symbol_f * np.conj(channel) / (np.abs(channel)**2 + noise_var)
 
     def find_zc_angle(self, symbol_f, zc_seq):
-        a = zcsequence_t(zc_seq, NCARRIERS)
+        a = self.plan.zc_reference(zc_seq)
+        dc = self.plan.dc
 
         if (symbol_f == 0).any():
-            symbol_f += 1
+            symbol_f = symbol_f + 1
 
         adiff = np.angle(a / symbol_f)
-        adiff[NCARRIERS//2] = adiff[NCARRIERS//2+1]
+        adiff[dc] = adiff[dc+1]
         adiff = np.unwrap(adiff)
 
         slope = np.max(adiff) - np.min(adiff)
@@ -169,57 +307,57 @@ class Packet:
         slope = np.sqrt(np.mean(slope**2))
 
         if self.debug:
-            print("slope", slope)
-            print("phase 0", np.angle(symbol_f[NCARRIERS//2]))
+            import matplotlib.pyplot as plt
+            logger.debug("slope %f, phase 0 %f", slope, np.angle(symbol_f[dc]))
             plt.plot(adiff)
             plt.title("Phase diff of ZC Seq")
             plt.show()
 
-        return np.angle(symbol_f[NCARRIERS//2])
+        return np.angle(symbol_f[dc])
 
     def find_fine_start(self, samples):
         """Fine-tune symbol start using cyclic prefixes (first symbol only"""
-        res = []
         cpl = self.CP_LENGTHS[0]
+        nfft = self.plan.nfft
 
-        for n in range(NFFT, len(samples) - cpl):
-            ac = np.sum(samples[n:n+cpl] * np.conj(samples[n-NFFT:n-NFFT+cpl]))
-            #ac = np.max(corr(samples[n:n+cpl], samples[n-NFFT:n-NFFT+cpl]))
-            res.append(ac)
+        # correlation of every CP-long window with the one nfft samples earlier
+        res = kernels.cp_correlation(samples, nfft, cpl)
 
         res_abs = np.abs(res)
         # distance is roughly number of samples of a symbol at Fs
-        peaks, _ = signal.find_peaks(res_abs, distance = 1000)
+        peaks, _ = signal.find_peaks(res_abs, distance = self.plan.peak_distance)
         peak_prominences, _, _ = signal.peak_prominences(res_abs, peaks)
         # discard small peaks
         peak_index = np.where(peak_prominences > 1.0)[0][0]
         
         if self.debug:
-            x = np.linspace(0, len(samples) / (NFFT + cpl), len(res_abs))
+            import matplotlib.mlab
+            import matplotlib.pyplot as plt
+            x = np.linspace(0, len(samples) / (nfft + cpl), len(res_abs))
             plt.plot(x, np.array(res_abs)*300)
-            # distance is at least symbol length, so at least NFFT
+            # distance is at least symbol length, so at least nfft
             plt.scatter(x[peaks], abs(res_abs[peaks])*300, marker='x')
             plt.scatter(x[peaks-cpl//2], abs(res_abs[peaks])*300, marker='x')
-            plt.specgram(samples, Fs=NFFT + cpl, NFFT=NFFT//64,
+            plt.specgram(samples, Fs=nfft + cpl, NFFT=nfft//64,
                          window=matplotlib.mlab.window_none, noverlap=0)
             plt.title("Raw Spectrum + Rough Packet Peak Estimation")
             plt.show()
 
         start = peaks[peak_index]
 
-        ffo = self.Fs / (2 * np.pi * NFFT) * np.angle(res[start])
-        print("FFO: %f" % ffo)
+        ffo = self.Fs / (2 * np.pi * nfft) * np.angle(res[start])
+        logger.debug("FFO: %f", ffo)
+        frametrace.record(cp_peak=res_abs[start], ffo=ffo)
         return start, ffo
 
     def find_zc_seq(self, symbol_f):
-        res = []
-        for r in range(1, NCARRIERS):
-            a = zcsequence_t(r, NCARRIERS)
-            res.append(np.max(np.abs(corr(symbol_f, a))))
+        # correlation with every root at once, see Numerology.zc_correlation
+        res = self.plan.zc_correlation(symbol_f)
 
         best = np.argmax(res) + 1
         if self.debug:
-            print("best zc seq", best)
+            import matplotlib.pyplot as plt
+            logger.debug("best zc seq %i", best)
 
             # plot the correlation; there should be ONE SINGLE hit,
             # otherwise things are terribly wrong.
@@ -230,40 +368,37 @@ class Packet:
         return best
 
     def find_zc_offset(self, symbol_idx, seq, cyc):
-        a = zcsequence_t(seq, NCARRIERS)
-
-        resx = []
-        resy = []
+        a = self.plan.zc_reference(seq)
 
         # fine-tune sample alignment by seaching for peak in ZC correlation
         samples = self.raw_samples_orig[self.start:]
         samples = fshift(samples, -self.detected_ffo, self.Fs)
 
-        for i in np.linspace(-15, 15, 1000):
-            _, symbols_f = self.raw_data_to_symbols(samples, 0, ffo=None, sampling_offset=i)
+        resx = np.linspace(-15, 15, 1000)
+        offsets_int = np.floor(resx).astype(int)
 
-            zc_sym_f = symbols_f[symbol_idx]
+        # FFT the ZC symbol once per integer offset, the fractional part is a phase ramp
+        sym_start = self.plan.fft_starts[symbol_idx]
+        nfft = self.plan.nfft
+        zc_sym_f = {}
+        for offset in np.unique(offsets_int):
+            zc_sym_f[offset] = self.plan.tfft(integer_sample_offset(samples, offset)[sym_start:sym_start+nfft])
+        zc_sym_f = np.array([zc_sym_f[offset] for offset in offsets_int])
+        zc_sym_f = fractional_delay(zc_sym_f, resx - offsets_int, nfft)
 
-            # prevent division by zero
-            if (zc_sym_f == 0).any():
-                zc_sym_f += 1
+        # prevent division by zero
+        zc_sym_f += (zc_sym_f == 0).any(axis=1, keepdims=True)
 
-            adiff = np.angle(a / zc_sym_f)
-            # remove DC carrier
-            adiff[NCARRIERS//2] = adiff[NCARRIERS//2+1]
-            adiff = np.unwrap(adiff)
+        adiff = np.angle(a / zc_sym_f)
+        # remove DC carrier
+        adiff[:, self.plan.dc] = adiff[:, self.plan.dc+1]
+        adiff = np.unwrap(adiff, axis=1)
 
-            slope = np.max(adiff) - np.min(adiff)
-            slope = (adiff - np.mean(adiff))
-            slope = np.sqrt(np.mean(slope**2))
-
-            # x = np.linspace(0, len(adiff)-1, len(adiff))
-            #npslope, npoffset = np.polyfit(x, adiff, 1)
-
-            resx.append(i)
-            resy.append(slope)
+        # RMS of the phase difference, lowest for a flat (aligned) ZC sequence
+        resy = np.sqrt(np.mean((adiff - np.mean(adiff, axis=1, keepdims=True))**2, axis=1))
 
         if self.debug:
+            import matplotlib.pyplot as plt
             plt.title("RMS for ZC sequence")
             plt.xlabel("Sample Offset Correction")
             plt.ylabel("")
@@ -275,24 +410,159 @@ class Packet:
 
     def find_zc_shift(self, symbol_f, seq: int, cyc=0):
         """Find ZC cyclic shift"""
-        a = np.zeros(NFFT, dtype=np.complex64)
-
-        a = zcsequence_f(seq, MAXNCARRIERS)
+        a = zcsequence_f(seq, self.plan.ncarriers, self.plan.nfft)
         rx_symbol_f = self.symbol_equalized(symbol_f, self.channel)
     
         am = np.argmax(np.abs(corr(rx_symbol_f, a)))
-        return (cyc - am) % (NCARRIERS)
+        return (cyc - am) % (self.plan.ncarriers)
     
-    def get_symbol_data(self, linear_rotation=0, _sampling_offset=0, tune=0, skip_zc=False):
-        sampling_offset = self.sampling_offset+_sampling_offset
-        ffo = self.detected_ffo+tune
+    def get_symbol_data(self, linear_rotation=0, _sampling_offset=0, tune=0, skip_zc=False, equalized=False):
+        """Symbols with corrections applied, tweaks are added on top of the estimated values.
+
+        Only the steps affected by a changed tweak are recomputed: the
+        frequency shift for tune, the symbol extraction for _sampling_offset.
+        With equalized, the symbols are MMSE-equalized (see equalizer), the
+        channel is then estimated on the tweaked symbols.
+        """
+        with frametrace.span("get_symbol_data"):
+            return self._symbol_data(linear_rotation, _sampling_offset, tune, skip_zc, equalized)
+
+    def _symbol_data(self, linear_rotation, _sampling_offset, tune, skip_zc, equalized):
+        if tune == 0 and _sampling_offset == 0:
+            all_symbols_f = self.symbols_equalized if equalized else self.offset_symbols_freq_domain
+        else:
+            sampling_offset = self.sampling_offset+_sampling_offset
+            ffo = self.detected_ffo+tune
+
+            if self._tweaks.get("ffo") != ffo:
+                self._tweaks.clear()
+                self._tweaks["ffo"] = ffo
+                self._tweaks["shifted"] = fshift(self.raw_samples[self.start:], -ffo, self.Fs)
+
+            if self._tweaks.get("sampling_offset") != sampling_offset:
+                self._tweaks.pop("equalized", None)
+                self._tweaks["sampling_offset"] = sampling_offset
+                _, self._tweaks["symbols_f"] = self.raw_data_to_symbols(self._tweaks["shifted"], 0, sampling_offset=sampling_offset)
+
+            all_symbols_f = self._tweaks["symbols_f"]
+            if equalized:
+                if "equalized" not in self._tweaks:
+                    equalizer = Equalizer(self.ZC_SYMBOL_IDX, self.zc_roots, self.NCARRIERS)
+                    equalizer.estimate(all_symbols_f)
+                    self._tweaks["equalized"] = list(equalizer.equalize(all_symbols_f))
+                all_symbols_f = self._tweaks["equalized"]
+
+        if linear_rotation:
+            all_symbols_f = self.rotate_linear(all_symbols_f, linear_rotation)
 
-        # all symbols
-        _, all_symbols_f = self.raw_data_to_symbols(self.raw_samples_orig, self.start, ffo = ffo, sampling_offset=sampling_offset, linear_rotation=linear_rotation)
-        
         symbols_f = []
         for i, symbol in enumerate(all_symbols_f):
             if skip_zc and i in self.ZC_SYMBOL_IDX:
                 continue
             symbols_f.append(symbol)
         return symbols_f
+
+
+class PacketBatch:
+    """Demodulate N frames at once, from raw samples to equalized OFDM symbols.
+
+    Frames must already be coarsely frequency corrected and resampled (see
+    SpectrumCapture.get_packet_samples), zero-padded to a common length and
+    stacked into a 2D array. lengths holds the number of valid samples per
+    row; if omitted, every row is considered valid up to the full width.
+
+    Unlike Packet, the ZC roots are not searched for (the ones of the
+    numerology plan are assumed, 600 and 147 for Drone-ID) and no sampling offset search is performed: the channel
+    estimate obtained from the ZC symbols absorbs the residual timing offset.
+    Frames without a detected first symbol have valid set to False; their
+    symbols are meaningless.
+    """
+    def __init__(self, frames, lengths=None, Fs=15.36e6, legacy=False, packet_type="droneid"):
+        frames = np.atleast_2d(frames)
+        self.Fs = Fs
+        self.plan = get_plan(packet_type, legacy)
+        if self.plan.zc_roots is None:
+            raise ValueError("ZC roots of %s frames are unknown, use Packet" % self.plan.name)
+        self.CP_LENGTHS = self.plan.cp_lengths
+        self.ZC_SYMBOL_IDX = self.plan.zc_symbol_idx
+
+        if lengths is None:
+            lengths = np.full(frames.shape[0], frames.shape[1])
+        self.lengths = np.asarray(lengths)
+
+        # normalize amplitudes per frame
+        peak = np.max(np.abs(frames), axis=1, keepdims=True)
+        peak[peak == 0] = 1
+        self.raw_samples = frames / peak
+
+        # per-frame sync metadata
+        self.start, self.detected_ffo, self.valid = self.find_fine_start(self.raw_samples)
+
+        self.symbols_freq_domain = self.raw_data_to_symbols(self.raw_samples, self.start, self.detected_ffo)
+
+        self.equalizer = Equalizer(self.ZC_SYMBOL_IDX, self.plan.zc_roots, self.plan.ncarriers)
+        self.channel = self.equalizer.estimate(self.symbols_freq_domain)
+        self.snr = self.equalizer.snr
+        self.symbols_equalized = self.equalizer.equalize(self.symbols_freq_domain)
+
+    @classmethod
+    def from_frames(cls, frames, **kwargs):
+        """Build a batch from a list of 1D frames of different lengths"""
+        lengths = np.array([len(f) for f in frames])
+        padded = np.zeros((len(frames), np.max(lengths)), dtype=np.complex64)
+        for i, f in enumerate(frames):
+            padded[i, :len(f)] = f
+        return cls(padded, lengths=lengths, **kwargs)
+
+    def find_fine_start(self, samples):
+        """Fine-tune symbol start using cyclic prefixes (first symbol only), for all frames"""
+        cpl = self.CP_LENGTHS[0]
+        nfft = self.plan.nfft
+        nres = samples.shape[1] - cpl - nfft
+
+        # sliding sum over cpl samples of s[n] * conj(s[n-nfft]), via cumsum
+        prod = samples[:, nfft:] * np.conj(samples[:, :-nfft])
+        csum = np.zeros((samples.shape[0], prod.shape[1] + 1), dtype=np.complex128)
+        np.cumsum(prod, axis=1, out=csum[:, 1:])
+        res = csum[:, cpl:cpl + nres] - csum[:, :nres]
+        res_abs = np.abs(res)
+
+        start = np.zeros(samples.shape[0], dtype=int)
+        ffo = np.zeros(samples.shape[0])
+        valid = np.zeros(samples.shape[0], dtype=bool)
+
+        # peak picking is cheap compared to the correlation, do it per frame
+        for i, row in enumerate(res_abs):
+            row = row[:max(self.lengths[i] - cpl - nfft, 0)]
+            peaks, _ = signal.find_peaks(row, distance = self.plan.peak_distance)
+            peak_prominences, _, _ = signal.peak_prominences(row, peaks)
+            peak_index = np.where(peak_prominences > 1.0)[0]
+            if len(peak_index) == 0:
+                continue
+            start[i] = peaks[peak_index[0]]
+            ffo[i] = self.Fs / (2 * np.pi * nfft) * np.angle(res[i, start[i]])
+            valid[i] = True
+
+        return start, ffo, valid
+
+    def raw_data_to_symbols(self, samples, first_symbol_offset, ffo):
+        """Convert raw samples into OFDM symbols, returns an (N, nsym, ncarriers) array"""
+        frame_len = self.plan.frame_length
+
+        # gather each frame starting at its own first symbol, zero beyond the valid samples
+        idx = first_symbol_offset[:, None] + np.arange(frame_len)
+        in_range = idx < self.lengths[:, None]
+        aligned = np.take_along_axis(samples, np.minimum(idx, samples.shape[1] - 1), axis=1)
+        aligned = np.where(in_range, aligned, 0)
+
+        # frequency correction
+        t = np.arange(frame_len) / self.Fs
+        aligned = aligned * np.exp(-2j * np.pi * ffo[:, None] * t)
+
+        # skip CP for FFT
+        return self.plan.tfft(aligned[:, self.plan.fft_index])
+
+    def get_symbol_data(self, frame, skip_zc=False):
+        """Equalized symbols of a single frame, in the format Decoder expects"""
+        return [symbol for i, symbol in enumerate(self.symbols_equalized[frame])
+                if not (skip_zc and i in self.ZC_SYMBOL_IDX)]
@@ -1,38 +1,44 @@
-from distutils.log import debug
+import logging
 import numpy as np
-import matplotlib.pyplot as plt
+import frametrace
 from packetizer import find_packet_candidate_time
+from numerology import get_plan
 from helpers import estimate_offset, fshift, resample
 
+logger = logging.getLogger(__name__)
+
 class SpectrumCapture:
     """Class for storing raw captures and providing coarsely packetized Drone ID frames"""
     raw_data: np.array
     sampling_rate: float
     packets: list
+    packet_info: list
     debug: bool
 
-    def __init__(self, raw_data=None, skip_detection=False, Fs=50e6, debug=False, p_type = "droneid", legacy = False):
-        """Read capture from file"""
+    def __init__(self, raw_data=None, skip_detection=False, Fs=50e6, debug=False, p_type = "droneid", legacy = False, tuning = None):
+        """Read capture from file, tuning overrides the detection parameters (packetizer.DETECTION_PARAMS)"""
         self.legacy = legacy
+        self.tuning = tuning
         self.raw_data = raw_data
         self.debug = debug
         self.sampling_rate = Fs
         self.packet_type = p_type
         if skip_detection:
             self.packets = [self.raw_data, ]
+            self.packet_info = [{"start": 0, "length": len(self.raw_data), "cfo": None}, ]
         else:
             self._packetize_coarse()
 
-        if debug:
-            print(f"SpectrumCapture: found {len(self.packets)} packets")
+        logger.debug("SpectrumCapture: found %i packets", len(self.packets))
 
     def _packetize_coarse(self):
         """Packetize input data"""
         droneid_found = False
 
-        self.packets, cfo = find_packet_candidate_time(self.raw_data, self.sampling_rate, debug = self.debug, packet_type=self.packet_type, legacy = self.legacy)
+        self.packets, cfo, self.packet_info = find_packet_candidate_time(self.raw_data, self.sampling_rate, debug = self.debug, packet_type=self.packet_type, legacy = self.legacy, return_info=True, params=self.tuning)
 
         if self.debug:
+            import matplotlib.pyplot as plt
             # show all packets found
             for p in self.packets:
                 plt.specgram(p,Fs=self.sampling_rate)
@@ -42,8 +48,7 @@ class SpectrumCapture:
             droneid_found = True
 
         if not droneid_found:
-            if self.debug:
-                print("Could not verify DroneID packet!")
+            logger.debug("Could not verify DroneID packet!")
 
         #self.packets = droneid_pkt
 
@@ -55,30 +60,28 @@ class SpectrumCapture:
         packet_data = self.packets[pktnum].copy()
 
         # correct frequency offset
-        print(f"get_packet_samples pkt={pktnum}")
-        offset, success = estimate_offset(packet_data, self.sampling_rate)
-        if success:
-            packet_data = fshift(packet_data, -1.0*offset, self.sampling_rate)
-        else:
+        logger.debug("get_packet_samples pkt=%i", pktnum)
+        with frametrace.span("coarse_cfo"):
+            offset, success = estimate_offset(packet_data, self.sampling_rate, packet_type=self.packet_type)
+            if success:
+                packet_data = fshift(packet_data, -1.0*offset, self.sampling_rate)
+        frametrace.record(cfo=offset)
+        if not success:
             return ValueError("Cannot estimate carrier offset for packet %i" % (pktnum))
 
-        if self.packet_type == "droneid" or self.packet_type == "beacon":
-            resample_rate = 15.36e6
-        elif self.packet_type == "c2":
-            resample_rate = 1.92e6
-
-        # resample to LTE freq
+        # resample to LTE freq of the frame type
+        resample_rate = get_plan(self.packet_type, self.legacy).sample_rate
         if self.sampling_rate > resample_rate + .1e6:
-            if debug:
-                print("Resampling from %i MHz to %f MHz" % ((self.sampling_rate / 1e6),resample_rate))
-            packet_data = resample(packet_data, self.sampling_rate, resample_rate)
+            logger.debug("Resampling from %i MHz to %f MHz", self.sampling_rate / 1e6, resample_rate)
+            with frametrace.span("resample"):
+                packet_data = resample(packet_data, self.sampling_rate, resample_rate)
         elif self.sampling_rate < resample_rate - .1e6:
             raise ValueError("Your sampling rate is too low")
         else:
-            if debug:
-                print("Sampling rate matches, not resampling.")
+            logger.debug("Sampling rate matches, not resampling.")
         
         if self.debug:
+            import matplotlib.pyplot as plt
             plt.specgram(packet_data, Fs=self.sampling_rate)
             plt.show()
         
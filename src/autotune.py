@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""Tune the detection parameters of one site/radio on recorded captures
+
+Sweeps the parameters of packetizer.DETECTION_PARAMS (noise threshold,
+STFT length, packet length margin, start/end offset, chunk length) over
+a replay corpus and runs detection plus demodulation for every
+combination. Per combination it counts the candidates, the candidates
+with a ZC sequence (those that demodulate), the unique payloads with a
+valid CRC, how many of the labels were found, and the CPU time.
+
+Labels are the frames with a valid CRC in the sidecar of a capture (the
+burst index the offline receiver writes with --write-index). A capture
+without labels is labeled with every valid payload any combination
+decodes.
+
+The best combination (most valid payloads, then most labels, then fewest
+candidates, then least CPU time) is written as a tuning profile, load it
+with --tuning in the offline or live receiver.
+"""
+
+import json
+import time
+import logging
+import argparse
+import itertools
+from capture_file import CaptureFile, isotime
+from packetizer import find_bursts, detection_params, packet_types, DETECTION_PARAMS
+from live_stages import demod_frame
+from droneid_packet import DroneIDPacket
+from dedup import payload_key
+from eventlog import add_log_arguments, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# values tried per parameter, the defaults of the receivers are among them
+GRID = {
+    "threshold": [1.05, 1.1, 1.15, 1.25, 1.4],
+    "nperseg": [32, 64, 128],
+    "length_margin": [0.0, 0.03],
+    "start_offset": [15e-6, 3*15e-6],
+    "end_offset": [3*15e-6],
+    "chunk": [500e-3],
+}
+
+# packet types that are demodulated, others only count as candidates
+DECODED_TYPES = ("droneid", "legacy")
+
+
+def load_labels(capture_file):
+    """(serial number, sequence number) of the frames with a valid CRC in the sidecar"""
+    annotations = (capture_file.meta or {}).get("annotations", [])
+    return {(a["droneid:serial_number"], a["droneid:sequence_number"]) for a in annotations if a.get("droneid:crc_ok")}
+
+def decode(frame, Fs):
+    """(ZC found, valid payloads) of a candidate frame"""
+    payloads, _ = demod_frame(frame["samples"], Fs, frame["type"], legacy=frame["type"] == "legacy")
+    valid = []
+    for raw in payloads or []:
+        try:
+            payload = DroneIDPacket(raw)
+        except Exception:
+            continue
+        if payload.check_crc():
+            valid.append((payload_key(raw), (payload.droneid["serial_number"], payload.droneid["sequence_number"])))
+    return payloads is not None, valid
+
+class Corpus:
+    """Captures to tune on, with their labels and the decode results of every candidate seen so far"""
+    def __init__(self, filenames, sample_rate=None, p_types=("droneid", )):
+        self.filenames = filenames
+        self.packet_types = p_types
+        self.captures = [CaptureFile(filename, sample_rate=sample_rate) for filename in filenames]
+        self.labels = [load_labels(capture) for capture in self.captures]
+        # (capture, first sample, length, type) -> (ZC found, valid payloads, CPU time)
+        self.decoded = {}
+
+    def run(self, params):
+        """Detect and decode every capture with params, returns the counts of the run"""
+        result = {"candidates": 0, "zc": 0, "crc_ok": 0, "found": set(), "cpu_time": 0.0}
+        unique = set()
+
+        for n, capture in enumerate(self.captures):
+            Fs = capture.sample_rate
+            chunk_start = 0
+            for data in capture.chunks(int(params["chunk"] * Fs)):
+                start = time.process_time()
+                bursts = find_bursts(data, Fs, self.packet_types, params=params)
+                result["cpu_time"] += time.process_time() - start
+
+                for frame in bursts:
+                    result["candidates"] += 1
+                    if frame["type"] not in DECODED_TYPES:
+                        continue
+                    # the same frame is found by many combinations, it is decoded once
+                    key = (n, chunk_start + frame["start"], frame["length"], frame["type"])
+                    if key not in self.decoded:
+                        start = time.process_time()
+                        zc, valid = decode(frame, Fs)
+                        self.decoded[key] = (zc, valid, time.process_time() - start)
+                    zc, valid, cpu_time = self.decoded[key]
+                    result["zc"] += zc
+                    result["cpu_time"] += cpu_time
+                    for payload, label in valid:
+                        result["found"].add((n, label))
+                        if (n, payload) not in unique:
+                            unique.add((n, payload))
+                            result["crc_ok"] += 1
+                chunk_start += len(data)
+
+        return result
+
+    def decoded_labels(self):
+        """Labels of every valid payload decoded in any run so far"""
+        labels = [set() for _ in self.captures]
+        for (n, _, _, _), (_, valid, _) in self.decoded.items():
+            labels[n].update(label for _, label in valid)
+        return labels
+
+def candidates(grid):
+    """Every combination of the grid values, as detection parameters"""
+    names = list(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield detection_params(dict(zip(names, values)))
+
+def score(result):
+    """Sort key, larger is better"""
+    return (result["crc_ok"], result["recall"], -result["candidates"], -result["cpu_time"])
+
+def autotune(corpus, grid=GRID):
+    """Results of all combinations of grid on corpus, best first"""
+    results = []
+    for params in candidates(grid):
+        result = corpus.run(params)
+        result["params"] = params
+        results.append(result)
+        logger.info("%s: %i candidates, %i ZC, %i CRC OK, %.2f s", params, result["candidates"], result["zc"], result["crc_ok"], result["cpu_time"])
+
+    # captures without labels in their sidecar: whatever any combination decoded
+    decoded = corpus.decoded_labels()
+    labels = {(n, label) for n, capture_labels in enumerate(corpus.labels) for label in (capture_labels or decoded[n])}
+    for n, capture_labels in enumerate(corpus.labels):
+        if not capture_labels:
+            logger.warning("No labels in the sidecar of %s, using the %i payloads decoded by the sweep", corpus.filenames[n], len(decoded[n]))
+    for result in results:
+        result["labels"] = len(labels)
+        result["recall"] = len(result.pop("found") & labels) / len(labels) if labels else 0.0
+
+    return sorted(results, key=score, reverse=True)
+
+def write_profile(filename, site, radio, corpus, results):
+    best = results[0]
+    profile = {
+        "site": site,
+        "radio": radio,
+        "created": isotime(),
+        "corpus": corpus.filenames,
+        "packet_types": list(corpus.packet_types),
+        "detection": best["params"],
+        "score": {name: best[name] for name in ("candidates", "zc", "crc_ok", "recall", "labels", "cpu_time")},
+        "default": next((dict((name, result[name]) for name in ("candidates", "zc", "crc_ok", "recall", "cpu_time"))
+                         for result in results if result["params"] == DETECTION_PARAMS), None),
+    }
+    with open(filename, "w") as fd:
+        json.dump(profile, fd, indent=2)
+    return profile
+
+def floats(value):
+    return [float(v) for v in value.split(",")]
+
+def ints(value):
+    return [int(v) for v in value.split(",")]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep the detection parameters over labeled captures and write the best as tuning profile")
+    parser.add_argument('-i', '--input-file', required=True, nargs="+", help="Captures of the site, labeled by the sidecar of an offline receiver run")
+    parser.add_argument('-s', '--sample-rate', default=None, type=float, help="Sample Rate (default: from capture metadata, or 50e6)")
+    parser.add_argument('-p', '--packet-types', default=["droneid"], type=packet_types, help="Packet types to detect, comma separated (default: droneid)")
+    parser.add_argument('--site', default="default", help="Site name, stored in the profile")
+    parser.add_argument('--radio', default="b205mini", help="Radio name, stored in the profile")
+    parser.add_argument('-o', '--output', default=None, help="Profile to write (default: tuning_<site>_<radio>.json)")
+    parser.add_argument('-n', '--top', default=10, type=int, help="Print this many of the best combinations")
+    for name, values in GRID.items():
+        parser.add_argument('--' + name.replace("_", "-"), dest=name, default=values, type=ints if name == "nperseg" else floats,
+                            help="Values to try, comma separated (default: %s)" % ",".join("%g" % value for value in values))
+    add_log_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    corpus = Corpus(args.input_file, args.sample_rate, args.packet_types)
+    results = autotune(corpus, {name: getattr(args, name) for name in GRID})
+
+    print("%9s %7s %6s %9s %8s %8s | %10s %4s %6s %6s %8s" % ("threshold", "nperseg", "margin", "start_off", "end_off", "chunk", "candidates", "ZC", "CRC OK", "recall", "CPU [s]"))
+    for result in results[:args.top]:
+        params = result["params"]
+        print("%9.3f %7i %6.3f %9.2e %8.2e %8.3f | %10i %4i %6i %5.0f%% %8.3f" % (params["threshold"], params["nperseg"], params["length_margin"], params["start_offset"], params["end_offset"], params["chunk"],
+              result["candidates"], result["zc"], result["crc_ok"], 100 * result["recall"], result["cpu_time"]))
+
+    output = args.output or "tuning_%s_%s.json" % (args.site, args.radio)
+    write_profile(output, args.site, args.radio, corpus, results)
+    print("Profile written to %s, use it with --tuning %s" % (output, output))
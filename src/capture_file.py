@@ -0,0 +1,131 @@
+import os
+import gzip
+import json
+from datetime import datetime, timezone
+import numpy as np
+
+# on-disk sample formats: numpy dtype of one I or Q value, full scale, SigMF datatype
+CAPTURE_FORMATS = {
+    "fc32": ("<f4", 1.0, "cf32_le"),
+    "sc16": ("<i2", 32767.0, "ci16_le"),
+    "cs8": ("i1", 127.0, "ci8"),
+}
+
+META_SUFFIX = ".sigmf-meta"
+
+
+def to_format(samples, fmt):
+    """complex64 samples in [-1, 1] to interleaved I/Q in the given format"""
+    dtype, scale, _ = CAPTURE_FORMATS[fmt]
+    interleaved = np.asarray(samples, dtype=np.complex64).view(np.float32)
+    if fmt == "fc32":
+        return interleaved
+    info = np.iinfo(dtype)
+    return np.clip(np.round(interleaved * scale), info.min, info.max).astype(dtype)
+
+def from_format(raw, fmt):
+    """Interleaved I/Q in the given format to complex64"""
+    _, scale, _ = CAPTURE_FORMATS[fmt]
+    if fmt == "fc32":
+        return np.asarray(raw, dtype=np.float32).view(np.complex64)
+    return (np.asarray(raw, dtype=np.float32) * (1.0 / scale)).view(np.complex64)
+
+def meta_filename(filename):
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    return filename + META_SUFFIX
+
+def isotime(timestamp=None):
+    if timestamp is None:
+        return datetime.now(timezone.utc).isoformat()
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+def read_metadata(filename):
+    """SigMF-style sidecar of a capture, None if there is none"""
+    path = meta_filename(filename)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        return json.load(fd)
+
+def write_metadata(filename, fmt, sample_rate, captures=None, annotations=None, num_samples=None):
+    """Write the sidecar; captures are dicts with core:sample_start, core:frequency, core:datetime"""
+    meta = {
+        "global": {
+            "core:datatype": CAPTURE_FORMATS[fmt][2],
+            "core:sample_rate": sample_rate,
+            "core:version": "1.0.0",
+            "core:recorder": "DroneSecurity",
+        },
+        "captures": captures if captures is not None else [{"core:sample_start": 0, "core:datetime": isotime()}],
+        "annotations": annotations if annotations is not None else [],
+    }
+    if num_samples is not None:
+        # appending writers continue from here, also for compressed files
+        meta["global"]["droneid:num_samples"] = num_samples
+    with open(meta_filename(filename), "w") as fd:
+        json.dump(meta, fd, indent=2)
+    return meta
+
+
+class CaptureFile:
+    """Read a capture file of any CAPTURE_FORMATS chunk by chunk as complex64
+
+    Format and sample rate come from the sidecar if there is one, otherwise
+    from the arguments (fc32 and 50 MHz by default). Plain files are
+    memory-mapped, so converting happens per chunk only. gzip files can only
+    be read sequentially with chunks().
+    """
+    def __init__(self, filename, fmt=None, sample_rate=None):
+        self.filename = filename
+        self.meta = read_metadata(filename)
+
+        if fmt is None and self.meta is not None:
+            datatype = self.meta["global"]["core:datatype"]
+            fmt = [f for f, (_, _, d) in CAPTURE_FORMATS.items() if d == datatype][0]
+        self.fmt = fmt or "fc32"
+
+        if sample_rate is None and self.meta is not None:
+            sample_rate = self.meta["global"]["core:sample_rate"]
+        self.sample_rate = sample_rate or 50e6
+
+        self.dtype = np.dtype(CAPTURE_FORMATS[self.fmt][0])
+        self.compressed = filename.endswith(".gz")
+        if self.compressed:
+            self.raw = None
+        else:
+            self.raw = np.memmap(filename, mode='r', dtype=self.dtype)
+
+    def __len__(self):
+        """Number of complex samples"""
+        if self.raw is None:
+            raise TypeError("Length of a compressed capture is unknown")
+        return len(self.raw) // 2
+
+    def read(self, start, count):
+        """count complex samples from sample start on"""
+        return from_format(self.raw[2*start:2*(start+count)], self.fmt)
+
+    def chunks(self, chunk_samples):
+        """Iterate over the whole capture in chunks of chunk_samples"""
+        if not self.compressed:
+            for start in range(0, len(self), chunk_samples):
+                yield self.read(start, chunk_samples)
+            return
+
+        chunk_bytes = 2 * chunk_samples * self.dtype.itemsize
+        with gzip.open(self.filename, "rb") as fd:
+            while True:
+                data = fd.read(chunk_bytes)
+                if len(data) < 2 * self.dtype.itemsize:
+                    break
+                yield from_format(np.frombuffer(data[:len(data) - len(data) % (2 * self.dtype.itemsize)], dtype=self.dtype), self.fmt)
+
+    def center_frequency(self, sample):
+        """Center frequency at a sample according to the sidecar captures, None if unknown"""
+        frequency = None
+        for capture in (self.meta or {}).get("captures", []):
+            if capture["core:sample_start"] > sample:
+                break
+            frequency = capture.get("core:frequency", frequency)
+        return frequency
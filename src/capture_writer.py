@@ -0,0 +1,172 @@
+import os
+import gzip
+import time
+import queue
+import logging
+import threading
+import collections
+import numpy as np
+from capture_file import CAPTURE_FORMATS, to_format, read_metadata, write_metadata, isotime
+
+logger = logging.getLogger(__name__)
+
+# off: nothing, detections: dwells with a detected Drone-ID frame,
+# ring: the last N seconds before (and including) a detection, all: everything
+RECORD_POLICIES = ["off", "detections", "ring", "all"]
+RECORD_FORMATS = list(CAPTURE_FORMATS)
+
+# batch small writes (candidate frames) up to this many bytes
+WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
+# the ring holds the received complex64 samples (8 bytes each) in memory, 10 s at 50 MS/s
+# would be 4 GB, so it is capped at this many bytes
+RING_MAX_BYTES = 2 * 1024**3
+
+# a block this close to the end of the one before on the same frequency continues its
+# capture segment, this covers the samples dropped while settling after a retune [s]
+CAPTURE_GAP = 50e-3
+
+
+class CaptureWriter(threading.Thread):
+    """Write captures from a background thread with a bounded queue
+
+    write() never blocks the caller: if the disk cannot keep up and the
+    queue is full, the block is dropped and counted in dropped. The ring
+    goes to the queue as one item, so it is written or dropped as a whole.
+    Blocks start a new capture segment (start sample, center frequency,
+    time) in the sidecar on another frequency or after a gap in time,
+    contiguous ones are merged unless merge is False (e.g. for single
+    frames cut out of a dwell), see capture_file. The sidecar is written
+    on a retune and on close().
+    """
+    def __init__(self, filename, policy="all", fmt="fc32", compress=False, sample_rate=50e6, ring_seconds=10.0, max_queue=4, merge=True):
+        super().__init__(daemon=True)
+        if policy not in RECORD_POLICIES:
+            raise ValueError("Unknown record policy %s" % policy)
+        if fmt not in RECORD_FORMATS:
+            raise ValueError("Unknown record format %s" % fmt)
+
+        self.filename = filename
+        self.policy = policy
+        self.fmt = fmt
+        self.compress = compress
+        self.sample_rate = sample_rate
+        self.ring_seconds = ring_seconds
+        self.merge = merge
+        self.ring_samples = int(ring_seconds * sample_rate)
+        if policy == "ring" and self.ring_samples * 8 > RING_MAX_BYTES:
+            self.ring_samples = RING_MAX_BYTES // 8
+            logger.warning("Ring of %.1f s at %.1f MS/s exceeds %i MB, keeping %.1f s", ring_seconds, sample_rate / 1e6,
+                           RING_MAX_BYTES // 1024**2, self.ring_samples / sample_rate)
+        self.dropped = 0
+        self.written = 0
+
+        self.filename_data = filename + ".gz" if compress else filename
+
+        # continue sample numbering (and captures) of an existing recording
+        meta = read_metadata(self.filename_data)
+        self._captures = meta["captures"] if meta is not None else []
+        if meta is not None and "droneid:num_samples" in meta["global"]:
+            self._num_samples = meta["global"]["droneid:num_samples"]
+        elif os.path.exists(self.filename_data) and not compress:
+            self._num_samples = os.path.getsize(self.filename_data) // (2 * np.dtype(CAPTURE_FORMATS[fmt][0]).itemsize)
+        else:
+            self._num_samples = 0
+
+        # (center frequency, end time) of the last block written
+        self._last = None
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._ring = collections.deque()
+        self._ring_samples = 0
+
+        if policy != "off":
+            self.start()
+
+    def write(self, samples, detection=False, center_freq=None, timestamp=None):
+        """Hand samples to the writer, detection marks blocks with a detected frame"""
+        if self.policy == "off":
+            return
+
+        block = (samples, center_freq, time.time() if timestamp is None else timestamp)
+        if self.policy == "all" or (self.policy == "detections" and detection):
+            self._put([block])
+        elif self.policy == "ring":
+            self._ring.append(block)
+            self._ring_samples += len(samples)
+            while len(self._ring) > 1 and self._ring_samples - len(self._ring[0][0]) >= self.ring_samples:
+                self._ring_samples -= len(self._ring.popleft()[0])
+
+            if detection:
+                self._put(list(self._ring))
+                self._ring.clear()
+                self._ring_samples = 0
+
+    def _put(self, blocks):
+        """Queue blocks as one item, dropped (and counted per block) if the queue is full"""
+        try:
+            self._queue.put_nowait(blocks)
+        except queue.Full:
+            self.dropped += len(blocks)
+
+    def close(self):
+        """Write everything queued and stop the thread"""
+        if self.policy == "off":
+            return
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        if self.compress:
+            fd = gzip.open(self.filename_data, "ab", compresslevel=1)
+        else:
+            fd = open(self.filename_data, "ab")
+
+        with fd:
+            stop = False
+            while not stop:
+                batch = []
+                batch_len = 0
+                retune = False
+                blocks = self._queue.get()
+
+                # collect whatever else is waiting, up to WRITE_BATCH_BYTES
+                while True:
+                    if blocks is None:
+                        stop = True
+                        break
+                    for samples, center_freq, timestamp in blocks:
+                        retune |= self._add_capture(center_freq, timestamp, len(samples))
+                        self._num_samples += len(samples)
+
+                        data = to_format(samples, self.fmt)
+                        batch.append(data)
+                        batch_len += data.nbytes
+                    if batch_len >= WRITE_BATCH_BYTES:
+                        break
+                    try:
+                        blocks = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                if batch:
+                    for data in batch:
+                        fd.write(data.tobytes())
+                    fd.flush()
+                    self.written += batch_len
+
+                if stop or retune:
+                    write_metadata(self.filename_data, self.fmt, self.sample_rate, self._captures, num_samples=self._num_samples)
+
+    def _add_capture(self, center_freq, timestamp, length):
+        """Start a capture segment for a block unless it continues the last one, True on a retune"""
+        last = self._last
+        self._last = (center_freq, timestamp + length / self.sample_rate)
+        if self.merge and last is not None and last[0] == center_freq and abs(timestamp - last[1]) <= CAPTURE_GAP:
+            return False
+
+        capture = {"core:sample_start": self._num_samples, "core:datetime": isotime(timestamp)}
+        if center_freq is not None:
+            capture["core:frequency"] = center_freq
+        self._captures.append(capture)
+        return last is not None and last[0] != center_freq
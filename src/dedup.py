@@ -0,0 +1,76 @@
+import time
+import collections
+from droneid_packet import DRONEID_DTYPE, DRONEID_MAX_LEN, crc16
+
+# default size and lifetime of the duplicate cache
+DEDUP_MAX_ENTRIES = 4096
+DEDUP_TTL = 30.0
+
+
+def _field(name):
+    """Byte range of a DUML field, from the packet layout"""
+    dtype, offset = DRONEID_DTYPE.fields[name][:2]
+    return slice(offset, offset + dtype.itemsize)
+
+_KEY_FIELDS = [_field(name) for name in ("serial_number", "sequence_number", "crc")]
+
+def payload_key(raw_bytes):
+    """(serial number, sequence number, CRC) of a DUML payload as raw bytes, without parsing it"""
+    return tuple(bytes(raw_bytes[field]) for field in _KEY_FIELDS)
+
+_CRC_FIELD = _field("crc")
+
+def crc_ok(raw_bytes):
+    """True if the CRC of a DUML payload as raw bytes matches, without parsing it"""
+    if not raw_bytes or len(raw_bytes) < DRONEID_MAX_LEN:
+        return False
+    return int.from_bytes(raw_bytes[_CRC_FIELD], "little") == crc16(bytes(raw_bytes[:DRONEID_MAX_LEN-2]))
+
+def valid_payload(payloads):
+    """The payload with a valid CRC among the QPSK rotations of a frame, None if there is none"""
+    return next((raw_bytes for raw_bytes in payloads if crc_ok(raw_bytes)), None)
+
+
+class DuplicateFilter:
+    """Drop Drone-ID payloads that were seen before
+
+    The same broadcast is decoded more than once from repeated dwells on a
+    locked frequency or from several workers. Only payloads with a valid
+    CRC may be passed to seen(), anything else could hide a later clean
+    copy of the same broadcast. Payloads are keyed by serial
+    number, sequence number and CRC; the max_entries most recently seen
+    keys are kept, each until it was not seen for ttl seconds (sequence
+    numbers wrap).
+    """
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> time last seen, oldest first
+        self.entries = collections.OrderedDict()
+        self.unique = 0
+        self.duplicates = 0
+
+    def seen(self, raw_bytes, now=None):
+        """True if raw_bytes is a duplicate, otherwise remember it"""
+        if now is None:
+            now = time.monotonic()
+
+        # expire from the oldest end
+        while self.entries:
+            key, last_seen = next(iter(self.entries.items()))
+            if now - last_seen <= self.ttl:
+                break
+            del self.entries[key]
+
+        key = payload_key(raw_bytes)
+        if key in self.entries:
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            self.duplicates += 1
+            return True
+
+        self.entries[key] = now
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.unique += 1
+        return False
@@ -1,11 +1,18 @@
+import os
 import struct
 import json
+import logging
 import argparse
-import helpers
 import crcmod
+import numpy as np
+
+logger = logging.getLogger(__name__)
 
 DRONEID_MAX_LEN = 91
 
+# decoded bits files store one Decoder.magic() result (1412 bits, padded) per record
+DRONEID_RECORD_LEN = 177
+
 DRONEID_DRONE_TYPES = {
     "1": "Inspire 1",
     "2": "Phantom 3 Series",
@@ -61,12 +68,51 @@ DRONEID_DRONE_TYPES = {
 CRC_INIT = 0x3692
 CRC_POLY = 0x11021
 
+# building the CRC table is expensive, do it once
+crc16 = crcmod.mkCrcFun(CRC_POLY, initCrc = CRC_INIT, rev=True)
+
+# same table for the vectorized CRC (reflected poly)
+CRC_TABLE = np.zeros(256, dtype=np.uint16)
+for _i in range(256):
+    _c = _i
+    for _ in range(8):
+        _c = (_c >> 1) ^ 0x8408 if _c & 1 else _c >> 1
+    CRC_TABLE[_i] = _c
+
+# "<BBBHH16siihhhhhhQiiiiBB20sH" as numpy structured dtype
+DRONEID_DTYPE = np.dtype([
+    ("pkt_len", "u1"),
+    ("unk", "u1"),
+    ("version", "u1"),
+    ("sequence_number", "<u2"),
+    ("state_info", "<u2"),
+    ("serial_number", "S16"),
+    ("longitude", "<i4"),
+    ("latitude", "<i4"),
+    ("altitude", "<i2"),
+    ("height", "<i2"),
+    ("v_north", "<i2"),
+    ("v_east", "<i2"),
+    ("v_up", "<i2"),
+    ("d_1_angle", "<i2"),
+    ("gps_time", "<u8"),
+    ("app_lat", "<i4"),
+    ("app_lon", "<i4"),
+    ("longitude_home", "<i4"),
+    ("latitude_home", "<i4"),
+    ("device_type", "u1"),
+    ("uuid_len", "u1"),
+    ("uuid", "S20"),
+    ("crc", "<u2"),
+])
+assert DRONEID_DTYPE.itemsize == DRONEID_MAX_LEN
+
 class DroneIDPacket:
     """Decode DUML payload to JSON."""
-    droneid = {}
 
     def __init__(self, raw_bytes):
         self.raw_bytes = raw_bytes
+        self.droneid = {}
 
         droneid_pack = struct.unpack("<BBBHH16siihhhhhhQiiiiBB20sH",raw_bytes[0:DRONEID_MAX_LEN])
         self.droneid["pkt_len"]         = droneid_pack[0]
@@ -118,10 +164,8 @@ class DroneIDPacket:
 
     def crc(self) -> str:
         """Calculate CRC of the packet."""
-        crc = crcmod.mkCrcFun(CRC_POLY, initCrc = CRC_INIT, rev=True)
         # CRC is appended to the packet
-        crc(self.raw_bytes[:DRONEID_MAX_LEN-2])
-        return "%04x" % crc(self.raw_bytes[:DRONEID_MAX_LEN-2])
+        return "%04x" % crc16(self.raw_bytes[:DRONEID_MAX_LEN-2])
 
     def check_crc(self) -> bool:
         """Returns True if the CRC matches, false otherwise."""
@@ -130,46 +174,83 @@ class DroneIDPacket:
     def __str__(self):
         return json.dumps(self.droneid, indent=4)
 
+def crc16_bulk(data: np.array) -> np.array:
+    """Table-driven CRC over the rows of an (N, L) uint8 array, one byte column at a time"""
+    crc = np.full(data.shape[0], CRC_INIT, dtype=np.uint16)
+    for column in data.T:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ column) & 0xff]
+    return crc
+
+def read_packets(filename, record_len=DRONEID_RECORD_LEN) -> np.array:
+    """Memory-map a decoded bits file as structured array of DRONEID_DTYPE records
+
+    Only whole records, a last record cut off while writing is skipped."""
+    dtype = np.dtype({"names": DRONEID_DTYPE.names,
+                      "formats": [DRONEID_DTYPE.fields[n][0] for n in DRONEID_DTYPE.names],
+                      "offsets": [DRONEID_DTYPE.fields[n][1] for n in DRONEID_DTYPE.names],
+                      "itemsize": record_len})
+    size = os.path.getsize(filename)
+    count = size // record_len
+    if size % record_len:
+        logger.warning("%s: skipping %i bytes of a truncated last record", filename, size % record_len)
+    if count == 0:
+        # np.memmap cannot map an empty file
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r", shape=(count, ))
+
+def parse_packets(records: np.array) -> dict:
+    """Convert DRONEID_DTYPE records column-wise, same units as DroneIDPacket.
+
+    Strings (serial number, uuid, device type) stay bytes / raw type ids,
+    decoding them per record is left to the caller."""
+    raw = np.ascontiguousarray(records).view(np.uint8).reshape(len(records), records.dtype.itemsize)
+    crc_calculated = crc16_bulk(raw[:, :DRONEID_MAX_LEN-2])
+
+    droneid = {}
+    for name in ("pkt_len", "unk", "version", "sequence_number", "state_info",
+                 "serial_number", "v_north", "v_east", "v_up", "d_1_angle",
+                 "gps_time", "device_type", "uuid_len", "uuid"):
+        droneid[name] = np.asarray(records[name])
+    for name in ("longitude", "latitude", "app_lat", "app_lon", "longitude_home", "latitude_home"):
+        droneid[name] = records[name] / 174533.0
+    droneid["altitude"] = np.round(records["altitude"] / 3.281, 2) # ft to m
+    droneid["height"] = np.round(records["height"] / 3.281, 2)     # ft to m
+    droneid["crc-packet"] = np.asarray(records["crc"])
+    droneid["crc-calculated"] = crc_calculated
+    droneid["crc-ok"] = droneid["crc-packet"] == crc_calculated
+    return droneid
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', type=str, help="Filename")
     parser.add_argument('-m', '--map', default=False, action="store_true", help="Create Map from coords")
+    parser.add_argument('-q', '--quiet', default=False, action="store_true", help="Do not print every packet, summary only")
     args = parser.parse_args()
-    coords = []
-    lat_list = []
-    lon_list = []
-    a_lat_list = []
-    a_lon_list = []
-
-    with open(args.file,"rb") as fd:
-        while True:
-            d = fd.read(177)
-            if len(d) == 0:
-                break
-            print("\nReceived DroneID packet:")
-            packet = DroneIDPacket(d)
 
-            if not packet.check_crc():
+    records = read_packets(args.file)
+    droneid = parse_packets(records)
+
+    if not args.quiet:
+        for i, record in enumerate(records):
+            print("\nReceived DroneID packet:")
+            if not droneid["crc-ok"][i]:
                 print("Invalid packet (CRC mismatch)")
             else:
-                print(packet)
-            lat, lon,a_lat, a_lon, height = DroneIDPacket(d).get_coords()
-            if lat != 0.0 and lon != 0.0:     
-                lat_list.append(lat)
-                lon_list.append(lon)
-
-                if a_lat != 0.0 and a_lon != 0.0:
-                    a_lat_list.append(a_lat)
-                    a_lon_list.append(a_lon)
-                coords.append((lat,lon,height))
- 
+                print(DroneIDPacket(record.tobytes()))
+
+    # same selection as before: drone position known, app position optional
+    drone = (droneid["latitude"] != 0.0) & (droneid["longitude"] != 0.0)
+    app = drone & (droneid["app_lat"] != 0.0) & (droneid["app_lon"] != 0.0)
+
+    print("\n\n%i packets, %i with CRC error" % (len(records), np.count_nonzero(~droneid["crc-ok"])))
+
     if args.map:
-        helpers.plot_map(lat_list,lon_list,a_lat_list, a_lon_list)
+        from map import plot_map
+        plot_map(droneid["latitude"][drone], droneid["longitude"][drone], droneid["app_lat"][app], droneid["app_lon"][app])
 
     print("\n\nFlyinfo (LAT, LON, Height):")
-    for c in coords:
+    for c in zip(droneid["latitude"][drone], droneid["longitude"][drone], droneid["height"][drone]):
         print(c)
 
 if __name__ == '__main__':
     main()
-
@@ -1,67 +1,57 @@
 #!/usr/bin/python3
 
-import queue
-import uhd
+try:
+    import uhd
+except ImportError:
+    # only --mock works without UHD
+    uhd = None
 import numpy as np
 import signal
-import SpectrumCapture as SC
-from Packet import Packet
-from qpsk import Decoder
+import asyncio
+import glob
+import logging
+import collections
+import concurrent.futures
 from droneid_packet import DroneIDPacket
+from trackstore import TrackStore
+from dedup import DuplicateFilter, DEDUP_TTL, valid_payload
+from capture_writer import CaptureWriter, RECORD_POLICIES, RECORD_FORMATS
+from live_stages import init_worker, run_stage, detect_dwell, detect_stream, demod_frame
+from packetizer import packet_types, PACKET_TYPES, detection_params, load_tuning
+import frametrace
+from metrics import Metrics, serve
+from eventlog import add_log_arguments, setup_logging, log_event, log_packet
 from datetime import datetime
 import argparse
-import matplotlib.pyplot as plt
-import threading
-import multiprocessing as mp
 import time
-import sys
 
 import warnings
 
 warnings.filterwarnings("ignore")
-queue = mp.Queue()
-exit_event = threading.Event()
+logger = logging.getLogger("droneid_receiver_live")
 RECV_BUFFER_LEN=1000
-streamer = None
-usrp = None
-db_filename = None
-sample_rate = None
-args = None
-coords = []
-lat_list = []
-lon_list = []
-raw_droneid_bits = []
-fixed_runs = 0
-c_freq = 0
-num_decoded = 0
-interesting_freq = 0
-crc_err = 0
-correct_pkt = 0
-total_num_pkt = 0
-recv_thread = None
-worker = None 
-
-def signal_handler(sig, frame):
-    global exit_event
-    exit_event.set()
-
-def clean_up():
-    global exit_event, recv_thread, workers
-    # Stop Stream
-    print("\n\n######### Stopping Threads, please wait #########\n\n")
-    while recv_thread.is_alive():
-        recv_thread.join(timeout=10)
-
-    print("Receiver stopped")
-    
-    for worker in workers:
-        print("Send stop message to thread:",worker.name)
-        queue.put((None, None))
-
-def decoded_to_file(raw_bits):
-    if len(raw_bits) > 0:     
-        with open(db_filename,"ab") as fd:
-            fd.write(raw_bits)
+
+FREQUENCIES = [2414.5, 2429.502441, 2434.5, 2444.5, 2459.5, 2474.5, 5721.5, 5731.5, 5741.5, 5756.5, 5761.5, 5771.5, 5786.5, 5801.5, 5816.5, 5831.5]
+
+# hop on after this many dwells without a Drone-ID frame on a locked frequency
+MAX_FIXED_RUNS = 10
+
+# candidate frames (and their payloads) in flight between the stages
+FRAME_QUEUE_DEPTH = 64
+
+# candidate types that are demodulated and decoded, the others are only counted and logged
+DECODED_TYPES = ("droneid", "legacy")
+
+# trace record kind per worker pool, same as in the offline receiver
+TRACE_KIND = {"detect": "detect", "demod": "frame"}
+
+# continuous streaming: samples per recv call, time from the stream command to the first sample,
+# and timed tune commands this close to their time are considered late [s]
+STREAM_BLOCK = 1e-3
+STREAM_LEAD = 50e-3
+TUNE_MARGIN = 10e-3
+# samples after a retune are dropped this long [s]
+SETTLE_TIME = 2e-3
 
 def set_sdr(usrp, sample_rate=50e6, duration_s=1.3, gain=None):
     ###### dev config (UHD b200) #####
@@ -86,65 +76,7 @@ def set_sdr(usrp, sample_rate=50e6, duration_s=1.3, gain=None):
 
     return num_samps, _metadata, _streamer, _recv_buffer
 
-def run_demod(samples,Fs, debug=False, legacy = False):
-    global correct_pkt, crc_err, total_num_pkt
-    chunk_samples = int(500e-3 * Fs) # in seconds
-    found = False
-
-    #for packet in packets:
-    chunks = len(samples) // chunk_samples
-
-    for i in range(chunks):
-        capture = SC.SpectrumCapture(raw_data = samples[i*chunk_samples:(i+1)*chunk_samples],Fs=Fs,debug=debug, p_type = args.packettype, legacy=legacy)
-        if debug:
-            print("Found %i Drone-ID RF frames in spectrum capture." % len(capture.packets))
-        
-        total_num_pkt += len(capture.packets)
-        for packet_num, _ in enumerate(capture.packets):
-
-            with open("ext_drone_id_" + str(sample_rate),"ab") as f:
-                f.write(_)
-            # get a Drone ID frame, resampled and with coarse center frequency correction.
-            packet_data = capture.get_packet_samples(pktnum=packet_num,debug=debug)
-
-            try:
-                packet = Packet(packet_data, debug=debug, legacy=legacy)
-            except:
-                if debug:
-                    print("Could not decode packet.")
-                continue
-            # perform RF corrections, OFDM and stuff
-            symbols = packet.get_symbol_data(skip_zc=True)
-            decoder = Decoder(symbols)
-
-            # brute force QPSK alignment
-            for phase_corr in range(4):
-                decoder.raw_data_to_symbol_bits(phase_corr)
-                droneid_duml = decoder.magic()
-                if not droneid_duml:
-                    # decoding failed
-                    continue
-                # save bits to file
-                decoded_to_file(droneid_duml)
-
-                try:
-                    payload = DroneIDPacket(droneid_duml)
-                except:
-                    print("error decoding packet")
-                    continue
-                print(payload)
-                found = True
-
-                if not payload.check_crc():
-                    # CRC check failed
-                    crc_err += 1
-                    continue
-                correct_pkt +=1
-                break 
-
-    return found
-
-def receive_samples(num_samps, metadata, streamer, recv_buffer):
+def receive_samples(num_samps, metadata, streamer, recv_buffer, metrics=None):
     # Receive Samples
     samples = np.zeros(int(num_samps), dtype=np.complex64)
 
@@ -155,148 +87,652 @@ def receive_samples(num_samps, metadata, streamer, recv_buffer):
 
     for i in range(int(num_samps//RECV_BUFFER_LEN)):
         streamer.recv(recv_buffer, metadata,timeout=1.4)
-       
-        if "ERROR_CODE_TIMEOUT" in str(metadata.strerror()):
+
+        error = str(metadata.strerror())
+        if "ERROR_CODE_TIMEOUT" in error:
             return None
-            
+        if "ERROR_CODE_OVERFLOW" in error and metrics is not None:
+            metrics.inc("droneid_rx_overflows_total")
+
 
         samples[i*RECV_BUFFER_LEN:(i+1)*RECV_BUFFER_LEN] = recv_buffer[0]
     return samples
 
-def receive_thread(usrp, sample_rate, duration, gain, queue):
-    global interesting_freq
-    frequencies = [2414.5, 2429.502441, 2434.5, 2444.5, 2459.5, 2474.5, 5721.5, 5731.5, 5741.5, 5756.5, 5761.5, 5771.5, 5786.5, 5801.5, 5816.5, 5831.5]
-    num_samps, metadata, streamer, recv_buffer = set_sdr(usrp, sample_rate, duration, gain)
-
-    while True:
-        samples = []
-        for c_freq in frequencies:
-            c_freq = c_freq * 1e6
-
-            if interesting_freq == 0:
-                cnt_freq = c_freq
-                interesting_freq = 0
-                r = usrp.set_rx_freq(uhd.libpyuhd.types.tune_request(cnt_freq), 0)
-            else:
-                r = usrp.set_rx_freq(uhd.libpyuhd.types.tune_request(interesting_freq), 0)
-                cnt_freq = interesting_freq
-
-            if not r:
-                print("Unable to set center freq")
-            else:
-                print("Center Freq: ",cnt_freq,"@",sample_rate/1e6)
 
+class ContinuousReceiver:
+    """Stream without stopping, retune with timed commands between dwells
+
+    The stream starts once. Every retune is scheduled one dwell ahead, at
+    the device time right after the previous dwell plus settle_time, so
+    the radio does not idle between dwells or while Python copies samples.
+    Received blocks are placed by their time stamps: samples within
+    settle_time after a retune are dropped, the rest go to the dwell of the
+    retune before them. Dwells that passed while the host did not receive
+    (overflow, full queue) are skipped as a whole.
+    """
+    def __init__(self, usrp, streamer, metadata, sample_rate, duration, settle_time, metrics=None):
+        self.usrp = usrp
+        self.streamer = streamer
+        self.metadata = metadata
+        self.sample_rate = sample_rate
+        self.metrics = metrics
+        self.dwell_samples = int(duration * sample_rate)
+        self.settle_time = settle_time
+        self.recv_buffer = np.zeros((1, int(STREAM_BLOCK * sample_rate)), dtype=np.complex64)
+        # (device time, center frequency) of the scheduled retunes, oldest first
+        self.schedule = collections.deque()
+        # device time of the next retune to schedule
+        self.next_tune = None
+        # (device time, samples) of the block received last, as far as not in a dwell yet
+        self.block = None
+
+    def start(self):
+        """Start streaming STREAM_LEAD from now, call after the first tune()"""
+        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
+        stream_cmd.stream_now = False
+        stream_cmd.time_spec = uhd.types.TimeSpec(self.schedule[0][0])
+        self.streamer.issue_stream_cmd(stream_cmd)
+
+    def stop(self):
+        self.streamer.issue_stream_cmd(uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont))
+
+    def tune(self, center_freq):
+        """Schedule a retune to center_freq after the last scheduled dwell"""
+        now = self.usrp.get_time_now().get_real_secs()
+        if self.next_tune is None:
+            self.next_tune = now + STREAM_LEAD
+        elif self.next_tune < now + TUNE_MARGIN:
+            # receiving fell behind, the command would come late
+            self.next_tune = now + TUNE_MARGIN
+
+        self.usrp.set_command_time(uhd.types.TimeSpec(self.next_tune))
+        r = self.usrp.set_rx_freq(uhd.libpyuhd.types.tune_request(center_freq), 0)
+        self.usrp.clear_command_time()
+        if not r:
+            logger.warning("Unable to set center freq")
+
+        self.schedule.append((self.next_tune, center_freq))
+        self.next_tune += self.settle_time + self.dwell_samples / self.sample_rate
+
+    def receive(self, on_samples=None):
+        """Samples of the next scheduled dwell with samples, its center frequency and the
+        device time of its first sample; None on timeout or if no scheduled dwell got any.
+        Samples lost to overflows are zero and counted as lost, like skipped dwells.
+        on_samples(samples, center_freq) gets the samples of the dwell in order as they
+        are received, lost ones as zeros."""
+        samples = None
+        filled = 0
+        fed = 0
+        lost = 0
+
+        while True:
+            if self.block is None:
+                count = self.streamer.recv(self.recv_buffer, self.metadata, timeout=STREAM_LEAD + 1.0)
+                error = str(self.metadata.strerror())
+                if "ERROR_CODE_TIMEOUT" in error:
+                    self._count("droneid_rx_timeouts_total")
+                    break
+                if "ERROR_CODE_OVERFLOW" in error:
+                    self._count("droneid_rx_overflows_total")
+                    continue
+                self.block = (self.metadata.time_spec.get_real_secs(), self.recv_buffer[0, :count])
 
-            samples = receive_samples(num_samps, metadata, streamer, recv_buffer)
+            block_time, block = self.block
             if samples is None:
-                continue
+                # dwells that ended before the samples at hand are gone as a whole
+                while self.schedule and block_time >= self.schedule[0][0] + self.settle_time + self.dwell_samples / self.sample_rate:
+                    self.schedule.popleft()
+                    lost += self.dwell_samples
+                if not self.schedule:
+                    break
+                tune_time, center_freq = self.schedule.popleft()
+                first = tune_time + self.settle_time
+                samples = np.zeros(self.dwell_samples, dtype=np.complex64)
+
+            # position of the block in the dwell, negative while settling (or still in the dwell before)
+            pos = int(round((block_time - first) * self.sample_rate))
+            if pos >= self.dwell_samples:
+                # next dwell
+                break
+            skip = max(-pos, 0)
+            count = max(min(len(block), self.dwell_samples - pos) - skip, 0)
+            samples[pos + skip:pos + skip + count] = block[skip:skip + count]
+            filled += count
+            self._count("droneid_rx_settling_samples_total", min(skip, len(block)))
+            if on_samples is not None and pos + skip + count > fed:
+                on_samples(samples[fed:pos + skip + count], center_freq)
+                fed = pos + skip + count
+
+            if skip + count < len(block):
+                self.block = (block_time + (skip + count) / self.sample_rate, block[skip + count:])
             else:
-                samples = samples#.view(np.complex64)
-            queue.put((samples.copy(),c_freq))
-            if exit_event.is_set():
+                self.block = None
+            if pos + skip + count >= self.dwell_samples:
                 break
-        if exit_event.is_set():
-            print("Receiver Thread: Stopped")
-            break
 
+        if samples is not None:
+            lost += self.dwell_samples - filled
+        self._count("droneid_rx_lost_samples_total", lost)
+        if not filled:
+            return None
+        return samples, center_freq, first
+
+    def _count(self, name, value=1):
+        if self.metrics is not None and value:
+            self.metrics.inc(name, value)
+
+
+class Dwell:
+    """Samples received on one center frequency, done when all its candidate frames are"""
+    def __init__(self, samples, center_freq, radio_time=None):
+        self.samples = samples
+        self.center_freq = center_freq
+        self.timestamp = time.time()
+        # device time of the first sample, continuous streaming only
+        self.radio_time = radio_time
+        self.pending = 0
+        self.found = False
+        # continuous streaming: futures of the detect_stream calls with its samples,
+        # and the number of samples of the stream before its first one
+        self.detection = None
+        self.stream_offset = 0
+
+
+class Tuner:
+    """Hop over FREQUENCIES, lock on a frequency with Drone-ID frames until MAX_FIXED_RUNS dwells without"""
+    def __init__(self, frequencies):
+        self.frequencies = frequencies
+        self.hop = 0
+        self.interesting_freq = 0
+        self.fixed_runs = 0
+
+    def next_frequency(self):
+        if self.interesting_freq:
+            return self.interesting_freq
+        freq = self.frequencies[self.hop % len(self.frequencies)]
+        self.hop += 1
+        return freq
+
+    def update(self, dwell):
+        if dwell.found:
+            if self.interesting_freq != dwell.center_freq:
+                logger.info("Locking Frequency to %.0f", dwell.center_freq)
+            self.interesting_freq = dwell.center_freq
+            self.fixed_runs = 0
+        elif self.interesting_freq:
+            self.fixed_runs += 1
+
+        if self.fixed_runs > MAX_FIXED_RUNS:
+            self.interesting_freq = 0
+            self.fixed_runs = 0
+
+
+def live_metrics():
+    """Metrics of the live receiver"""
+    metrics = Metrics()
+    metrics.counter("droneid_samples_received_total", "Samples received from the SDR")
+    metrics.counter("droneid_rx_overflows_total", "Receive overflows (samples lost in the SDR)")
+    metrics.counter("droneid_rx_timeouts_total", "Dwells lost to receive timeouts")
+    metrics.counter("droneid_rx_settling_samples_total", "Samples dropped after a retune (continuous streaming)")
+    metrics.counter("droneid_rx_lost_samples_total", "Samples of scheduled dwells lost to overflows (continuous streaming)")
+    metrics.gauge("droneid_rx_duty_cycle", "Share of the time since receiving started covered by received samples")
+    metrics.counter("droneid_dwells_total", "Dwells received, per band [MHz]", labelled=True)
+    metrics.counter("droneid_candidates_total", "Candidate frames detected, per packet type", labelled=True)
+    metrics.counter("droneid_demod_failures_total", "Candidate frames that could not be demodulated, per reason (cfo, zc, demod, decode)", labelled=True)
+    metrics.counter("droneid_crc_errors_total", "Decoded payloads with CRC error")
+    metrics.counter("droneid_packets_decoded_total", "Decoded packets with valid CRC")
+    metrics.counter("droneid_duplicates_total", "Decoded payloads dropped as duplicates of a payload seen before")
+    metrics.gauge("droneid_queue_depth", "Items waiting between the stages, per queue")
+    metrics.gauge("droneid_queue_capacity", "Capacity of the queues between the stages")
+    metrics.gauge("droneid_workers_busy", "Jobs running per worker pool")
+    metrics.histogram("droneid_stage_seconds", "Run time of a stage per dwell (receive, detect) or frame (demod) [s]")
+    metrics.histogram("droneid_frame_latency_seconds", "Time from the end of the dwell to the frame leaving the pipeline [s]")
+    return metrics
+
+
+class LivePipeline:
+    """source -> detect -> demod -> sink, linked by bounded queues
+
+    All stages are tasks of one event loop: the radio runs in a thread,
+    detection and demodulation in two separate process pools (live_stages),
+    so a dwell full of candidates does not hold up the detection of the
+    next one and empty dwells do not wait behind decodes. A full queue
+    blocks the stage in front of it, so the radio never runs more than
+    --queue-depth dwells ahead of detection. Statistics, tuning and file
+    output stay in this process.
+    """
+    def __init__(self, _args, usrp):
+        self.args = _args
+        self.usrp = usrp
+        self.sample_rate = _args.sample_rate
+        self.tuner = Tuner([f * 1e6 for f in FREQUENCIES])
+        self.metrics = live_metrics()
+        # from the clock, not only when a dwell comes in
+        self.metrics.computed("droneid_rx_duty_cycle", self.duty_cycle)
+
+        dt = datetime.now()
+        db_filename = "decoded_" + str(dt.day) + str(dt.month) + "_" + str(dt.hour) + str(dt.minute)
+        self.track_store = TrackStore(db_filename, compact="hour")
+        # payloads from all demod workers meet here, so one filter covers them all
+        self.dedup = DuplicateFilter(ttl=_args.dedup_ttl) if _args.dedup_ttl > 0 else None
+
+        self.capture_writer = CaptureWriter("receive_test.raw", policy=_args.record, fmt=_args.record_format, compress=_args.record_compress,
+                                            sample_rate=self.sample_rate, ring_seconds=_args.record_seconds)
+        self.frame_writer = CaptureWriter("ext_drone_id_%i" % self.sample_rate, policy=_args.record, fmt=_args.record_format, compress=_args.record_compress,
+                                          sample_rate=self.sample_rate, ring_seconds=_args.record_seconds, max_queue=256, merge=False)
+
+        self.stop = None
+        self.task = None
+        self.receive_start = None
+        self.receive_end = None
+        self.detect_params = load_tuning(_args.tuning) if _args.tuning else detection_params()
+        self.queues = {}
+        # queue high-water marks and jobs running per pool
+        self.max_depth = collections.Counter()
+        self.busy = collections.Counter()
+        self.metrics_server = None
+
+        self.pool_size = {"detect": _args.detect_workers, "demod": _args.demod_workers}
+        self.pools = {name: concurrent.futures.ProcessPoolExecutor(size, initializer=init_worker, initargs=(_args.profile,))
+                      for name, size in self.pool_size.items() if not (name == "detect" and _args.continuous)}
+        # continuous streaming: blocks are detected as received, no seams every 500 ms. Each detect
+        # worker is a pool of its own, so its detector (live_stages.detect_stream) sees a stream in order
+        self.streams = [concurrent.futures.ProcessPoolExecutor(1, initializer=init_worker, initargs=(_args.profile,))
+                        for _ in range(_args.detect_workers)] if _args.continuous else []
+        # [stream pool, center frequency, samples pushed] of the stream being received, None after a retune
+        self.stream = None
+        self.tracer = frametrace.TraceWriter(_args.trace) if _args.trace else None
+        # the radio calls block, they get a thread of their own
+        self.radio = concurrent.futures.ThreadPoolExecutor(1)
+
+    def interrupt(self):
+        """First Ctrl+C stops receiving and drains the pipeline, the second one aborts"""
+        if self.stop.is_set():
+            self.task.cancel()
+        self.stop.set()
+
+    async def run_cpu(self, pool, trace_context, fn, *fn_args):
+        """Run fn in a worker pool, records its run time in the worker and its trace"""
+        self.busy[pool] += 1
+        self.metrics.set("droneid_workers_busy", self.busy[pool], pool=pool)
+        try:
+            result, elapsed, trace_record = await asyncio.get_running_loop().run_in_executor(self.pools[pool], run_stage, TRACE_KIND[pool], self.tracer is not None, fn, *fn_args)
+        finally:
+            self.busy[pool] -= 1
+            self.metrics.set("droneid_workers_busy", self.busy[pool], pool=pool)
+        self.metrics.observe("droneid_stage_seconds", elapsed, stage=pool)
+        if trace_record is not None:
+            trace_record.update(trace_context)
+            self.tracer.write(trace_record)
+        return result
+
+    async def put(self, name, item):
+        await self.queues[name].put(item)
+        self.max_depth[name] = max(self.max_depth[name], self.queues[name].qsize())
+        self.metrics.set("droneid_queue_depth", self.queues[name].qsize(), queue=name)
+
+    async def get(self, name):
+        item = await self.queues[name].get()
+        self.metrics.set("droneid_queue_depth", self.queues[name].qsize(), queue=name)
+        return item
+
+    def queue_status(self):
+        queues = ", ".join("%s %i/%i" % (name, q.qsize(), q.maxsize) for name, q in self.queues.items())
+        busy = ", ".join("%s %i/%i" % (name, self.busy[name], self.pool_size[name]) for name in self.pools)
+        return "Queues: %s | Busy workers: %s" % (queues, busy)
+
+    async def monitor(self):
+        """Print queue depths, a full candidates queue means more demod workers are needed"""
+        while True:
+            await asyncio.sleep(self.args.stats_interval)
+            logger.info("%s", self.queue_status())
+
+    def receive_dwell(self, center_freq, radio):
+        num_samps, metadata, streamer, recv_buffer = radio
+        r = self.usrp.set_rx_freq(uhd.libpyuhd.types.tune_request(center_freq), 0)
+
+        if not r:
+            logger.warning("Unable to set center freq")
+        else:
+            logger.info("Center Freq: %.0f @ %.1f", center_freq, self.sample_rate/1e6)
+
+        start = time.perf_counter()
+        samples = receive_samples(num_samps, metadata, streamer, recv_buffer, self.metrics)
+        self.metrics.observe("droneid_stage_seconds", time.perf_counter() - start, stage="receive")
+        return samples
+
+    def receive_continuous(self, center_freq, receiver):
+        """Schedule the dwell after the next one on center_freq, then receive the next one.
+        Returns the Dwell, or None; its samples are detected while they come in."""
+        receiver.tune(center_freq)
+
+        detection = []
+        stream_offset = []
+        def on_samples(samples, dwell_freq):
+            if self.stream is None or self.stream[1] != dwell_freq:
+                self.end_stream(detection, final=self.stream is not None)
+                # retune: the next detect worker starts a new stream
+                index = 0 if self.stream is None else (self.stream[0] + 1) % len(self.streams)
+                self.stream = [index, dwell_freq, 0]
+                reset = True
+            else:
+                reset = False
+            if not stream_offset:
+                stream_offset.append(self.stream[2])
+            # copied, the dwell buffer is still written while the worker gets its samples
+            detection.append(self.streams[self.stream[0]].submit(run_stage, "detect", False, detect_stream, samples.copy(), self.sample_rate,
+                                                                 self.args.packettype, self.detect_params, reset))
+            self.stream[2] += len(samples)
+
+        start = time.perf_counter()
+        received = receiver.receive(on_samples)
+        self.metrics.observe("droneid_stage_seconds", time.perf_counter() - start, stage="receive")
+        if received is None:
+            return None
 
-def process_samples(sample_rate, queue):
-    #global droneid_found, new_cnt_freq, fixed_runs
-    global interesting_freq
-    droneid_found = False
-    fixed_runs = 0
-
-    while True:
-        samples, cnt_freq = queue.get()
+        samples, dwell_freq, radio_time = received
+        logger.info("Center Freq: %.0f @ %.1f", dwell_freq, self.sample_rate/1e6)
+        # the next dwell is scheduled already, bursts at the end of this one only wait for it on the same frequency
+        retune = not receiver.schedule or receiver.schedule[0][1] != dwell_freq
+        self.end_stream(detection, final=retune)
+        if retune:
+            self.stream = None
+
+        dwell = Dwell(samples, dwell_freq, radio_time)
+        dwell.detection = detection
+        dwell.stream_offset = stream_offset[0]
+        return dwell
+
+    def end_stream(self, detection, final):
+        """Last detect_stream call of a dwell, with a trace record; final flushes the stream before a retune"""
+        if self.stream is not None:
+            detection.append(self.streams[self.stream[0]].submit(run_stage, "detect", self.tracer is not None, detect_stream, np.zeros(0, dtype=np.complex64),
+                                                                 self.sample_rate, self.args.packettype, self.detect_params, False, final))
+
+    async def source(self):
+        loop = asyncio.get_running_loop()
+        radio = await loop.run_in_executor(self.radio, set_sdr, self.usrp, self.sample_rate, self.args.duration, self.args.gain)
+
+        receiver = None
+        if self.args.continuous:
+            _, metadata, streamer, _ = radio
+            receiver = ContinuousReceiver(self.usrp, streamer, metadata, self.sample_rate, self.args.duration, self.args.settle, self.metrics)
+            # from here on, one dwell is always scheduled ahead
+            await loop.run_in_executor(self.radio, receiver.tune, self.tuner.next_frequency())
+            await loop.run_in_executor(self.radio, receiver.start)
+
+        self.receive_start = time.monotonic()
+        while not self.stop.is_set():
+            center_freq = self.tuner.next_frequency()
+            if receiver is None:
+                samples = await loop.run_in_executor(self.radio, self.receive_dwell, center_freq, radio)
+                if samples is None:
+                    self.metrics.inc("droneid_rx_timeouts_total")
+                    continue
+                dwell = Dwell(samples, center_freq)
+            else:
+                if not receiver.schedule:
+                    # the dwells scheduled ahead were skipped, get one ahead again
+                    await loop.run_in_executor(self.radio, receiver.tune, center_freq)
+                    center_freq = self.tuner.next_frequency()
+                dwell = await loop.run_in_executor(self.radio, self.receive_continuous, center_freq, receiver)
+                if dwell is None:
+                    # ContinuousReceiver counts its timeouts and lost dwells itself
+                    continue
+            self.metrics.inc("droneid_samples_received_total", len(dwell.samples))
+            self.metrics.inc("droneid_dwells_total", band="%.1f" % (dwell.center_freq / 1e6))
+            await self.put("dwells", dwell)
+
+        self.receive_end = time.monotonic()
+        if receiver is not None:
+            await loop.run_in_executor(self.radio, receiver.stop)
+        logger.info("Receiver: Stopped")
+
+    def duty_cycle(self):
+        """Samples received per sample time while receiving, None before receiving started"""
+        if self.receive_start is None:
+            return None
+        elapsed = (self.receive_end or time.monotonic()) - self.receive_start
+        return self.metrics.value("droneid_samples_received_total") / (elapsed * self.sample_rate) if elapsed > 0 else 0.0
 
-        if samples is None and cnt_freq is None:
-            break
+    async def detect(self):
+        while True:
+            dwell = await self.get("dwells")
+            try:
+                if dwell.detection is not None:
+                    candidates = await self.detected(dwell)
+                else:
+                    candidates = await self.run_cpu("detect", {"center_freq": dwell.center_freq}, detect_dwell, dwell.samples, self.sample_rate, self.args.packettype, self.args.debug, self.detect_params)
+                for candidate in candidates:
+                    self.metrics.inc("droneid_candidates_total", type=candidate["type"])
+
+                # one detection pass for all types, only Drone-ID frames go on to the demodulators
+                decoded = [candidate for candidate in candidates if candidate["type"] in DECODED_TYPES]
+                for candidate in candidates:
+                    if candidate["type"] not in DECODED_TYPES:
+                        self.burst_seen(dwell, candidate)
+
+                dwell.pending = len(decoded)
+                if not decoded:
+                    self.dwell_done(dwell)
+                for candidate in decoded:
+                    await self.put("candidates", (dwell, candidate))
+            finally:
+                self.queues["dwells"].task_done()
+
+    async def detected(self, dwell):
+        """Candidates of a dwell detected while it was received, continuous streaming"""
+        candidates = []
+        elapsed = 0.0
+        for future in dwell.detection:
+            result, run_time, trace_record = await asyncio.wrap_future(future)
+            elapsed += run_time
+            for candidate in result:
+                # bursts at the end of the dwell before on the same frequency come before its first sample
+                candidate["start"] -= dwell.stream_offset
+            candidates += result
+            if trace_record is not None:
+                trace_record.update(center_freq=dwell.center_freq)
+                self.tracer.write(trace_record)
+        self.metrics.observe("droneid_stage_seconds", elapsed, stage="detect")
+        return candidates
+
+    async def demod(self):
+        while True:
+            dwell, candidate = await self.get("candidates")
+            try:
+                payloads, error = await self.run_cpu("demod", {"center_freq": dwell.center_freq, "sample_start": candidate["start"]}, demod_frame, candidate["samples"], self.sample_rate, "droneid", candidate["type"] == "legacy", self.args.debug)
+                if payloads is None:
+                    self.metrics.inc("droneid_demod_failures_total", reason=error)
+                    self.frame_done(dwell, candidate, False)
+                else:
+                    await self.put("payloads", (dwell, candidate, payloads))
+            finally:
+                self.queues["candidates"].task_done()
+
+    async def sink(self):
+        while True:
+            dwell, candidate, payloads = await self.get("payloads")
+            try:
+                self.frame_done(dwell, candidate, self.output(dwell, payloads))
+            finally:
+                self.queues["payloads"].task_done()
+
+    def output(self, dwell, payloads):
+        """Print and store decoded payloads, returns True if one could be parsed"""
+        if self.dedup is not None:
+            # only the rotation with a valid CRC is the broadcast, the others are noise
+            valid = valid_payload(payloads)
+            if valid is not None and self.dedup.seen(valid):
+                # frame decoded before (previous dwell, other worker): neither stored nor printed
+                self.metrics.inc("droneid_duplicates_total")
+                return True
+
+        found = False
+        for droneid_duml in payloads:
+            # save bits to file
+            self.track_store.append(droneid_duml)
 
-        with open("receive_test.raw", 'ab') as f:
-           f.write(samples)
+            try:
+                payload = DroneIDPacket(droneid_duml)
+            except:
+                logger.debug("error decoding packet")
+                continue
+            print(payload)
+            log_packet(payload, center_freq=dwell.center_freq)
+            found = True
 
-        if run_demod(samples,sample_rate,debug=args.debug, legacy = args.legacy):
-            interesting_freq = cnt_freq
-            print("Locking Frequency to", cnt_freq)
-            fixed_runs = 0
-        else:
-            fixed_runs += 1
-
-        if fixed_runs > 10:
-            interesting_freq = 0
-            fixed_runs = 0
-        
-        if exit_event.is_set():
-            print("Process Thread: Stopped")
+            if not payload.check_crc():
+                # CRC check failed
+                self.metrics.inc("droneid_crc_errors_total")
+                continue
+            self.metrics.inc("droneid_packets_decoded_total")
             break
+        return found
+
+    def burst_seen(self, dwell, candidate):
+        """Log and record a burst of a type that is not decoded (c2, beacon, ...)"""
+        logger.info("%s burst at %.0f, cfo %.0f", "/".join(candidate["types"]), dwell.center_freq, candidate["cfo"])
+        log_event("burst", type=candidate["type"], types=candidate["types"], center_freq=dwell.center_freq,
+                  sample_start=candidate["start"], length=candidate["length"], cfo=candidate["cfo"])
+        self.frame_writer.write(candidate["samples"], detection=False, center_freq=dwell.center_freq, timestamp=dwell.timestamp)
+
+    def frame_done(self, dwell, candidate, found):
+        self.metrics.observe("droneid_frame_latency_seconds", time.time() - dwell.timestamp)
+        self.frame_writer.write(candidate["samples"], detection=found, center_freq=dwell.center_freq, timestamp=dwell.timestamp)
+        dwell.found = dwell.found or found
+        dwell.pending -= 1
+        if dwell.pending == 0:
+            self.dwell_done(dwell)
+
+    def dwell_done(self, dwell):
+        self.capture_writer.write(dwell.samples, detection=dwell.found, center_freq=dwell.center_freq, timestamp=dwell.timestamp)
+        self.tuner.update(dwell)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        self.task = asyncio.current_task()
+        self.queues = {
+            "dwells": asyncio.Queue(maxsize=self.args.queue_depth),
+            "candidates": asyncio.Queue(maxsize=FRAME_QUEUE_DEPTH),
+            "payloads": asyncio.Queue(maxsize=FRAME_QUEUE_DEPTH),
+        }
+        for name, q in self.queues.items():
+            self.metrics.set("droneid_queue_capacity", q.maxsize, queue=name)
+        loop.add_signal_handler(signal.SIGINT, self.interrupt)
+        if self.args.metrics_port:
+            self.metrics_server = serve(self.metrics, self.args.metrics_port, self.args.metrics_host)
+            logger.info("Metrics on http://%s:%i/metrics (and /metrics.json)", self.args.metrics_host, self.args.metrics_port)
+
+        # one task per worker and pool, the sink runs here
+        stages = [asyncio.create_task(self.sink())]
+        stages += [asyncio.create_task(self.detect()) for _ in range(self.args.detect_workers)]
+        stages += [asyncio.create_task(self.demod()) for _ in range(self.args.demod_workers)]
+        if self.args.stats_interval > 0:
+            stages.append(asyncio.create_task(self.monitor()))
+
+        logger.info("Start receiving...")
+        try:
+            await self.source()
+
+            # let everything received so far run through, front to back
+            logger.info("######### Stopping, please wait #########")
+            for q in self.queues.values():
+                await q.join()
+        except asyncio.CancelledError:
+            logger.warning("Aborted, frames still in the pipeline are lost")
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+            for task in stages:
+                task.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+
+            self.radio.shutdown()
+            for pool in list(self.pools.values()) + self.streams:
+                pool.shutdown(cancel_futures=True)
+            self.track_store.close()
+            self.capture_writer.close()
+            self.frame_writer.close()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+
+        if self.capture_writer.dropped or self.frame_writer.dropped:
+            logger.warning("Recording could not keep up, dropped %i captures and %i frames", self.capture_writer.dropped, self.frame_writer.dropped)
+
+        print("\n\nReceived %i dwells (%i timeouts, %i overflows)" % (self.metrics.value("droneid_dwells_total"), self.metrics.value("droneid_rx_timeouts_total"), self.metrics.value("droneid_rx_overflows_total")))
+        if self.receive_start is not None:
+            print("Radio duty cycle: %.1f%% (%i samples dropped after retunes)" % (100 * self.duty_cycle(), self.metrics.value("droneid_rx_settling_samples_total")))
+        print("Max. queue depth: " + ", ".join("%s %i/%i" % (name, self.max_depth[name], q.maxsize) for name, q in self.queues.items()))
+        print("Successfully decoded %i / %i packets" % (self.metrics.value("droneid_packets_decoded_total"), sum(self.metrics.value("droneid_candidates_total", type=t) for t in DECODED_TYPES)))
+        others = {t: self.metrics.value("droneid_candidates_total", type=t) for t in PACKET_TYPES if t not in DECODED_TYPES}
+        if any(others.values()):
+            print("Other bursts: " + ", ".join("%s %i" % (t, n) for t, n in others.items() if n))
+        print(self.metrics.value("droneid_crc_errors_total"),"Packets with CRC error")
+        print(self.metrics.value("droneid_duplicates_total"),"Duplicate payloads dropped")
+
+        if self.tracer is not None:
+            self.tracer.close()
+            print("\nTrace summary:")
+            print(frametrace.summary(self.tracer.records))
 
 
 ####################################
 
 
 def main():
-    global db_filename, usrp, recv_thread, args, workers
     parser = argparse.ArgumentParser()
     parser.add_argument('-g', '--gain', default="0", type=int, help="Gain 0 == AGC")
     parser.add_argument('-s', '--sample_rate', default="50e6", type=float, help="Sample Rate")
-    parser.add_argument('-w', '--workers', default="2", type=int, help="number of worker threads for processing")
-    parser.add_argument('-l', '--legacy', default=False, action="store_true", help="Support of legacy drones (Mavic Pro, Mavic 2)")
+    parser.add_argument('-w', '--demod-workers', default="2", type=int, help="number of worker processes for demodulation and decoding")
+    parser.add_argument('--detect-workers', default="1", type=int, help="number of worker processes for frame detection")
+    parser.add_argument('--stats-interval', default=10.0, type=float, help="Print queue depths every n seconds, 0 to disable")
+    parser.add_argument('-q', '--queue-depth', default=2, type=int, help="Dwells waiting for detection before receiving pauses")
+    parser.add_argument('-l', '--legacy', default=False, action="store_true", help="Support of legacy drones (Mavic Pro, Mavic 2), same as adding legacy to -p")
     parser.add_argument('-d', '--debug', default=False, action="store_true", help="Enable debug output")
     parser.add_argument('-t', '--duration', default=1.3, type=float, help="Time of receiving samples per band")
-    parser.add_argument('-p', '--packettype', default="droneid", type=str, help="Packet type: droneid, c2, beacon, video")
-
+    parser.add_argument('-c', '--continuous', default=False, action="store_true", help="Stream continuously and retune with timed commands instead of one stream per band")
+    parser.add_argument('--settle', default=SETTLE_TIME, type=float, help="Samples dropped after a retune with --continuous [s]")
+    parser.add_argument('--mock', default=None, metavar="CAPTURE", help="No radio: stream this capture in real time through a stand-in for UHD (uhd_mock)")
+    parser.add_argument('-p', '--packettype', default="droneid", type=packet_types, help="Packet types to detect, comma separated (one detection pass for all): " + ", ".join(PACKET_TYPES) + "; only droneid and legacy are decoded")
+    parser.add_argument('--tuning', default=None, help="Tuning profile with the detection parameters of this site/radio (see autotune.py)")
+    parser.add_argument('--dedup-ttl', default=DEDUP_TTL, type=float, help="Drop payloads decoded again within this many seconds (same serial, sequence number and CRC), 0 to disable")
+    parser.add_argument('-m', '--metrics-port', default=0, type=int, help="Serve metrics (Prometheus text, JSON) on this port, 0 to disable")
+    parser.add_argument('--metrics-host', default="127.0.0.1", help="Address to serve metrics on")
+    parser.add_argument('-r', '--record', default="all", choices=RECORD_POLICIES, help="Which captures and candidate frames to record")
+    parser.add_argument('--record-format', default="fc32", choices=RECORD_FORMATS, help="On-disk sample format of recordings")
+    parser.add_argument('--record-seconds', default=10.0, type=float, help="Ring buffer length for --record ring [s], held in memory and capped at 2 GB (5.4 s at 50 MS/s)")
+    parser.add_argument('--record-compress', default=False, action="store_true", help="gzip recordings")
+
+    parser.add_argument('--trace', default=None, help="Write per-frame trace records (timings, quality values) as JSON lines to this file")
+    parser.add_argument('--profile', default=None, help="Profile the run with cProfile, write the stats to this file")
+    add_log_arguments(parser)
     args = parser.parse_args()
+    if args.legacy and "legacy" not in args.packettype:
+        args.packettype.append("legacy")
 
+    setup_logging("debug" if args.debug else args.log_level, args.events)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    usrp = uhd.usrp.MultiUSRP("type=b200, recv_frame_size=8200,num_recv_frames=512")
-
-    if args.gain > 0:
-        gain = args.gain
-    else:
+    if args.gain <= 0:
         # AGC
-        gain = False
-
-    duration = args.duration
-    sample_rate = args.sample_rate
-    channels = [0]
-
-
-    dt = datetime.now()
-    db_filename = "decoded_bits_" + str(dt.day) + str(dt.month) + "_" + str(dt.hour) + str(dt.minute) + ".bin"
-
-
-    # Start Stream
-    print("Start receiving...")
-
-    recv_thread = threading.Thread(target=receive_thread, args=(usrp, sample_rate, duration, gain, queue))
-    recv_thread.start()
-
-    num_workers = args.workers
-    workers = []
-    for i in range(num_workers):
-        proc_thread = mp.Process(target=process_samples, args=(sample_rate, queue))
-        proc_thread.start()
-        workers.append(proc_thread)
-
-    while True:
-
-        if exit_event.is_set():
-            clean_up()
-            exit_event.clear()
-
-        workers_alive = 0
-        for worker in workers:
-            if worker.is_alive():
-                workers_alive += 1
-
-        if workers_alive == 0:
-            print("No more workers alive!\nExiting...")
-            break
+        args.gain = False
+
+    global uhd
+    if args.mock:
+        import uhd_mock as uhd
+        usrp = uhd.usrp.MultiUSRP(source=args.mock)
+    elif uhd is None:
+        parser.error("UHD is not installed (python3-uhd), only --mock works without it")
+    else:
+        usrp = uhd.usrp.MultiUSRP("type=b200, recv_frame_size=8200,num_recv_frames=512")
 
-    print("\n\nSuccessfully decoded %i / %i packets" % (total_num_pkt, correct_pkt))
-    print(crc_err,"Packets with CRC error")
+    if args.profile:
+        # main process (event loop, sink) plus every worker process
+        frametrace.profile_call(args.profile, asyncio.run, LivePipeline(args, usrp).run())
+        frametrace.print_profile(args.profile, glob.glob(args.profile + ".[0-9]*"))
+    else:
+        asyncio.run(LivePipeline(args, usrp).run())
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
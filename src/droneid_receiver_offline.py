@@ -1,96 +1,199 @@
 #!/usr/bin/env python3
 
+import logging
 import argparse
 import numpy as np
 
+from capture_file import CaptureFile, CAPTURE_FORMATS, write_metadata
 from SpectrumCapture import SpectrumCapture
+from packetizer import detection_params, load_tuning
 from Packet import Packet
 from qpsk import Decoder
 from droneid_packet import DroneIDPacket
-from gui import interactive
+from eventlog import add_log_arguments, setup_logging, log_packet
+from dedup import DuplicateFilter, DEDUP_TTL
+import frametrace
+
+logger = logging.getLogger("droneid_receiver_offline")
+
+def decode_frame(capture, packet_num, _args, dedup=None, now=None):
+    """Demodulate and decode a single frame, returns the payload (None if decoding failed) and the result for the index
+
+    Payloads with a valid CRC that dedup has seen before are dropped before
+    printing, the result marks them as duplicate."""
+    payload = None
+    result = {"droneid:decoded": False}
+
+    # get a Drone ID frame, resampled and with coarse center frequency correction.
+    packet_data = capture.get_packet_samples(pktnum=packet_num)
+
+    try:
+        packet = Packet(packet_data, debug=_args.debug, enable_zc_detection=not _args.disable_zc_detection, legacy=_args.legacy)
+    except Exception as error:
+        logger.warning("Demodulation FAILED (Frame %i): %s", packet_num+1, error)
+        frametrace.record(error=str(error))
+        return payload, result
+
+    snr = 10*np.log10(np.mean(packet.snr))
+    result["droneid:snr"] = round(float(snr), 2)
+    logger.info("Channel SNR: %.1f dB", snr)
+
+    # GUI for manual RF inspection
+    if _args.gui:
+        # matplotlib and its backend are only loaded for the GUI
+        from gui import interactive
+        interactive(packet)
+
+    # channel-equalized symbol data with corrections applied
+    symbols = packet.get_symbol_data(skip_zc=True, equalized=True)
+    decoder = Decoder(symbols, packet.plan)
+
+    # brute force QPSK alignment
+    for phase_corr in range(4):
+        decoder.raw_data_to_symbol_bits(phase_corr)
+        droneid_duml = decoder.magic()
+
+        try:
+            payload = DroneIDPacket(droneid_duml)
+        except:
+            continue
+
+        # only payloads with a valid CRC are remembered, a broken copy must not hide a clean one
+        if dedup is not None and payload.check_crc() and dedup.seen(droneid_duml, now):
+            result["droneid:duplicate"] = True
+            frametrace.record(duplicate=True)
+            return None, result
+
+        print(f"## Drone-ID Payload ##")
+        print(payload)
+
+        result["droneid:decoded"] = True
+        result["droneid:crc_ok"] = payload.check_crc()
+        frametrace.record(qpsk_rotation=phase_corr, crc_ok=result["droneid:crc_ok"])
+        result["droneid:serial_number"] = payload.droneid["serial_number"]
+        result["droneid:sequence_number"] = payload.droneid["sequence_number"]
+
+        # we're done for this packet
+        break
+
+    return payload, result
 
 def main(_args):
     """Decode capture file"""
-    raw = np.memmap(_args.input_file, mode='r', dtype="<f").astype(np.float32).view(np.complex64)
+    # format and sample rate from the sidecar, unless given
+    capture_file = CaptureFile(_args.input_file, fmt=_args.format, sample_rate=_args.sample_rate)
+    sample_rate = capture_file.sample_rate
+    tuning = load_tuning(_args.tuning) if _args.tuning else detection_params()
 
     packets_decoded = 0
     crc_error = 0
+    candidates = 0
 
     drone_coords = []
     app_coords = []
 
-    chunk_samples = int(500e-3 * _args.sample_rate) # in seconds
-    chunks = len(raw) // chunk_samples +1
-
-    for i in range(chunks):
-        print("Drone-ID Frame Detection")
-
-        capture = SpectrumCapture(raw[i*chunk_samples:(i+1)*chunk_samples], skip_detection = args.skip_detection, Fs=_args.sample_rate, debug=args.debug, legacy=args.legacy)
-        print(f"Found {len(capture.packets)} Drone-ID RF frames in spectrum capture.")
-
-        for packet_num, _ in enumerate(capture.packets):
-            payload = None
-
-            print(f"################## Decoding Frame {packet_num+1}/{len(capture.packets)} ##################")
-
-            # get a Drone ID frame, resampled and with coarse center frequency correction.
-            packet_data = capture.get_packet_samples(pktnum=packet_num)
-
-            try:
-                packet = Packet(packet_data, debug=args.debug, enable_zc_detection=not args.disable_zc_detection, legacy=args.legacy)
-            except Exception as error:
-                print(f"Demodulation FAILED (Frame {packet_num+1}): {error}")
-                continue
-            
-            # GUI for manual RF inspection
-            if _args.gui:
-                interactive(packet)
-
-            # symbol data with corrections applied
-            symbols = packet.get_symbol_data(skip_zc=True)
-            decoder = Decoder(symbols)
-    
-            # brute force QPSK alignment
-            for phase_corr in range(4):
-                decoder.raw_data_to_symbol_bits(phase_corr)
-                droneid_duml = decoder.magic()
-
-                try:
-                    payload = DroneIDPacket(droneid_duml)
-                except:
-                    continue
-
-                print(f"## Drone-ID Payload ##")
-                print(payload)
-
-                if not payload.check_crc():
-                    print("CRC error!")
-
-                    # CRC check failed
-                    crc_error += 1
-                    break
-
-                drone_lat, drone_lon, app_lat, app_lon, height = DroneIDPacket(droneid_duml).get_coords()
-
-                # congrats, you received a valid Drone-ID packet
-                packets_decoded += 1
-
-                if drone_lat != 0.0 and drone_lon != 0.0:
-                    drone_coords.append((drone_lat, drone_lon, height))
-
-                if app_lat != 0.0 and app_lon != 0.0:
-                    app_coords.append((app_lat,app_lon))
-    
-                # we're done for this packet
-                break
-
-            if not payload:
-                print(f"Frame {packet_num}/{len(capture.packets)}: Decoding failed.")
+    annotations = []
+
+    tracer = frametrace.TraceWriter(_args.trace) if _args.trace else None
+    # in capture time, the sample position of the frame
+    dedup = DuplicateFilter(ttl=_args.dedup_ttl) if _args.dedup_ttl > 0 else None
+
+    def frames():
+        """(capture, packet number, first sample) of every frame to decode"""
+        if _args.use_index:
+            # seek straight to the bursts of a previous run, no detection
+            if capture_file.compressed:
+                raise ValueError("Cannot seek in compressed captures, decompress first")
+            if capture_file.meta is None or not capture_file.meta["annotations"]:
+                raise ValueError("No burst index for %s, run once with --write-index" % _args.input_file)
+
+            for annotation in capture_file.meta["annotations"]:
+                start = annotation["core:sample_start"]
+                raw = capture_file.read(start, annotation["core:sample_count"])
+                yield SpectrumCapture(raw, skip_detection=True, Fs=sample_rate, debug=_args.debug, legacy=_args.legacy), 0, start
+            return
+
+        chunk_samples = int(tuning["chunk"] * sample_rate)
+        chunk_start = 0
+
+        # samples are converted to complex64 chunk by chunk
+        for raw in capture_file.chunks(chunk_samples):
+            logger.info("Drone-ID Frame Detection")
+
+            with frametrace.frame(tracer is not None, kind="detect", sample_start=chunk_start) as trace_record:
+                capture = SpectrumCapture(raw, skip_detection = _args.skip_detection, Fs=sample_rate, debug=_args.debug, legacy=_args.legacy, tuning=tuning)
+            if tracer is not None:
+                tracer.write(trace_record)
+            logger.info("Found %i Drone-ID RF frames in spectrum capture.", len(capture.packets))
+
+            for packet_num, _ in enumerate(capture.packets):
+                logger.info("################## Decoding Frame %i/%i ##################", packet_num+1, len(capture.packets))
+                yield capture, packet_num, chunk_start + capture.packet_info[packet_num]["start"]
+
+            chunk_start += len(raw)
+
+    for capture, packet_num, first_sample in frames():
+        candidates += 1
+
+        with frametrace.frame(tracer is not None, kind="frame", sample_start=int(first_sample)) as trace_record:
+            payload, result = decode_frame(capture, packet_num, _args, dedup, first_sample / sample_rate)
+        if tracer is not None:
+            tracer.write(trace_record)
+
+        info = capture.packet_info[packet_num]
+        annotation = {
+            "core:sample_start": int(first_sample),
+            "core:sample_count": int(info["length"]),
+            "core:label": "droneid_legacy" if _args.legacy else "droneid",
+        }
+        if info["cfo"] is not None:
+            annotation["droneid:cfo"] = float(info["cfo"])
+        annotation.update(result)
+        annotations.append(annotation)
+
+        if result.get("droneid:duplicate"):
+            logger.info("Frame %i/%i: Duplicate of a payload decoded before.", packet_num, len(capture.packets))
+            continue
+
+        if not payload:
+            logger.info("Frame %i/%i: Decoding failed.", packet_num, len(capture.packets))
+            continue
+
+        log_packet(payload, sample_start=annotation["core:sample_start"], snr=result.get("droneid:snr"))
+
+        if not payload.check_crc():
+            logger.warning("CRC error!")
+
+            # CRC check failed
+            crc_error += 1
+            continue
+
+        drone_lat, drone_lon, app_lat, app_lon, height = payload.get_coords()
+
+        # congrats, you received a valid Drone-ID packet
+        packets_decoded += 1
+
+        if drone_lat != 0.0 and drone_lon != 0.0:
+            drone_coords.append((drone_lat, drone_lon, height))
+
+        if app_lat != 0.0 and app_lon != 0.0:
+            app_coords.append((app_lat,app_lon))
+
+    # burst index for the next run
+    if _args.write_index and not _args.use_index and not _args.skip_detection:
+        meta = capture_file.meta or {}
+        try:
+            write_metadata(_args.input_file, capture_file.fmt, sample_rate, meta.get("captures"), annotations,
+                           num_samples=meta.get("global", {}).get("droneid:num_samples"))
+        except OSError as error:
+            logger.warning("Could not write burst index: %s", error)
 
     print("\n\n")
-    print(f"Frame detection: {len(capture.packets)} candidates")
+    print(f"Frame detection: {candidates} candidates")
     print(f"Decoder: {packets_decoded+crc_error} total, CRC OK: {packets_decoded} ({crc_error} CRC errors)")
-    
+    if dedup is not None:
+        print(f"Duplicates dropped: {dedup.duplicates}")
+
     print("Drone Coordinates:")
     for coords in drone_coords:
         print(coords)
@@ -99,15 +202,33 @@ def main(_args):
     for coords in app_coords:
         print(coords)
 
+    if tracer is not None:
+        tracer.close()
+        print("\nTrace summary:")
+        print(frametrace.summary(tracer.records))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-g', '--gui', default=False, action="store_true", help="Show interactive")
     parser.add_argument('-i', '--input-file', default="../samples/mini2_sm", help="Binary Sample Input")
-    parser.add_argument('-s', '--sample-rate', default="50e6", type=float, help="Sample Rate")
+    parser.add_argument('-s', '--sample-rate', default=None, type=float, help="Sample Rate (default: from capture metadata, or 50e6)")
+    parser.add_argument('-F', '--format', default=None, choices=list(CAPTURE_FORMATS), help="Sample format (default: from capture metadata, or fc32)")
     parser.add_argument('-l', '--legacy', default=False, action="store_true", help="Support of legacy drones (Mavic Pro, Mavic 2)")
     parser.add_argument('-d', '--debug', default=False, action="store_true", help="Enable debug output")
     parser.add_argument('-z', '--disable-zc-detection', default=True, action="store_false", help="Disable per-symbol ZC sequence detection (faster)")
     parser.add_argument('-f', '--skip-detection', default=False, action="store_true", help="Skip packet detection and enforce decoding of input file")
+    parser.add_argument('-u', '--use-index', default=False, action="store_true", help="Decode the bursts found in a previous run (from the capture metadata), skip detection")
+    parser.add_argument('--tuning', default=None, help="Tuning profile with the detection parameters of this site/radio (see autotune.py)")
+    parser.add_argument('--trace', default=None, help="Write per-frame trace records (timings, quality values) as JSON lines to this file")
+    parser.add_argument('--profile', default=None, help="Profile the run with cProfile, write the stats to this file")
+    parser.add_argument('--dedup-ttl', default=DEDUP_TTL, type=float, help="Drop payloads decoded again within this many seconds of capture time (same serial, sequence number and CRC), 0 to disable")
+    parser.add_argument('--write-index', default=False, action="store_true", help="Write the burst index to the capture metadata (sidecar next to the capture), for --use-index and autotune.py labels")
+    add_log_arguments(parser)
     args = parser.parse_args()
 
-    main(args)
+    setup_logging("debug" if args.debug else args.log_level, args.events)
+    if args.profile:
+        frametrace.profile_call(args.profile, main, args)
+        frametrace.print_profile(args.profile)
+    else:
+        main(args)
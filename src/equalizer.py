@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import functools
+import numpy as np
+from zcsequence import zcsequence_t
+from helpers import NCARRIERS, ZC_SYMBOL_IDX
+
+
+@functools.lru_cache(maxsize=None)
+def zc_reference(root: int, ncarriers: int = NCARRIERS) -> np.array:
+    """ZC sequence as mapped onto the carriers (read-only, shared between packets)"""
+    ref = zcsequence_t(root, ncarriers)
+    ref.flags.writeable = False
+    return ref
+
+
+class Equalizer:
+    """Channel estimation on the ZC symbols and MMSE equalization
+
+    The least-squares estimates on both ZC symbols are smoothed over the
+    carriers, then interpolated over time (magnitude linearly, phase along
+    the drift between both ZC symbols). The residual of the smoothing gives
+    the noise variance, from which the MMSE weights and the per-carrier SNR
+    are derived.
+
+    Works on a single frame (nsym, ncarriers) or on a batch (N, nsym, ncarriers).
+    """
+    def __init__(self, zc_symbol_idx=ZC_SYMBOL_IDX, zc_roots=(600, 147), ncarriers=NCARRIERS, smoothing=9):
+        self.zc_symbol_idx = zc_symbol_idx
+        self.zc_roots = zc_roots
+        self.ncarriers = ncarriers
+        self.smoothing = smoothing
+
+        # per symbol channel, noise variance and per-carrier SNR of the last estimate()
+        self.channel = None
+        self.noise_var = None
+        self.snr = None
+
+    def least_squares(self, symbols_f):
+        """LS estimate on each ZC symbol, shape (..., 2, ncarriers)"""
+        dc = self.ncarriers//2
+        h_ls = np.stack([symbols_f[..., idx, :] / zc_reference(root, self.ncarriers)
+                         for idx, root in zip(self.zc_symbol_idx, self.zc_roots)], axis=-2)
+
+        # DC carrier carries nothing, take the neighbours
+        h_ls[..., dc] = 0.5 * (h_ls[..., dc-1] + h_ls[..., dc+1])
+        return h_ls
+
+    def smooth(self, h):
+        """Moving average over the carriers, normalized at the band edges"""
+        half = self.smoothing//2
+        pad = [(0, 0)] * (h.ndim - 1) + [(half + 1, half)]
+
+        # window sums via cumsum, the weight counts the carriers inside the band
+        csum = np.cumsum(np.pad(h, pad), axis=-1)
+        count = np.cumsum(np.pad(np.ones(h.shape[-1]), (half + 1, half)))
+        window = self.smoothing
+        return (csum[..., window:] - csum[..., :-window]) / (count[window:] - count[:-window])
+
+    def estimate(self, symbols_f):
+        """Estimate channel (..., nsym, ncarriers), noise variance and SNR (..., ncarriers)"""
+        symbols_f = np.asarray(symbols_f)
+        nsym = symbols_f.shape[-2]
+
+        h_ls = self.least_squares(symbols_f)
+        h = self.smooth(h_ls)
+
+        # the smoothing residual is noise only (|ZC| == 1), corrected for the window size
+        residual = np.mean(np.abs(h_ls - h)**2, axis=(-2, -1))
+        self.noise_var = residual * self.smoothing / (self.smoothing - 1)
+
+        # interpolate between (and extrapolate beyond) the ZC symbols
+        first, second = self.zc_symbol_idx
+        pos = (np.arange(nsym) - first) / (second - first)
+        pos = pos[:, None]
+
+        mag = np.abs(h)
+        drift = np.angle(h[..., 1, :] * np.conj(h[..., 0, :]))
+        magnitude = (1 - pos) * mag[..., 0:1, :] + pos * mag[..., 1:2, :]
+        phase = np.angle(h[..., 0:1, :]) + pos * drift[..., None, :]
+        self.channel = np.maximum(magnitude, 0) * np.exp(1j * phase)
+
+        noise_var = np.asarray(self.noise_var)[..., None]
+        self.snr = np.mean(np.abs(self.channel)**2, axis=-2) / np.maximum(noise_var, np.finfo(float).tiny)
+        return self.channel
+
+    def equalize(self, symbols_f):
+        """MMSE-equalize all symbols with the last estimate()"""
+        noise_var = np.asarray(self.noise_var)[..., None, None]
+        weights = np.conj(self.channel) / np.maximum(np.abs(self.channel)**2 + noise_var, np.finfo(float).tiny)
+        return np.asarray(symbols_f) * weights
+
+    def snr_db(self):
+        """Per-carrier SNR of the last estimate() in dB"""
+        return 10 * np.log10(self.snr)
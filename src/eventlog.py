@@ -0,0 +1,46 @@
+import sys
+import json
+import logging
+from datetime import datetime, timezone
+
+LOG_LEVELS = ["debug", "info", "warning", "error", "off"]
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# decoded packets as JSON lines, separate from the human readable log
+events = logging.getLogger("droneid.events")
+events.propagate = False
+events.setLevel(logging.CRITICAL + 1)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """One JSON object per event: time, event name and the event fields"""
+    def format(self, record):
+        event = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(), "event": record.msg}
+        event.update(getattr(record, "fields", {}))
+        return json.dumps(event, default=str)
+
+def add_log_arguments(parser):
+    parser.add_argument('-v', '--log-level', default="info", choices=LOG_LEVELS, help="Log level, debug shows every processing step")
+    parser.add_argument('--events', default=None, help="Write decoded packets as JSON lines to this file (- for stdout)")
+
+def setup_logging(level="info", events_file=None):
+    """Configure the log level of all modules and the packet event stream"""
+    if level == "off":
+        logging.basicConfig(level=logging.CRITICAL + 1)
+    else:
+        logging.basicConfig(level=getattr(logging, level.upper()), format=LOG_FORMAT)
+
+    if events_file is not None:
+        handler = logging.StreamHandler(sys.stdout) if events_file == "-" else logging.FileHandler(events_file)
+        handler.setFormatter(JSONLinesFormatter())
+        events.addHandler(handler)
+        events.setLevel(logging.INFO)
+
+def log_event(event, **fields):
+    if events.isEnabledFor(logging.INFO):
+        events.info(event, extra={"fields": fields})
+
+def log_packet(payload, **context):
+    """Event for a decoded DroneIDPacket, context adds e.g. the center frequency"""
+    if events.isEnabledFor(logging.INFO):
+        log_event("packet", crc_ok=payload.check_crc(), **context, **payload.droneid)
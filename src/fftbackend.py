@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""FFTs of the receiver, from numpy.fft, scipy.fft or pyFFTW
+
+All transforms (OFDM symbols, ZC correlation, STFT of the detection,
+Welch PSD of the CFO estimation) go through this module. The backend and
+its threads are taken from DRONEID_FFT (numpy, scipy, pyfftw or auto,
+default scipy) and DRONEID_FFT_WORKERS (default 1, the live receiver
+runs one process per core already), or set with configure().
+./fftbackend.py benchmarks all backends on the transform sizes of the
+receiver and prints the fastest.
+
+Results are double precision like numpy.fft, whatever the backend,
+unless single precision is asked for (single=True).
+"""
+
+import os
+import time
+import atexit
+import pickle
+import argparse
+import contextlib
+import numpy as np
+import scipy.fft
+import scipy.signal as signal
+
+try:
+    import pyfftw
+    import pyfftw.builders
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+HAVE_PYFFTW = pyfftw is not None
+
+BACKENDS = ["numpy", "scipy"] + (["pyfftw"] if HAVE_PYFFTW else [])
+
+# FFTW plans measured once per host, reused by the next process
+WISDOM_FILE = os.path.expanduser("~/.cache/droneid/fftw_wisdom.pickle")
+
+# (batch, size) of the transforms in the receiver: STFT segments, OFDM symbols, ZC correlation, Welch segments
+BENCHMARK_SHAPES = [(4096, 64), (9, 1024), (600, 1202), (64, 2048)]
+
+_backend = None
+_workers = 1
+# pyFFTW plans with their aligned buffers, per transform
+_plans = {}
+
+
+def configure(backend=None, workers=None):
+    """Select the backend (numpy, scipy, pyfftw or auto) and the number of threads per transform"""
+    global _backend, _workers
+    if backend is None:
+        backend = os.environ.get("DRONEID_FFT", "scipy")
+    if workers is None:
+        workers = int(os.environ.get("DRONEID_FFT_WORKERS", 1))
+    _workers = workers
+
+    if backend == "auto":
+        backend = fastest(repeat=3)
+    if backend not in BACKENDS:
+        raise ValueError("FFT backend %s not available, have: %s" % (backend, ", ".join(BACKENDS)))
+
+    if backend == "pyfftw" and _backend != "pyfftw":
+        load_wisdom()
+        # plans of the scipy.signal transforms
+        pyfftw.interfaces.cache.enable()
+        atexit.unregister(save_wisdom)
+        atexit.register(save_wisdom)
+    _backend = backend
+    _plans.clear()
+
+def backend():
+    """Name of the backend in use"""
+    if _backend is None:
+        configure()
+    return _backend
+
+def load_wisdom(filename=WISDOM_FILE):
+    if not os.path.exists(filename):
+        return
+    with open(filename, "rb") as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
+def save_wisdom(filename=WISDOM_FILE):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+def _pyfftw_plan(kind, shape, dtype, n, axis):
+    key = (kind, shape, dtype, n, axis, _workers)
+    if key not in _plans:
+        buffer = pyfftw.empty_aligned(shape, dtype=dtype)
+        threads = _workers if _workers > 0 else os.cpu_count()
+        _plans[key] = getattr(pyfftw.builders, kind)(buffer, n=n, axis=axis, threads=threads,
+                                                      planner_effort="FFTW_MEASURE")
+    return _plans[key]
+
+def _transform(kind, x, n, axis, single):
+    dtype = np.complex64 if single else np.complex128
+    x = np.asarray(x, dtype=dtype)
+    name = backend()
+    if name == "numpy":
+        # numpy.fft always computes in double precision
+        return getattr(np.fft, kind)(x, n=n, axis=axis).astype(dtype, copy=False)
+    if name == "scipy":
+        return getattr(scipy.fft, kind)(x, n=n, axis=axis, workers=_workers)
+    # the plan copies x into its aligned input, its output is reused by the next call
+    return _pyfftw_plan(kind, x.shape, dtype, n, axis)(x).copy()
+
+def fft(x, n=None, axis=-1, single=False):
+    """FFT along axis, of all other axes at once, complex64 with single"""
+    return _transform("fft", x, n, axis, single)
+
+def ifft(x, n=None, axis=-1, single=False):
+    """Inverse FFT along axis, of all other axes at once, complex64 with single"""
+    return _transform("ifft", x, n, axis, single)
+
+@contextlib.contextmanager
+def _scipy_backend():
+    # scipy.signal does its FFTs through scipy.fft, which can be pointed at pyFFTW
+    with scipy.fft.set_workers(_workers):
+        if backend() == "pyfftw":
+            with scipy.fft.set_backend(pyfftw.interfaces.scipy_fft):
+                yield
+        else:
+            yield
+
+def stft(x, fs, **kwargs):
+    """scipy.signal.stft with the FFTs of the selected backend (numpy uses scipy's)"""
+    with _scipy_backend():
+        return signal.stft(x, fs, **kwargs)
+
+def welch(x, fs, **kwargs):
+    """scipy.signal.welch with the FFTs of the selected backend (numpy uses scipy's)"""
+    with _scipy_backend():
+        return signal.welch(x, fs, **kwargs)
+
+
+def benchmark(backends=None, shapes=BENCHMARK_SHAPES, repeat=20):
+    """Seconds per round of all shapes (forward and inverse), per backend"""
+    previous = (_backend, _workers)
+    rng = np.random.default_rng(0)
+    inputs = [rng.standard_normal(shape) + 1j * rng.standard_normal(shape) for shape in shapes]
+
+    times = {}
+    try:
+        for name in backends or BACKENDS:
+            configure(name, _workers)
+            # first round plans
+            for x in inputs:
+                ifft(fft(x))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for x in inputs:
+                    ifft(fft(x))
+            times[name] = (time.perf_counter() - start) / repeat
+    finally:
+        if previous[0] is not None:
+            configure(*previous)
+    return times
+
+def fastest(repeat=20):
+    """Backend with the shortest benchmark() time on this host"""
+    times = benchmark(repeat=repeat)
+    return min(times, key=times.get)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the FFT backends on the transform sizes of the receiver")
+    parser.add_argument('-w', '--workers', type=int, default=int(os.environ.get("DRONEID_FFT_WORKERS", 1)), help="Threads per transform (-1: all cores)")
+    parser.add_argument('-r', '--repeat', type=int, default=20, help="Rounds per backend")
+    args = parser.parse_args()
+
+    _workers = args.workers
+    times = benchmark(repeat=args.repeat)
+    for name, seconds in sorted(times.items(), key=lambda item: item[1]):
+        print("%-7s %8.3f ms" % (name, seconds * 1e3))
+    if not HAVE_PYFFTW:
+        print("pyfftw not installed")
+    best = min(times, key=times.get)
+    print("fastest: DRONEID_FFT=%s DRONEID_FFT_WORKERS=%i" % (best, args.workers))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import time
+import json
+import pstats
+import cProfile
+import argparse
+import contextlib
+import numpy as np
+
+# record of the frame traced right now (per process), None if tracing is off
+_current = None
+
+# where a record comes from, not a quality value
+CONTEXT_FIELDS = ("kind", "timings", "frame", "sample_start", "center_freq")
+
+
+class _Span:
+    """Times a processing step of the traced frame, nested steps are not counted twice"""
+    __slots__ = ("record", "name", "start", "children")
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+        self.children = 0.0
+
+    def __enter__(self):
+        self.record["_spans"].append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        spans = self.record["_spans"]
+        spans.pop()
+        if spans:
+            spans[-1].children += elapsed
+
+        timings = self.record["timings"]
+        timings[self.name] = timings.get(self.name, 0.0) + elapsed - self.children
+        if exc_type is not None and "failed_step" not in self.record:
+            self.record["failed_step"] = self.name
+        return False
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def frame(enabled=True, **context):
+    """Trace everything run inside as one record, yields the record (None if not enabled)
+
+    context (e.g. kind, frame number, sample position) is stored in the record.
+    """
+    global _current
+    if not enabled:
+        yield None
+        return
+
+    record = {**context, "timings": {}, "_spans": []}
+    previous, _current = _current, record
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as error:
+        record["error"] = str(error)
+        raise
+    finally:
+        record["timings"]["total"] = time.perf_counter() - start
+        del record["_spans"]
+        _current = previous
+
+def span(name):
+    """Time a processing step, a no-op if no frame is traced"""
+    if _current is None:
+        return _NO_SPAN
+    return _Span(_current, name)
+
+def tracing():
+    """True while a frame is traced, to skip values that are only computed for the trace"""
+    return _current is not None
+
+def record(**values):
+    """Add quality values (CFO, ZC roots, ...) to the traced frame"""
+    if _current is not None:
+        _current.update({name: value.item() if isinstance(value, np.generic) else value for name, value in values.items()})
+
+
+def profile_call(filename, fn, *args):
+    """Run fn under cProfile, dump the stats to filename (for snakeviz, pstats, ...)"""
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn, *args)
+    finally:
+        profile.dump_stats(filename)
+
+def print_profile(filename, parts=(), limit=25):
+    """Merge the profiles of other processes (parts) into filename, print the top functions"""
+    stats = pstats.Stats(filename)
+    for part in parts:
+        stats.add(part)
+    stats.dump_stats(filename)
+    stats.sort_stats("cumulative").print_stats(limit)
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+class TraceWriter:
+    """Append trace records to a JSON lines file"""
+    def __init__(self, filename):
+        self.fd = open(filename, "a")
+        self.records = []
+
+    def write(self, trace_record):
+        if trace_record is None:
+            return
+        self.records.append(trace_record)
+        self.fd.write(json.dumps(trace_record, default=_to_json) + "\n")
+
+    def close(self):
+        self.fd.close()
+
+def read_traces(filename):
+    with open(filename) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+def summary(records):
+    """Where the time goes: per record kind and step, plus failures and quality values"""
+    lines = []
+    for kind in sorted({r.get("kind", "frame") for r in records}):
+        kind_records = [r for r in records if r.get("kind", "frame") == kind]
+        total = sum(r["timings"]["total"] for r in kind_records)
+        lines.append("%s: %i records, %.3f s" % (kind, len(kind_records), total))
+
+        steps = {}
+        for r in kind_records:
+            for name, t in r["timings"].items():
+                if name != "total":
+                    steps.setdefault(name, []).append(t)
+        for name, times in sorted(steps.items(), key=lambda item: -sum(item[1])):
+            times = np.array(times)
+            lines.append("  %-28s %6.1f%%  n=%-6i mean %8.2f ms  p95 %8.2f ms" % (
+                name, 100 * times.sum() / total if total else 0, len(times), 1e3 * times.mean(), 1e3 * np.percentile(times, 95)))
+
+        failed = {}
+        for r in kind_records:
+            if "error" in r or "failed_step" in r:
+                step = r.get("failed_step", "?")
+                failed[step] = failed.get(step, 0) + 1
+        for step, count in sorted(failed.items(), key=lambda item: -item[1]):
+            lines.append("  failed in %-20s %i" % (step, count))
+
+        values = {}
+        for r in kind_records:
+            for name, value in r.items():
+                if name not in CONTEXT_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values.setdefault(name, []).append(value)
+        for name, vals in sorted(values.items()):
+            lines.append("  %-28s mean %12.4f  min %12.4f  max %12.4f" % (name, np.mean(vals), np.min(vals), np.max(vals)))
+
+        if any("crc_ok" in r for r in kind_records):
+            ok = sum(1 for r in kind_records if r.get("crc_ok"))
+            lines.append("  crc ok %i / %i" % (ok, len(kind_records)))
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', help="Trace file written by a receiver with --trace")
+    args = parser.parse_args()
+
+    print(summary(read_traces(args.file)))
@@ -2,13 +2,17 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button
 
 import numpy as np
-import scipy.signal as signal
-from zcsequence import zcsequence_t, zcsequence_f
 
-from helpers import CP_LENGTHS, NCARRIERS, ZC_SYMBOL_IDX
+# wait this long after the last slider event before recomputing [ms]
+DEBOUNCE_MS = 80
+
+# data carriers are scattered in groups of 100, one marker per group
+MARKERS = ['+', 'x', 'o', '.', '*', 'v']
 
 def interactive(packet):
+    plan = packet.plan
     fig, ax = plt.subplots(3, 3)
+    axes = [ax[s//3][s % 3] for s in range(plan.nsymbols)]
     symbol_data_export = []
 
     linrot  = Slider(plt.axes([0.25, .1, 0.50, 0.02]),  'linear rotation', - .03, .03, valinit=0)
@@ -27,49 +31,102 @@ def interactive(packet):
                 for val in symbol:
                     fo.write("%f %f\n" % (np.real(val), np.imag(val)))
 
-    def update(_):
+    def zc_phase(s, data):
+        # Plotting for ZC Sequences
+        seq = plan.zc_reference(packet.zc_roots[plan.zc_symbol_idx.index(s)])
+        # poor man's channel estimation
+        est = seq / data
+        est[plan.dc] = (est[plan.dc-1] +
+                                est[plan.dc+1]) * .5  # fake
+        #magest = np.abs(est)
+        return np.angle(est)
+
+    def symbols():
+        # all symbols with one frequency shift and one FFT, not once per subplot
+        return packet.get_symbol_data(linear_rotation=linrot.val, _sampling_offset=off.val, tune=tune.val)
+
+    # artists are created once and then only get new data, animated ones are left out of full redraws for blitting
+    blit = fig.canvas.supports_blit
+    artists = []
+    for s, data in enumerate(symbols()):
+        a = axes[s]
+        if s in plan.zc_symbol_idx:
+            line, = a.plot(zc_phase(s, data), animated=blit)
+            a.set_ylim(-np.pi, np.pi)
+            artists.append([line])
+        else:
+            groups = []
+            for i in range(plan.ncarriers//100):
+                group = data[i*100:100*(i+1)]
+                groups.append(a.scatter(np.real(group), np.imag(group), marker=MARKERS[i], animated=blit))
+            # fixed limits, tweaks move the constellation but hardly change its size
+            limit = 1.5 * np.max(np.abs(data))
+            a.set_xlim(-limit, limit)
+            a.set_ylim(-limit, limit)
+            artists.append(groups)
+
+    # empty plots per axis, taken on every full redraw
+    backgrounds = []
+
+    def draw_artists():
+        for a, symbol_artists in zip(axes, artists):
+            for artist in symbol_artists:
+                a.draw_artist(artist)
 
+    def on_draw(_):
+        # full redraw (first show, resize): new backgrounds, then the animated artists on top
+        if blit:
+            backgrounds[:] = [fig.canvas.copy_from_bbox(a.bbox) for a in axes]
+            draw_artists()
+
+    def update():
         symbol_data_export.clear()
 
-        for axis in ax:
-            for plot in axis:
-                plot.clear()
-
-        # iterate over all symbol indices
-        for s, _ in enumerate(CP_LENGTHS):
-            a = ax[s//3][s % 3] # current axis
-
-            # current symbol data
-            #data = packet.update_params(s, linrot.val, off.val, tune.val, sr.val)
-            data = packet.get_symbol_data(linear_rotation=linrot.val, _sampling_offset=off.val, tune=tune.val)[s]
-
-            data_fft = [np.real(data), np.imag(data)]
-
-            if s in ZC_SYMBOL_IDX:
-                # Plotting for ZC Sequences
-                # 600 is wrong, this should variable
-                seq = zcsequence_t(600, NCARRIERS)
-                # poor man's channel estimation
-                est = seq / data
-                est[NCARRIERS//2] = (est[NCARRIERS//2-1] +
-                                        est[NCARRIERS//2+1]) * .5  # fake
-                #magest = np.abs(est)
-                a.plot(np.angle(est))
+        for s, data in enumerate(symbols()):
+            if s in plan.zc_symbol_idx:
+                artists[s][0].set_ydata(zc_phase(s, data))
                 symbol_data_export.append(None)
             else:
-                markers = ['+', 'x', 'o', '.', '*', 'v']
-                for i in range(NCARRIERS//100):
-                    a.scatter(data_fft[0][i*100:100*(i+1)], data_fft[1]
-                                [i*100:100*(i+1)], marker=markers[i])
+                for i, group in enumerate(artists[s]):
+                    group.set_offsets(np.column_stack((np.real(data[i*100:100*(i+1)]), np.imag(data[i*100:100*(i+1)]))))
                 symbol_data_export.append(data)
-        fig.canvas.draw_idle()
 
+        if blit and backgrounds:
+            # only the plot areas, ticks and labels stay as they are
+            for background in backgrounds:
+                fig.canvas.restore_region(background)
+            draw_artists()
+            for a in axes:
+                fig.canvas.blit(a.bbox)
+            fig.canvas.flush_events()
+        else:
+            fig.canvas.draw_idle()
+
+    # recompute once the slider rests instead of on every mouse move
+    timer = fig.canvas.new_timer(interval=DEBOUNCE_MS)
+    timer.single_shot = True
+    timer.add_callback(update)
+
+    def changed(slider):
+        def on_changed(_):
+            if blit:
+                # redraw just the slider, not the whole figure
+                slider.ax.draw(fig.canvas.get_renderer())
+                fig.canvas.blit(slider.ax.bbox)
+            else:
+                fig.canvas.draw_idle()
+            timer.stop()
+            timer.start()
+        slider.drawon = False
+        slider.on_changed(on_changed)
+
+    fig.canvas.mpl_connect("draw_event", on_draw)
     write.on_clicked(save)
-    linrot.on_changed(update)
-    off.on_changed(update)
-    tune.on_changed(update)
-    sr.on_changed(update)
-    #seqcor.on_changed(update)
-    update(0)
+    changed(linrot)
+    changed(off)
+    changed(tune)
+    changed(sr)
+    #changed(seqcor)
+    update()
 
     plt.show()
@@ -1,12 +1,13 @@
+import logging
 import numpy as np
 import scipy.signal as signal
+import fftbackend
 from fractions import Fraction
-import matplotlib.pyplot as plt
+
+logger = logging.getLogger(__name__)
 
 NCARRIERS = 601  # LTE SPEC
-NCARRIERS_c2 = 73
 MAXNCARRIERS = NCARRIERS
-MAXNCARRIERS_c2 = NCARRIERS_c2
 NFFT = 1024  # LTE SPEC
 
 # CP Len LTE SPEC: Short, first OFDM Sym: 80 Samples * 1, remaining 6 * 72 Samples
@@ -33,20 +34,9 @@ CP_LENGTHS_legacy = [
     72 + 8,  # 7
 ]
 
-CP_LENGTHS_C2 = [
-    72 + 8,  # 0
-    72,  # 1
-    72,  # 2
-    72,  # 3
-    72,  # 4
-    72,  # 5
-    72 + 8,  # 6
-]
-
 # ZC sequence in these symbols
 ZC_SYMBOL_IDX = [3, 5]
 ZC_SYMBOL_IDX_legacy = [2, 4]
-ZC_SYMBOL_IDX_c2 = [0, 6]
 
 def corr(x, y=None):
     if y is None:
@@ -55,7 +45,6 @@ def corr(x, y=None):
     return result[result.size//2:]
 
 def fshift(y, offset, Fs):
-    print(f"{len(y)}, offset={offset}, Fs={Fs}")
     x = np.linspace(0.0, len(y)/Fs, len(y))
     return y * np.exp(x * 2j * np.pi * offset)
 
@@ -63,8 +52,23 @@ def fshift_rad(y, offset, Fs):
     x = np.linspace(0.0, len(y)/Fs, len(y))
     return y * np.exp(x * 1j * np.pi * offset)
 
-def with_sample_offset(data, offset):
-        return np.interp(np.arange(offset, offset+len(data), 1), np.arange(0, len(data)), data)
+def fractional_delay(symbols_f, delay, nfft=NFFT):
+    """Advance symbols by delay samples (|delay| < 1) as a phase ramp on the tfft() carriers.
+
+    Works on a single symbol or on a stack of symbols; with an array of
+    delays, use one row per delay. Replaces interpolating the samples by
+    delay before the FFT, without the re-interpolation and re-FFT.
+    """
+    delay = np.asarray(delay)[..., None]
+    ncarriers = np.shape(symbols_f)[-1]
+    carrier_index = np.arange(-(ncarriers//2), ncarriers//2+1)
+    return symbols_f * np.exp(2j * np.pi * carrier_index * delay / nfft)
+
+def integer_sample_offset(data, offset):
+    """Advance data by an integer number of samples, zero-padding in front for negative offsets"""
+    if offset >= 0:
+        return data[offset:]
+    return np.concatenate((np.zeros(-offset, dtype=data.dtype), data))
 
 def resample(pkt_fullrate, Fs: float, Fsnew: float ):
     # decimate / resample
@@ -78,34 +82,46 @@ def resample(pkt_fullrate, Fs: float, Fsnew: float ):
 def consecutive(data, stepsize=1):
     return np.split(data, np.where(np.diff(data) != stepsize)[0]+1)
 
-def tfft(sy):
-    fft = np.fft.fft(sy, n=NFFT)
-    half_carriers = NCARRIERS//2
+def tfft(sy, nfft=NFFT, ncarriers=NCARRIERS):
+    fft = fftbackend.fft(sy, n=nfft)
+    half_carriers = ncarriers//2
     new_fft = np.concatenate((fft[-half_carriers:], fft[:half_carriers+1]))
     return new_fft
 
-def itfft(c):
-    half_carriers = NCARRIERS//2
-    c_full = np.zeros((NFFT), dtype=np.complex64)
+def itfft(c, nfft=NFFT):
+    half_carriers = len(c)//2
+    c_full = np.zeros((nfft), dtype=np.complex64)
     c_full[-half_carriers:] = c[:half_carriers]
     c_full[:half_carriers+1] = c[half_carriers:]
 
-    return np.fft.ifft(c_full)
+    return fftbackend.ifft(c_full)
 
-def estimate_offset(y, Fs, debug=False, packet_type="droneid"):
+# occupied bandwidth [Hz] per packet type, the burst durations are in packetizer.PACKET_DURATIONS
+PACKET_BANDWIDTHS = {
+    "droneid": (8e6, 11e6),  # drone ID is 9 MHz wide so 8 MHz should work :)
+    "legacy": (8e6, 11e6),
+    "c2": (1.2e6, 1.95e6),
+    "beacon": (8e6, 11e6),  # same 10 MHz LTE-like OFDM as Drone-ID
+    "pairing": (8e6, 11e6),
+    "video": (18e6, 22e6),
+}
+
+def occupied_bands(y, Fs, debug=False):
+    """Bands with power density above average as (center frequency offset, bandwidth) [Hz]"""
     nfft_welch = 2048
 
     if len(y) < nfft_welch:
-        return None, False
+        return []
 
     # calculate power density
-    f, Pxx_den = signal.welch(
+    f, Pxx_den = fftbackend.welch(
         y, Fs, nfft=nfft_welch, return_onesided=False)
 
     Pxx_den = np.fft.fftshift(Pxx_den)
     f = np.fft.fftshift(f)
 
     if debug:
+        import matplotlib.pyplot as plt
         # plot power density over frequency
         plt.semilogy(f, Pxx_den)
         plt.xlabel('frequency [Hz]')
@@ -120,9 +136,7 @@ def estimate_offset(y, Fs, debug=False, packet_type="droneid"):
     # resulting data is FFT bins with power density higher than avg
     candidate_bands = consecutive(np.where(Pxx_den > Pxx_den.mean())[0])
 
-    band_found = False
-    offset = 0.0
-
+    bands = []
     for band in candidate_bands:
         start = band[0]-nfft_welch/2
         end = band[-1]-nfft_welch/2
@@ -132,26 +146,25 @@ def estimate_offset(y, Fs, debug=False, packet_type="droneid"):
         fend = start * Fs/nfft_welch
         fstart = end * Fs/nfft_welch
 
-        if debug:
-            print("candidate band fstart: %3.2f, fend: %3.2f, bw: %3.2f MHz" % (fstart, fend, bw/1e6))
-        print("candidate band fstart: %3.2f, fend: %3.2f, bw: %3.2f MHz" % (fstart, fend, bw/1e6))
-
-        # droneid / beacons | c2 | video feed
-        if packet_type == "droneid" and (bw > 8e6 and bw < 11e6):
-            offset = fstart - 0.5*bw
-            band_found = True
-            break
-        elif packet_type == "c2" and (bw > 1.2e6 and bw < 1.95e6):
-            offset = fstart - 0.5*bw
-            band_found = True
-            break
-        elif packet_type == "video" and (bw > 18e6 and bw < 22e6):  # drone ID is 9 MHz wide so 8 MHz should work :)
-            # TODO this stops working if there are more than one simultaneous drone ID broadcasts
-            # (offset frequencies, not absolute)
-            offset = fstart - 0.5*bw
-            band_found = True
-            break
+        logger.debug("candidate band fstart: %3.2f, fend: %3.2f, bw: %3.2f MHz", fstart, fend, bw/1e6)
+        bands.append((fstart - 0.5*bw, bw))
+    return bands
 
-    if debug:
-        print("Offset found: %.2fkHz" % (offset/1000))
-    return offset, band_found
+def band_offset(bands, packet_type="droneid"):
+    """Center frequency offset of the first band as wide as packet_type, None if there is none"""
+    min_bw, max_bw = PACKET_BANDWIDTHS[packet_type]
+    for offset, bw in bands:
+        # TODO this stops working if there are more than one simultaneous broadcasts
+        # (offset frequencies, not absolute)
+        if min_bw < bw < max_bw:
+            return offset
+    return None
+
+def estimate_offset(y, Fs, debug=False, packet_type="droneid"):
+    """Center frequency offset of a packet_type burst, and whether a band of its width was found"""
+    offset = band_offset(occupied_bands(y, Fs, debug), packet_type)
+    if offset is None:
+        return 0.0, False
+
+    logger.debug("Offset found: %.2fkHz", offset/1000)
+    return offset, True
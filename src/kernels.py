@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""Per-sample loops of the receiver, compiled with Numba if it is installed
+
+Every kernel exists as a plain loop (the reference, also what Numba
+compiles) and as a NumPy version used when Numba is missing. Both give
+bit-identical results, check with ./kernels.py -i <capture>. Set
+DRONEID_KERNELS=numpy to use the NumPy versions even with Numba.
+"""
+
+import os
+import time
+import argparse
+import functools
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+# straight from 3GPP
+RM_PERM_TURBO = np.array([0, 16, 8, 24, 4, 20, 12, 28, 2, 18, 10, 26, 6, 22, 14, 30,
+                          1, 17, 9, 25, 5, 21, 13, 29, 3, 19, 11, 27, 7, 23, 15, 31])
+
+
+# reference loops, compiled as they are by Numba
+
+def _gold_loop(Nc, l, seed):
+    x1 = np.zeros(Nc + l + 31, dtype=np.bool_)
+    x2 = np.zeros(Nc + l + 31, dtype=np.bool_)
+
+    for n in range(32):
+        x2[n] = (seed >> n) & 1
+
+    x1[0] = 1
+
+    for n in range(Nc + l):
+        x1[n + 31] = x1[n + 3] ^ x1[n]
+        x2[n + 31] = x2[n + 3] ^ x2[n + 2] ^ x2[n + 1] ^ x2[n]
+
+    return x1[Nc:Nc + l] ^ x2[Nc:Nc + l]
+
+def _cp_correlation_loop(samples, nfft, cpl):
+    nres = max(len(samples) - cpl - nfft, 0)
+    # running sums of s[n] * conj(s[n-nfft]), real and imaginary part on their own
+    # (complex products are rounded differently by scalar and array code)
+    csum_re = np.zeros(max(len(samples) - nfft, 0) + 1)
+    csum_im = np.zeros(max(len(samples) - nfft, 0) + 1)
+    for n in range(len(samples) - nfft):
+        a = np.complex128(samples[n + nfft])
+        b = np.complex128(samples[n])
+        csum_re[n + 1] = csum_re[n] + (a.real * b.real + a.imag * b.imag)
+        csum_im[n + 1] = csum_im[n] + (a.imag * b.real - a.real * b.imag)
+
+    res = np.empty(nres, dtype=np.complex128)
+    for n in range(nres):
+        res[n] = complex(csum_re[n + cpl] - csum_re[n], csum_im[n + cpl] - csum_im[n])
+    return res
+
+def _rm_turbo_rx_loop(bits_in, perm):
+    ncols = 32
+    nrows = (len(bits_in) + 31) // ncols
+    n_dummy = (ncols * nrows) - len(bits_in)
+
+    bits = np.zeros((nrows, ncols), dtype=np.int64)
+
+    p = 0
+    for col in range(ncols):
+        c = perm[col]
+        first = 0
+        if c < n_dummy:
+            bits[0, c] = -1
+            first = 1
+        for row in range(first, nrows):
+            bits[row, c] = bits_in[p]
+            p += 1
+
+    return bits.ravel()[n_dummy:]
+
+def _qpsk_demap_loop(symbols, mapping):
+    out = np.empty(symbols.shape, dtype=np.int64)
+    for i in range(symbols.shape[0]):
+        for j in range(symbols.shape[1]):
+            re = symbols[i, j].real
+            im = symbols[i, j].imag
+            if re >= 0:
+                quadrant = 0 if im >= 0 else 1
+            else:
+                quadrant = 2 if im < 0 else 3
+            out[i, j] = mapping[quadrant]
+    return out
+
+
+# NumPy versions
+
+def _gold_numpy(Nc, l, seed):
+    x1 = np.zeros(Nc + l + 31, dtype=bool)
+    x2 = np.zeros(Nc + l + 31, dtype=bool)
+
+    x2[:32] = (seed >> np.arange(32)) & 1
+    x1[0] = 1
+
+    # x[n+31] only depends on x[n..n+3], so 28 outputs at a time are independent
+    for n in range(0, Nc + l, 28):
+        m = min(n + 28, Nc + l)
+        x1[n+31:m+31] = x1[n+3:m+3] ^ x1[n:m]
+        x2[n+31:m+31] = x2[n+3:m+3] ^ x2[n+2:m+2] ^ x2[n+1:m+1] ^ x2[n:m]
+
+    return x1[Nc:Nc + l] ^ x2[Nc:Nc + l]
+
+def _cp_correlation_numpy(samples, nfft, cpl):
+    nres = max(len(samples) - cpl - nfft, 0)
+    samples = np.asarray(samples, dtype=np.complex128)
+    a = samples[nfft:]
+    b = samples[:len(samples) - nfft]
+
+    csum_re = np.zeros(len(a) + 1)
+    csum_im = np.zeros(len(a) + 1)
+    np.cumsum(a.real * b.real + a.imag * b.imag, out=csum_re[1:])
+    np.cumsum(a.imag * b.real - a.real * b.imag, out=csum_im[1:])
+
+    res = np.empty(nres, dtype=np.complex128)
+    res.real = csum_re[cpl:cpl + nres] - csum_re[:nres]
+    res.imag = csum_im[cpl:cpl + nres] - csum_im[:nres]
+    return res
+
+@functools.lru_cache(maxsize=None)
+def _rm_turbo_index(length):
+    """Position of every input bit in the de-interleaved output"""
+    ncols = 32
+    nrows = (length + 31) // ncols
+    n_dummy = (ncols * nrows) - length
+
+    index = []
+    for c in RM_PERM_TURBO:
+        rows = np.arange(1 if c < n_dummy else 0, nrows)
+        index.append(rows * ncols + c - n_dummy)
+    return np.concatenate(index)
+
+def _rm_turbo_rx_numpy(bits_in, perm):
+    bits_in = np.asarray(bits_in)
+    bits = np.empty(len(bits_in), dtype=np.int64)
+    bits[_rm_turbo_index(len(bits_in))] = bits_in
+    return bits
+
+def _qpsk_demap_numpy(symbols, mapping):
+    re = symbols.real
+    im = symbols.imag
+    quadrant = np.where(re >= 0, np.where(im >= 0, 0, 1), np.where(im < 0, 2, 3))
+    return np.asarray(mapping, dtype=np.int64)[quadrant]
+
+
+KERNELS = ("gold", "cp_correlation", "rm_turbo_rx", "qpsk_demap")
+
+BACKENDS = {
+    "python": {name: globals()["_%s_loop" % name] for name in KERNELS},
+    "numpy": {name: globals()["_%s_numpy" % name] for name in KERNELS},
+}
+if HAVE_NUMBA:
+    # compiled on first use, cached on disk for the next process
+    BACKENDS["numba"] = {name: numba.njit(cache=True)(BACKENDS["python"][name]) for name in KERNELS}
+
+BACKEND = os.environ.get("DRONEID_KERNELS", "numba" if HAVE_NUMBA else "numpy")
+if BACKEND not in BACKENDS:
+    raise ImportError("Kernel backend %s not available, have: %s" % (BACKEND, ", ".join(BACKENDS)))
+_kernels = BACKENDS[BACKEND]
+
+
+def gold(Nc, l, seed):
+    """Gold sequence of length l after Nc shifts (3GPP 36.211, 7.2)"""
+    return _kernels["gold"](Nc, l, seed)
+
+def cp_correlation(samples, nfft, cpl):
+    """Sum of s[n+k] * conj(s[n-nfft+k]) over k < cpl, for every n in nfft..len(samples)-cpl-1"""
+    return _kernels["cp_correlation"](samples, nfft, cpl)
+
+def rm_turbo_rx(bits_in):
+    """Undo the sub-block interleaver of the systematic stream (3GPP 36.212, 5.1.4.1.1)"""
+    return _kernels["rm_turbo_rx"](np.asarray(bits_in), RM_PERM_TURBO)
+
+def qpsk_demap(symbols, mapping):
+    """Map QPSK symbols (2D) by quadrant (I, IV, III, II) to mapping[quadrant]"""
+    return _kernels["qpsk_demap"](np.atleast_2d(symbols), np.asarray(mapping, dtype=np.int64))
+
+
+def check(capture_file, sample_rate, frames, repeat):
+    """Run every kernel in every backend on frames of a capture, True if all results are identical"""
+    # imported here, the receiver modules import this one
+    from capture_file import CaptureFile
+    from SpectrumCapture import SpectrumCapture
+    from Packet import Packet
+    from qpsk import qpsk_to_bits
+    from numerology import get_plan
+
+    plan = get_plan()
+    capture = CaptureFile(capture_file, sample_rate=sample_rate)
+    raw = next(capture.chunks(int(500e-3 * capture.sample_rate)))
+    spectrum = SpectrumCapture(raw, Fs=capture.sample_rate)
+
+    inputs = {"gold": [(1600, 8400, 0x12345678), (0, 1, 1)],
+              "rm_turbo_rx": [(np.arange(plan.rm_length), RM_PERM_TURBO), (np.arange(32), RM_PERM_TURBO)],
+              "cp_correlation": [], "qpsk_demap": []}
+    for i in range(min(frames, len(spectrum.packets))):
+        try:
+            packet = Packet(spectrum.get_packet_samples(pktnum=i), enable_zc_detection=False)
+        except Exception as error:
+            print("frame %i: %s, skipped" % (i, error))
+            continue
+        inputs["cp_correlation"].append((packet.raw_samples, plan.nfft, plan.cp_lengths[0]))
+        symbols = np.array(packet.get_symbol_data(skip_zc=True))
+        for mapping in qpsk_to_bits:
+            inputs["qpsk_demap"].append((symbols, np.array(mapping, dtype=np.int64)))
+
+    ok = True
+    for name in KERNELS:
+        results = {}
+        for backend, kernels in BACKENDS.items():
+            kernel = kernels[name]
+            # the first call compiles
+            results[backend] = [kernel(*args) for args in inputs[name]]
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for args in inputs[name]:
+                    kernel(*args)
+            elapsed = (time.perf_counter() - start) / max(repeat * len(inputs[name]), 1)
+            print("%-15s %-7s %10.3f ms" % (name, backend, elapsed * 1e3))
+
+        reference = results["python"]
+        for backend, result in results.items():
+            identical = all(np.array_equal(a, b) and a.dtype == b.dtype for a, b in zip(result, reference))
+            print("%-15s %-7s %s (%i inputs)" % (name, backend, "identical" if identical else "MISMATCH", len(result)))
+            ok &= identical
+
+    if not HAVE_NUMBA:
+        print("Numba not installed, only the NumPy kernels were checked")
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that all kernel backends give identical results")
+    parser.add_argument('-i', '--input-file', default=os.path.join(os.path.dirname(__file__), "..", "samples", "mavic_air_2"), help="Capture to take frames from")
+    parser.add_argument('-s', '--sample-rate', type=float, help="Sample rate of the capture (default: from the sidecar, else 50e6)")
+    parser.add_argument('-n', '--frames', type=int, default=4, help="Number of frames")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Timing runs per kernel")
+    args = parser.parse_args()
+
+    print("Kernel backend: %s" % BACKEND)
+    if not check(args.input_file, args.sample_rate, args.frames, args.repeat):
+        raise SystemExit(1)
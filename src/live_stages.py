@@ -0,0 +1,149 @@
+import os
+import time
+import logging
+import signal
+import cProfile
+import numpy as np
+import frametrace
+import SpectrumCapture as SC
+from packetizer import find_bursts, StreamingDetector, detection_params
+from Packet import Packet, ZCNotFoundError
+from qpsk import Decoder
+from droneid_packet import DroneIDPacket
+
+logger = logging.getLogger(__name__)
+
+# CPU-heavy stages of the live receiver. They run in worker processes, so
+# they only take and return picklable data and keep no state between calls,
+# except the detector of a continuous stream (see detect_stream).
+
+# (profiler, stats file) of this worker with --profile
+_profile = None
+# StreamingDetector of this worker with continuous streaming, lives as long as the worker
+_detector = None
+
+
+def init_worker(profile=None):
+    """Ctrl+C reaches the whole process group, only the main process handles it.
+
+    With profile, every stage run in this worker is profiled, the stats go
+    to <profile>.<pid> (workers are killed without a chance to clean up, so
+    they are rewritten after each stage)."""
+    global _profile
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if profile:
+        _profile = (cProfile.Profile(), "%s.%i" % (profile, os.getpid()))
+
+def run_stage(kind, trace, fn, *args):
+    """Run a stage, returns its result, its run time in the worker [s] and its trace record (None unless trace)"""
+    if _profile is not None:
+        _profile[0].enable()
+    start = time.perf_counter()
+    try:
+        with frametrace.frame(trace, kind=kind) as trace_record:
+            result = fn(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+        if _profile is not None:
+            _profile[0].disable()
+            _profile[0].dump_stats(_profile[1])
+    return result, elapsed, trace_record
+
+def detect_dwell(samples, Fs, packet_types=("droneid", ), debug=False, params=None):
+    """Find candidate frames of all packet_types in a dwell, detector pool.
+
+    Returns small candidate records: a dict per frame with its first sample
+    in the dwell, its length, the estimated cfo, its type (see
+    packetizer.find_bursts) and the raw frame samples, so only the frames
+    and not the dwell go to the demod workers. params overrides the
+    detection parameters (packetizer.DETECTION_PARAMS)."""
+    params = detection_params(params)
+    chunk_samples = int(params["chunk"] * Fs)
+    candidates = []
+
+    for i in range(0, len(samples), chunk_samples):
+        bursts = find_bursts(samples[i:i+chunk_samples], Fs, packet_types, debug, params)
+        logger.debug("Found %i RF frames in spectrum capture.", len(bursts))
+
+        for candidate in bursts:
+            candidate["start"] += i
+            candidates.append(candidate)
+
+    return candidates
+
+def detect_stream(block, Fs, packet_types=("droneid", ), params=None, reset=False, final=False):
+    """Push the next samples of a continuous stream to the detector of this worker, detector pool.
+
+    Returns the candidates (see detect_dwell) complete with block, their
+    first sample counts from the start of the stream. The detector keeps
+    its noise floor and open bursts between calls: reset starts a new
+    stream (after a retune), final also returns the bursts still waiting
+    for samples after their end. A stream must go to a pool of a single
+    worker, so all its blocks reach the same detector in order."""
+    global _detector
+    params = detection_params(params)
+    if _detector is None or (_detector.Fs, _detector.packet_types, _detector.params) != (Fs, packet_types, params):
+        _detector = StreamingDetector(Fs, packet_types, params=params)
+    elif reset:
+        _detector.reset()
+
+    candidates = _detector.push(block) if len(block) else []
+    if final:
+        candidates += _detector.flush()
+    return candidates
+
+def demod_frame(frame, Fs, packet_type="droneid", legacy=False, debug=False):
+    """Demodulate and decode a candidate frame, demod pool.
+
+    Returns the DUML payloads tried and None, or None and the reason why the
+    frame could not be demodulated ("cfo", "zc" or "demod") or decoded
+    ("decode", frame types without a known payload layout such as c2)."""
+    capture = SC.SpectrumCapture(raw_data=frame, skip_detection=True, Fs=Fs, debug=debug, p_type=packet_type, legacy=legacy)
+
+    # get a Drone ID frame, resampled and with coarse center frequency correction.
+    packet_data = capture.get_packet_samples(pktnum=0, debug=debug)
+    if isinstance(packet_data, Exception):
+        frametrace.record(error=str(packet_data))
+        return None, "cfo"
+
+    try:
+        packet = Packet(packet_data, debug=debug, legacy=legacy, packet_type=packet_type)
+    except ZCNotFoundError as error:
+        frametrace.record(error=str(error))
+        return None, "zc"
+    except Exception as error:
+        logger.debug("Could not decode packet: %s", error)
+        frametrace.record(error=str(error))
+        return None, "demod"
+
+    if not packet.plan.decodable:
+        frametrace.record(error="no decoder for %s frames" % packet.plan.name)
+        return None, "decode"
+
+    # perform RF corrections, OFDM and stuff
+    return decode_symbols(packet.get_symbol_data(skip_zc=True, equalized=True), packet.plan), None
+
+def decode_symbols(symbols, plan=None):
+    """Brute force the QPSK alignment, returns the DUML payloads tried.
+
+    Stops at the first payload with a valid CRC, like the receivers do."""
+    decoder = Decoder(symbols, plan)
+    payloads = []
+
+    for phase_corr in range(4):
+        decoder.raw_data_to_symbol_bits(phase_corr)
+        droneid_duml = decoder.magic()
+        if not droneid_duml:
+            # decoding failed
+            continue
+        payloads.append(droneid_duml)
+
+        try:
+            crc_ok = DroneIDPacket(droneid_duml).check_crc()
+        except:
+            continue
+        frametrace.record(qpsk_rotation=phase_corr, crc_ok=crc_ok)
+        if crc_ok:
+            break
+
+    return payloads
@@ -0,0 +1,144 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the latency histogram buckets [s]
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+class Metrics:
+    """Counters, gauges and histograms of the live receiver
+
+    Only the main process updates metrics: worker processes return their
+    measurements with their results and the pipeline records them here, so
+    the numbers cover all workers. Updates and reads are locked, the HTTP
+    server reads from its own thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> {"type", "help", "buckets", "values": {labels: value}}
+        self.metrics = {}
+
+    def _add(self, name, mtype, help_text, buckets=None, values=None):
+        self.metrics[name] = {"type": mtype, "help": help_text, "buckets": buckets, "values": values or {}, "fn": None}
+
+    def counter(self, name, help_text, labelled=False):
+        # counters without labels start at 0, so they are exported before the first event
+        self._add(name, "counter", help_text, values=None if labelled else {(): 0})
+
+    def gauge(self, name, help_text):
+        self._add(name, "gauge", help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._add(name, "histogram", help_text, sorted(buckets))
+
+    def computed(self, name, fn):
+        """Take the value of gauge name from fn() whenever metrics are read (fn returns None: unchanged)"""
+        self.metrics[name]["fn"] = fn
+
+    def _compute(self, names):
+        # outside of the lock, fn may read other metrics
+        for name in names:
+            fn = self.metrics[name]["fn"]
+            value = fn() if fn is not None else None
+            if value is not None:
+                self.set(name, value)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.metrics[name]["values"]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.metrics[name]["values"][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            metric = self.metrics[name]
+            if key not in metric["values"]:
+                metric["values"][key] = {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0}
+            hist = metric["values"][key]
+            for i, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def value(self, name, **labels):
+        """Current value of a counter or gauge, summed over all label sets that match labels"""
+        self._compute([name])
+        labels = set(labels.items())
+        with self.lock:
+            return sum(v for key, v in self.metrics[name]["values"].items() if labels <= set(key))
+
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        def fmt_labels(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+        self._compute(list(self.metrics))
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append("# HELP %s %s" % (name, metric["help"]))
+                lines.append("# TYPE %s %s" % (name, metric["type"]))
+                for key, value in metric["values"].items():
+                    if metric["type"] != "histogram":
+                        lines.append("%s%s %s" % (name, fmt_labels(key), value))
+                        continue
+                    for bound, count in zip(metric["buckets"], value["buckets"]):
+                        lines.append("%s_bucket%s %i" % (name, fmt_labels(key, [("le", bound)]), count))
+                    lines.append("%s_bucket%s %i" % (name, fmt_labels(key, [("le", "+Inf")]), value["count"]))
+                    lines.append("%s_sum%s %f" % (name, fmt_labels(key), value["sum"]))
+                    lines.append("%s_count%s %i" % (name, fmt_labels(key), value["count"]))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        """All metrics, label sets as dicts"""
+        self._compute(list(self.metrics))
+        result = {}
+        with self.lock:
+            for name, metric in self.metrics.items():
+                values = []
+                for key, value in metric["values"].items():
+                    if metric["type"] == "histogram":
+                        value = dict(value, le=metric["buckets"])
+                    values.append({"labels": dict(key), "value": value})
+                result[name] = {"type": metric["type"], "help": metric["help"], "values": values}
+        return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.metrics.prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.metrics.as_dict(), indent=2).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(metrics, port, host="127.0.0.1"):
+    """Serve /metrics (Prometheus text) and /metrics.json from a daemon thread, returns the server"""
+    handler = type("MetricsHandler", (_Handler,), {"metrics": metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
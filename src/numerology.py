@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import numpy as np
+import fftbackend
+from goldgen import gold
+from kernels import rm_turbo_rx
+from equalizer import zc_reference
+from helpers import NFFT, NCARRIERS, CP_LENGTHS, CP_LENGTHS_legacy, ZC_SYMBOL_IDX, ZC_SYMBOL_IDX_legacy
+
+SCRAMBLER_SEED = 0x12345678
+
+
+@functools.lru_cache(maxsize=None)
+def scrambling_sequence(length, offset=1600, seed=SCRAMBLER_SEED):
+    """Gold sequence of the descrambler (read-only, shared between frames)"""
+    seq = gold(offset, length, seed)
+    seq.flags.writeable = False
+    return seq
+
+
+class Numerology:
+    """Everything about a frame type that does not depend on the received samples
+
+    Symbol positions, FFT size and carrier mapping for the OFDM stages of
+    Packet, the ZC reference sequences for sync and channel estimation, and
+    the bit layout and de-rate-matching table for Decoder. Plans are built
+    once per process (see get_plan), the more expensive tables on first use.
+    """
+    def __init__(self, name, sample_rate, nfft, ncarriers, cp_lengths, zc_symbol_idx, zc_roots=None,
+                 known_symbols=0, rm_offset=None, rm_length=None):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.nfft = nfft
+        self.ncarriers = ncarriers
+        self.cp_lengths = cp_lengths
+        self.zc_symbol_idx = zc_symbol_idx
+        # expected ZC roots (coarse sync, fine sync), None if unknown and taken from the frame
+        self.zc_roots = zc_roots
+
+        self.nsymbols = len(cp_lengths)
+        self.symbol_lengths = nfft + np.array(cp_lengths)
+        self.frame_length = int(np.sum(self.symbol_lengths))
+        # first and last (exclusive) sample of every symbol including its CP, and of its FFT window
+        self.symbol_ends = np.cumsum(self.symbol_lengths)
+        self.symbol_starts = self.symbol_ends - self.symbol_lengths
+        self.fft_starts = self.symbol_ends - nfft
+        # sample index of every FFT input, shape (nsymbols, nfft)
+        self.fft_index = self.fft_starts[:, None] + np.arange(nfft)
+
+        # FFT bins of the used carriers, lowest carrier first and DC in the middle
+        self.dc = ncarriers//2
+        self.carriers = np.r_[nfft-self.dc:nfft, 0:self.dc+1]
+        # carrier number of every used carrier, DC is 0
+        self.carrier_index = np.arange(-self.dc, self.dc+1)
+
+        # distance between CP correlation peaks in find_fine_start (one symbol is a bit longer)
+        self.peak_distance = nfft * 1000 // 1024
+
+        # decoder: symbols carrying data, the first known_symbols of them only the scrambling sequence
+        self.data_symbol_idx = [i for i in range(self.nsymbols) if i not in zc_symbol_idx]
+        self.known_symbols = known_symbols
+        self.bits_per_symbol = 2 * (ncarriers - 1)
+        # None if the frames can be demodulated but not decoded
+        self.rm_offset = rm_offset
+        self.rm_length = rm_length
+        self.decodable = rm_length is not None
+
+    def __repr__(self):
+        return "Numerology(%s, %.2f MHz, NFFT %i, %i carriers, %i symbols)" % (
+            self.name, self.sample_rate / 1e6, self.nfft, self.ncarriers, self.nsymbols)
+
+    def tfft(self, symbols_t):
+        """FFT of time domain symbols (..., nfft) to the used carriers (..., ncarriers)"""
+        return fftbackend.fft(symbols_t, n=self.nfft, axis=-1)[..., self.carriers]
+
+    def itfft(self, symbol_f):
+        """Used carriers back to a time domain symbol without CP"""
+        full = np.zeros(self.nfft, dtype=np.complex64)
+        full[self.carriers] = symbol_f
+        return fftbackend.ifft(full)
+
+    def symbols_f(self, samples):
+        """FFT all symbols of a frame starting at samples[0] at once, shape (nsymbols, ncarriers)
+
+        Like the FFT of each symbol on its own, missing samples at the end are zero."""
+        if len(samples) < self.frame_length:
+            samples = np.concatenate((samples, np.zeros(self.frame_length - len(samples), dtype=samples.dtype)))
+        return self.tfft(samples[self.fft_index])
+
+    def symbols_t(self, samples):
+        """Time domain symbols of a frame starting at samples[0], including their CP"""
+        return [samples[start:end] for start, end in zip(self.symbol_starts, self.symbol_ends)]
+
+    def zc_reference(self, root):
+        """ZC sequence of root as mapped onto the carriers"""
+        return zc_reference(root, self.ncarriers)
+
+    @functools.cached_property
+    def zc_spectra(self):
+        """Conjugated spectra of the ZC sequences of all roots, to correlate with all of them at once
+
+        Row r-1 is root r, zero-padded to 2 * ncarriers so the circular
+        correlation equals the linear one for non-negative lags."""
+        roots = np.arange(1, self.ncarriers)
+        n = np.arange(self.ncarriers)
+        sequences = np.exp(-1j * np.pi * roots[:, None] * n * (n+1) / self.ncarriers)
+        return np.conj(fftbackend.fft(sequences, n=2*self.ncarriers, axis=-1))
+
+    def zc_correlation(self, symbol_f):
+        """Peak correlation of symbol_f with the ZC sequence of every root (index root-1)"""
+        spectrum = fftbackend.fft(symbol_f, n=2*self.ncarriers)
+        correlation = fftbackend.ifft(self.zc_spectra * spectrum, axis=-1)[:, :self.ncarriers]
+        return np.max(np.abs(correlation), axis=-1)
+
+    @functools.cached_property
+    def rm_table(self):
+        """Position of every payload bit in the descrambled circular buffer (before wrapping)"""
+        return self.rm_offset + rm_turbo_rx(np.arange(self.rm_length))
+
+    def data_bits(self, sym_bits):
+        """QPSK symbol values (0..3) of the data symbols to bits, DC carrier dropped"""
+        bits = np.delete(np.asarray(sym_bits), self.dc, axis=-1)
+        bits = np.repeat(bits, 2, axis=-1) & np.tile([1, 2], self.ncarriers - 1)
+        return bits > 0
+
+
+PLANS = {
+    "droneid": Numerology("droneid", 15.36e6, NFFT, NCARRIERS, CP_LENGTHS, ZC_SYMBOL_IDX, (600, 147),
+                          known_symbols=1, rm_offset=4148, rm_length=1412),
+    # older drones (e.g. Mavic Pro), symbol 0 is missing
+    "legacy": Numerology("legacy", 15.36e6, NFFT, NCARRIERS, CP_LENGTHS_legacy, ZC_SYMBOL_IDX_legacy, (600, 147),
+                         rm_offset=4148, rm_length=1412),
+    # LTE 1.4 MHz numerology: 7 symbols of 128 + 9/10 samples CP fill the 500 us of a c2 burst,
+    # ZC roots and payload layout are unknown, so demodulation only
+    "c2": Numerology("c2", 1.92e6, 128, 73, [10, 9, 9, 9, 9, 9, 10], [0, 6]),
+}
+# video frames are detected (packetizer) but their numerology is not known
+
+# frame types sharing the numerology of another one
+PLAN_ALIASES = {"beacon": "droneid"}
+
+def get_plan(packet_type="droneid", legacy=False):
+    """Numerology of a frame type, legacy selects the legacy Drone-ID layout"""
+    packet_type = PLAN_ALIASES.get(packet_type, packet_type)
+    if legacy and packet_type == "droneid":
+        packet_type = "legacy"
+    if packet_type not in PLANS:
+        raise ValueError("No numerology for %s frames, known: %s" % (packet_type, ", ".join(PLANS)))
+    return PLANS[packet_type]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('plans', nargs="*", default=list(PLANS), help="Plans to show (default: all)")
+    args = parser.parse_args()
+    unknown = [name for name in args.plans if PLAN_ALIASES.get(name, name) not in PLANS]
+    if unknown:
+        parser.error("no numerology for %s, known: %s" % (", ".join(unknown), ", ".join(PLANS)))
+
+    for name in args.plans:
+        plan = get_plan(name)
+        print(plan)
+        print("  CP lengths        ", plan.cp_lengths)
+        print("  symbol starts     ", list(plan.symbol_starts), "frame length", plan.frame_length)
+        print("  ZC symbols, roots ", plan.zc_symbol_idx, plan.zc_roots)
+        print("  data symbols      ", plan.data_symbol_idx, "known", plan.known_symbols, "bits/symbol", plan.bits_per_symbol)
+        print("  rate matching     ", "offset %i, %i bits" % (plan.rm_offset, plan.rm_length) if plan.decodable else "unknown, not decodable")
@@ -1,99 +1,391 @@
 #!/usr/bin/env python3
 
+import json
+import logging
 import argparse
 import numpy as np
 import scipy.signal as signal
-import matplotlib.pyplot as plt
-from helpers import estimate_offset
-
-def find_packet_candidate_time(raw_data, Fs, debug=False, packet_type = "droneid", legacy = False):
-    """Find packets with the right length by looking at signal power"""
-    # for Mavic 2: around 576e-6 => symbol 0 missing
-    # 8 * 72e-7
-
-    if packet_type == "droneid": 
-        if legacy:
-            min_packet_len_t = 565e-6
-            max_packet_len_t = 600e-6
-        else:
-            min_packet_len_t = 630e-6
-            max_packet_len_t = 665e-6
-    elif packet_type == "c2":
-        min_packet_len_t = 500e-6
-        max_packet_len_t = 520e-6
-    elif packet_type == "beacon":
-        min_packet_len_t = 490e-6
-        max_packet_len_t = 540e-6
-    elif packet_type == "pairing":
-        min_packet_len_t = 490e-6
-        max_packet_len_t = 540e-6
-    elif packet_type == "video":
-        min_packet_len_t = 630e-6
-        max_packet_len_t = 665e-6
-
-
-    print("Packet Type:",packet_type)
-
-    start_offset = 3*15e-6
-    end_offset = 3*15e-6
-
-    f, t, Zxx = signal.stft(raw_data, Fs, nfft=64, nperseg=64)
-    res_abs = np.max(np.abs(Zxx), axis=0)
-    noise_floor = np.mean(np.abs(Zxx))
+import frametrace
+import fftbackend
+from helpers import occupied_bands, band_offset
+from capture_file import CaptureFile, CAPTURE_FORMATS
+from eventlog import add_log_arguments, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# burst duration [s] per packet type, the bandwidths are in helpers.PACKET_BANDWIDTHS
+# for Mavic 2: around 576e-6 => symbol 0 missing
+# 8 * 72e-7
+PACKET_DURATIONS = {
+    "droneid": (630e-6, 665e-6),
+    "legacy": (565e-6, 600e-6),  # Drone-ID of legacy drones (Mavic Pro, Mavic 2)
+    "c2": (500e-6, 520e-6),
+    "beacon": (490e-6, 540e-6),
+    "pairing": (490e-6, 540e-6),
+    "video": (630e-6, 665e-6),
+}
+PACKET_TYPES = list(PACKET_DURATIONS)
+
+# STFT bins above this times the noise floor belong to a burst
+NOISE_THRESHOLD = 1.15
+# samples kept before and after the detected burst [s]
+START_OFFSET = 3*15e-6
+END_OFFSET = 3*15e-6
+# STFT of the detection (scipy.signal.stft defaults: Hann window, half overlap)
+STFT_NPERSEG = 64
+# STFT segments transformed at once, only their peak and mean magnitude are kept
+STFT_TILE = 4096
+# time constant of the noise floor of StreamingDetector [s], also how long it learns the floor at first
+NOISE_TIME_CONSTANT = 0.1
+# samples per find_bursts call in the receivers [s]
+CHUNK_TIME = 500e-3
+
+# everything detection depends on; a tuning profile (see autotune.py) overrides any of them
+DETECTION_PARAMS = {
+    "threshold": NOISE_THRESHOLD,
+    "nperseg": STFT_NPERSEG,
+    "start_offset": START_OFFSET,
+    "end_offset": END_OFFSET,
+    # PACKET_DURATIONS widened by this share on both ends
+    "length_margin": 0.0,
+    "chunk": CHUNK_TIME,
+}
+
+def detection_params(tuning=None):
+    """DETECTION_PARAMS, with the values in tuning instead"""
+    params = dict(DETECTION_PARAMS)
+    if tuning:
+        unknown = [name for name in tuning if name not in DETECTION_PARAMS]
+        if unknown:
+            raise ValueError("Unknown detection parameters %s, known: %s" % (", ".join(unknown), ", ".join(DETECTION_PARAMS)))
+        params.update(tuning)
+    return params
+
+def load_tuning(filename):
+    """Detection parameters of a tuning profile written by autotune.py"""
+    with open(filename) as f:
+        profile = json.load(f)
+    logger.info("Tuning profile %s: site %s, radio %s", filename, profile.get("site"), profile.get("radio"))
+    return detection_params(profile["detection"])
+
+def packet_types(text):
+    """Comma separated packet types (argparse type)"""
+    types = [t.strip() for t in text.split(",") if t.strip()]
+    unknown = [t for t in types if t not in PACKET_DURATIONS]
+    if unknown or not types:
+        raise argparse.ArgumentTypeError("unknown packet type %s, known: %s" % (", ".join(unknown), ", ".join(PACKET_TYPES)))
+    return types
+
+def burst_lengths(packet_types, dt, margin=0.0):
+    """(min, max) burst length in STFT segments of dt seconds, per packet type, durations widened by margin"""
+    return {p_type: (int(PACKET_DURATIONS[p_type][0]*(1-margin)/dt), int(PACKET_DURATIONS[p_type][1]*(1+margin)/dt)) for p_type in packet_types}
+
+def stft_window(nperseg):
+    """Hann window scaled like scipy.signal.stft, float32"""
+    window = signal.get_window("hann", nperseg)
+    return (window / window.sum()).astype(np.float32)
+
+def segment_levels(segments, window):
+    """Peak and mean magnitude of the spectrum of every segment (rows), float32"""
+    spectra = np.abs(fftbackend.fft(segments * window, single=True))
+    return np.max(spectra, axis=1), np.mean(spectra, axis=1)
+
+def stft_levels(raw_data, nperseg=STFT_NPERSEG, tile=STFT_TILE):
+    """Peak and mean magnitude per segment of scipy.signal.stft(raw_data, nperseg=nperseg)
+
+    Same segments as scipy.signal.stft with its defaults (Hann window, half
+    overlap, nperseg/2 zeros before and after, zeros up to the last full
+    segment, two-sided), in float32 and tile segments at a time: the
+    spectrogram, eight times the size of complex64 raw_data, never exists
+    as a whole."""
+    hop = nperseg - nperseg // 2
+    pad = nperseg // 2
+    window = stft_window(nperseg)
+    nseg = -(-max(len(raw_data) + 2 * pad - nperseg, 0) // hop) + 1
+
+    level = np.empty(nseg, dtype=np.float32)
+    mean = np.empty(nseg, dtype=np.float32)
+    for first in range(0, nseg, tile):
+        last = min(first + tile, nseg)
+        # segment k starts at sample k*hop - pad of raw_data, zeros outside of it
+        start = first * hop - pad
+        stop = (last - 1) * hop - pad + nperseg
+        buffer = np.zeros(stop - start, dtype=np.complex64)
+        buffer[max(-start, 0):min(len(raw_data), stop) - start] = raw_data[max(start, 0):stop]
+        segments = np.lib.stride_tricks.sliding_window_view(buffer, nperseg)[::hop]
+        level[first:last], mean[first:last] = segment_levels(segments, window)
+    return level, mean
+
+def classify_burst(packet_data, first_sample, Fs, width, length_samples):
+    """Burst record (see find_bursts) if packet_data is width STFT segments long and its band matches
+    any of the packet types (keys of length_samples), otherwise None"""
+    # estimate center frequency offset once, then check the bandwidth of every type with the right duration
+    with frametrace.span("candidate_cfo"):
+        bands = occupied_bands(packet_data, Fs)
+
+    types = []
+    center_freq_offset = None
+    for p_type, (min_width, max_width) in length_samples.items():
+        if not min_width <= width <= max_width:
+            continue
+        offset = band_offset(bands, p_type)
+        if offset is not None:
+            types.append(p_type)
+            center_freq_offset = offset if center_freq_offset is None else center_freq_offset
+
+    if not types:
+        return None
+    return {"start": first_sample, "length": len(packet_data), "cfo": center_freq_offset, "type": types[0], "types": types, "samples": packet_data}
+
+def find_bursts(raw_data, Fs, packet_types=PACKET_TYPES, debug=False, params=None):
+    """Find bursts of all packet_types in one pass over the signal power
+
+    Every burst is classified by its duration (PACKET_DURATIONS) and its
+    occupied bandwidth (helpers.PACKET_BANDWIDTHS). Returns a dict per burst
+    with its first sample in raw_data, its length in samples, the estimated
+    cfo, the samples, its type and all types it matches (in the order of
+    packet_types, e.g. beacon and pairing bursts look the same).
+    params overrides DETECTION_PARAMS."""
+    logger.debug("Packet Types: %s", ", ".join(packet_types))
+    params = detection_params(params)
+    nperseg = params["nperseg"]
+
+    with frametrace.span("stft"):
+        res_abs, res_mean = stft_levels(raw_data, nperseg)
+        noise_floor = np.mean(res_mean, dtype=np.float64)
 
 
     # get things above the noise floor
-    above_level = res_abs > 1.15*noise_floor
+    above_level = res_abs > params["threshold"]*noise_floor
 
-    # search for chunks above noise floor that fit the packet length
-    signal_length_min_samples = int(min_packet_len_t/(t[1]-t[0])) # packet duration to samples
-    signal_length_max_samples = int(max_packet_len_t/(t[1]-t[0])) # packet duration to samples
-    peaks, properties = signal.find_peaks(above_level, width=[signal_length_min_samples, signal_length_max_samples],wlen=100*signal_length_max_samples)
+    # packet duration to samples, per type and for all types together
+    dt = (nperseg - nperseg // 2) / Fs
+    t = np.arange(len(res_abs)) * dt
+    length_samples = burst_lengths(packet_types, dt, params["length_margin"])
+    signal_length_min_samples = min(lengths[0] for lengths in length_samples.values())
+    signal_length_max_samples = max(lengths[1] for lengths in length_samples.values())
 
-        
-    packets = []
-    center_freq_offset = 0
-    start = 0
-    end = 0
-    length = 0
+    # search for chunks above noise floor that fit any packet length
+    peaks, properties = signal.find_peaks(above_level, width=[signal_length_min_samples, signal_length_max_samples],wlen=100*signal_length_max_samples)
 
+    bursts = []
     for i, _ in enumerate(peaks):
-        start = properties["left_bases"][i] * (t[1]-t[0]) # samples to time
-        end = properties["right_bases"][i] * (t[1]-t[0])
-        length =  properties["widths"][i] * (t[1]-t[0])
-
-        packet_data = raw_data[int((start-start_offset)*Fs):int((end+end_offset)*Fs)]
+        start = properties["left_bases"][i] * dt # samples to time
+        end = properties["right_bases"][i] * dt
+        width = properties["widths"][i]
+        length = width * dt
 
-        # estimate center frequency offset (only successful if packet is 10 MHz)
-        center_freq_offset, found = estimate_offset(packet_data, Fs)
+        first_sample = max(int((start-params["start_offset"])*Fs), 0)
+        packet_data = raw_data[first_sample:int((end+params["end_offset"])*Fs)]
 
-        if not found:
-            if debug:
-                print("Packet #%i, start %f, end %f, length %f, cfo MISMATCH" % (i, start, end, length))
+        burst = classify_burst(packet_data, first_sample, Fs, width, length_samples)
+        if burst is None:
+            logger.debug("Packet #%i, start %f, end %f, length %f, cfo MISMATCH", i, start, end, length)
             continue
 
-        print(center_freq_offset)
-        print("Packet #%i, start %f, end %f, length %f, cfo %f" % (i, start, end, length, center_freq_offset))
-        packets.append(packet_data)
+        logger.debug("Packet #%i, start %f, end %f, length %f, cfo %f, type %s", i, start, end, length, burst["cfo"], "/".join(burst["types"]))
+        bursts.append(burst)
 
     if debug:
-        print("legacy")
-
+        import matplotlib.pyplot as plt
         plt.plot(t, above_level)
         plt.scatter(t[peaks], abs(above_level[peaks]), marker="x", color="C5")
         plt.show()
 
+    return bursts
+
+def find_packet_candidate_time(raw_data, Fs, debug=False, packet_type = "droneid", legacy = False, return_info = False, params = None):
+    """Find packets of one type with the right length by looking at signal power
+
+    With return_info, additionally returns a dict per packet with its first
+    sample in raw_data, its length in samples and the estimated cfo.
+    To look for several types, use find_bursts."""
+    if legacy and packet_type == "droneid":
+        packet_type = "legacy"
+
+    packets = []
+    info = []
+    for burst in find_bursts(raw_data, Fs, (packet_type, ), debug, params):
+        packets.append(burst.pop("samples"))
+        info.append(burst)
+
+    center_freq_offset = info[-1]["cfo"] if info else 0
+    if return_info:
+        return packets, center_freq_offset, info
     return packets, center_freq_offset
 
+class StreamingDetector:
+    """Find bursts block by block, each as soon as it ended
+
+    find_bursts only returns after a whole chunk and takes the noise floor
+    of that chunk. This detector takes blocks of any size (e.g. 1 ms),
+    keeps the STFT overlap and an exponentially averaged noise floor
+    between them, and returns every burst (see find_bursts) with the block
+    that holds its end plus END_OFFSET. Burst starts count samples since
+    the first block.
+
+    The first noise_time_constant seconds are held back until their mean
+    is known as the first noise floor, exactly like find_bursts on a chunk
+    of that length; only later bursts come with low latency. params
+    overrides DETECTION_PARAMS (the chunk is not used).
+    """
+    def __init__(self, Fs, packet_types=PACKET_TYPES, noise_time_constant=NOISE_TIME_CONSTANT, params=None):
+        self.Fs = Fs
+        self.packet_types = packet_types
+        self.params = detection_params(params)
+        self.nperseg = self.params["nperseg"]
+        self.hop = self.nperseg - self.nperseg // 2
+        # scaled like scipy.signal.stft, so noise_floor matches find_bursts
+        self.window = stft_window(self.nperseg)
+        self.dt = self.hop / Fs
+        self.length_samples = burst_lengths(packet_types, self.dt, self.params["length_margin"])
+        self.min_width = min(lengths[0] for lengths in self.length_samples.values())
+        self.max_width = max(lengths[1] for lengths in self.length_samples.values())
+        # weight of a new STFT segment in the noise floor
+        self.alpha = min(self.hop / (Fs * noise_time_constant), 1.0)
+        self.warmup_segments = int(noise_time_constant / self.dt)
+        self.reset()
+
+    def reset(self):
+        """Start over without samples and noise floor, e.g. after a retune"""
+        # samples not in a full STFT segment yet, at first the zero padding of scipy.signal.stft
+        self.tail = np.zeros(self.nperseg // 2, dtype=np.complex64)
+        # STFT segments so far, segment k is centered on sample k*hop
+        self.segments = 0
+        self.samples = 0
+        self.noise_floor = None
+        # (peak, mean) magnitudes of the STFT segments before the first noise floor
+        self.warmup = []
+        # first segment above the noise floor of the current burst, None between bursts
+        self.burst_start = None
+        # (first sample, end sample, width) of bursts that ended, waiting for their last samples
+        self.pending = []
+        # samples from history_start on, as far as they may belong to a burst
+        self.history = np.zeros(0, dtype=np.complex64)
+        self.history_start = 0
+
+    def first_sample(self, segment):
+        """First sample of a burst starting at segment, like find_bursts (left base one segment earlier)"""
+        return max(int(((segment - 1) * self.dt - self.params["start_offset"]) * self.Fs), 0)
+
+    def push(self, block):
+        """Add the next block of samples, returns the bursts complete with it"""
+        self.history = np.concatenate((self.history, block))
+        self.samples += len(block)
+
+        buffer = np.concatenate((self.tail, block))
+        nseg = max((len(buffer) - self.nperseg) // self.hop + 1, 0)
+        if nseg:
+            with frametrace.span("stft"):
+                segments = np.lib.stride_tricks.sliding_window_view(buffer, self.nperseg)[::self.hop][:nseg]
+                level, mean = segment_levels(segments, self.window)
+            self._edges(level, mean)
+        self.tail = buffer[nseg * self.hop:]
+
+        return self._complete()
+
+    def flush(self):
+        """End of the stream, returns the bursts still waiting for samples after their end"""
+        if self.warmup:
+            self._end_warmup()
+        return self._complete(final=True)
+
+    def _edges(self, level, mean):
+        """Track the noise floor over the next STFT segments (peak and mean magnitude of each)"""
+        if self.noise_floor is None:
+            self.warmup.append((level, mean))
+            if sum(len(warmup_level) for warmup_level, _ in self.warmup) >= self.warmup_segments:
+                self._end_warmup()
+            return
+
+        # exponential average over segments, as a filter to keep it vectorized
+        floor, _ = signal.lfilter([self.alpha], [1, self.alpha - 1], mean, zi=[(1 - self.alpha) * self.noise_floor])
+        self.noise_floor = floor[-1]
+        self._threshold(level, floor)
+
+    def _end_warmup(self):
+        level = np.concatenate([warmup_level for warmup_level, _ in self.warmup])
+        mean = np.concatenate([warmup_mean for _, warmup_mean in self.warmup])
+        self.warmup = []
+        self.noise_floor = np.mean(mean, dtype=np.float64)
+        self._threshold(level, self.noise_floor)
+
+    def _threshold(self, level, floor):
+        """Find burst edges in the next STFT segments"""
+        above = level > self.params["threshold"] * floor
+
+        was_above = self.burst_start is not None
+        for i in np.flatnonzero(np.diff(np.r_[was_above, above].astype(np.int8))):
+            segment = self.segments + i
+            if above[i]:
+                self.burst_start = segment
+                continue
+
+            # trailing edge, same width and bases as find_peaks on find_bursts' above_level
+            width = segment - self.burst_start
+            if self.min_width <= width <= self.max_width:
+                end_sample = int((segment * self.dt + self.params["end_offset"]) * self.Fs)
+                self.pending.append((self.first_sample(self.burst_start), end_sample, width))
+            self.burst_start = None
+        self.segments += len(level)
+
+    def _complete(self, final=False):
+        bursts = []
+        waiting = []
+        for first, end, width in self.pending:
+            if end > self.samples and not final:
+                waiting.append((first, end, width))
+                continue
+            packet_data = self.history[first - self.history_start:end - self.history_start]
+            burst = classify_burst(packet_data, first, self.Fs, width, self.length_samples)
+            if burst is not None:
+                logger.debug("Burst at sample %i, length %i, cfo %f, type %s", first, len(packet_data), burst["cfo"], "/".join(burst["types"]))
+                bursts.append(burst)
+        self.pending = waiting
+
+        # drop samples no burst can start in
+        start = self.segments
+        if self.burst_start is not None and self.segments - self.burst_start <= self.max_width:
+            start = self.burst_start
+        keep = min([first for first, _, _ in self.pending] + [self.first_sample(start)])
+        if keep > self.history_start:
+            self.history = self.history[keep - self.history_start:]
+            self.history_start = keep
+
+        return bursts
+
 def main(args):
-    data = np.fromfile(args.input_file, dtype="<f").astype(np.float32).view(np.complex64)
-    find_packet_candidate_time(data, args.sample_rate, args.debug)
+    setup_logging("debug" if args.debug else args.log_level)
+    capture_file = CaptureFile(args.input_file, fmt=args.format, sample_rate=args.sample_rate)
+    params = load_tuning(args.tuning) if args.tuning else detection_params()
+    chunk_start = 0
+    if args.block:
+        # block by block, like a live stream
+        detector = StreamingDetector(capture_file.sample_rate, args.packet_types, args.noise_time, params)
+        for data in capture_file.chunks(int(args.block * 1e-3 * capture_file.sample_rate)):
+            for burst in detector.push(data):
+                print("Packet at sample %i, length %i, cfo %f, type %s, detected %.2f ms after its end" % (burst["start"], burst["length"], burst["cfo"], "/".join(burst["types"]),
+                      (detector.samples - burst["start"] - burst["length"]) / capture_file.sample_rate * 1e3))
+        for burst in detector.flush():
+            print("Packet at sample %i, length %i, cfo %f, type %s" % (burst["start"], burst["length"], burst["cfo"], "/".join(burst["types"])))
+        return
+
+    for data in capture_file.chunks(int(params["chunk"] * capture_file.sample_rate)):
+        for burst in find_bursts(data, capture_file.sample_rate, args.packet_types, args.debug, params):
+            print("Packet at sample %i, length %i, cfo %f, type %s" % (chunk_start + burst["start"], burst["length"], burst["cfo"], "/".join(burst["types"])))
+        chunk_start += len(data)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input-file', help="Binary Sample Input")
-    parser.add_argument('-s', '--sample-rate', default="50e6", type=float, help="Sample Rate")
+    parser.add_argument('-s', '--sample-rate', default=None, type=float, help="Sample Rate (default: from capture metadata, or 50e6)")
+    parser.add_argument('-F', '--format', default=None, choices=list(CAPTURE_FORMATS), help="Sample format (default: from capture metadata, or fc32)")
+    parser.add_argument('-p', '--packet-types', default=PACKET_TYPES, type=packet_types, help="Packet types to look for, comma separated (default: all): " + ", ".join(PACKET_TYPES))
+    parser.add_argument('-b', '--block', default=None, type=float, help="Detect block by block with StreamingDetector, block length [ms]")
+    parser.add_argument('--noise-time', default=NOISE_TIME_CONSTANT, type=float, help="Noise floor time constant of --block [s] (default: %(default)s)")
+    parser.add_argument('--tuning', default=None, help="Tuning profile with the detection parameters (see autotune.py)")
     parser.add_argument('-d', '--debug', default=False, action="store_true", help="Enable debug output")
+    add_log_arguments(parser)
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
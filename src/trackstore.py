@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import argparse
+from datetime import datetime
+import numpy as np
+from droneid_packet import DRONEID_DTYPE, DRONEID_RECORD_LEN, read_packets, parse_packets
+
+MANIFEST = "manifest.jsonl"
+
+# index granularity
+GEO_BUCKET_DEG = 0.01
+
+# segments within one of these periods [ms] are merged by compact()
+COMPACT_PERIODS = {"hour": 3600 * 1000, "day": 24 * 3600 * 1000}
+
+
+class TrackStore:
+    """Append-only columnar store of parsed Drone-ID packets
+
+    Packets are buffered and written in segments, one .npy file per column
+    (memory-mapped on read). manifest.jsonl is a log with one line per
+    added (and removed) segment, holding its time range, bounding box,
+    serial numbers and lat-lon buckets; the indices are built from it on
+    read. Several processes may append to the same store; appends to the
+    log are serialized with a file lock.
+
+    Every flush adds a segment, compact() merges the segments of each past
+    hour or day into one and rewrites the log with the remaining segments
+    only, so both stay bounded. With compact, the store compacts itself
+    after the first flush of every new period.
+
+    The time column is the receive time in ms (or gps_time for imported
+    files), raw holds the undecoded payload.
+    """
+    def __init__(self, path, batch_size=1024, flush_interval=5.0, compact=None):
+        if compact is not None and compact not in COMPACT_PERIODS:
+            raise ValueError("Unknown compaction period %s" % compact)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_period = compact
+        self._raw = []
+        self._time = []
+        self._oldest = None
+        self._segments_written = 0
+        # period of the last automatic compaction
+        self._compacted = None
+        os.makedirs(os.path.join(path, "segments"), exist_ok=True)
+
+    def append(self, raw_bytes, timestamp=None):
+        """Buffer a payload, flushes when the batch is full or old enough"""
+        if len(raw_bytes) < DRONEID_DTYPE.itemsize:
+            return
+        now = time.time()
+        self._raw.append(bytes(raw_bytes[:DRONEID_RECORD_LEN]).ljust(DRONEID_RECORD_LEN, b"\0"))
+        self._time.append(now * 1000 if timestamp is None else timestamp)
+        if self._oldest is None:
+            self._oldest = now
+
+        if len(self._raw) >= self.batch_size or now - self._oldest > self.flush_interval:
+            self.flush()
+
+    def append_records(self, raw, timestamps):
+        """Write (N, DRONEID_RECORD_LEN) uint8 payloads as one segment, bypassing the buffer"""
+        self._write_segment(np.asarray(raw, dtype=np.uint8), np.asarray(timestamps, dtype=np.float64))
+
+    def flush(self):
+        if not self._raw:
+            return
+        raw = np.frombuffer(b"".join(self._raw), dtype=np.uint8).reshape(-1, DRONEID_RECORD_LEN)
+        self._write_segment(raw, np.array(self._time, dtype=np.float64))
+        self._raw = []
+        self._time = []
+        self._oldest = None
+
+        if self.compact_period is not None:
+            period = int(time.time() * 1000 // COMPACT_PERIODS[self.compact_period])
+            if period != self._compacted:
+                self._compacted = period
+                self.compact(self.compact_period)
+
+    def close(self):
+        self.flush()
+
+    def _write_segment(self, raw, timestamps):
+        records = raw[:, :DRONEID_DTYPE.itemsize].copy().view(DRONEID_DTYPE).reshape(-1)
+        columns = parse_packets(records)
+        columns["time"] = timestamps
+        columns["raw"] = raw
+
+        info = self._save_segment(columns)
+        with self._manifest_log() as log:
+            log.append({"add": info})
+
+    def _save_segment(self, columns):
+        """Write the columns as a new segment, returns its manifest entry"""
+        name = "%i-%i-%i" % (int(time.time() * 1000), os.getpid(), self._segments_written)
+        self._segments_written += 1
+        segment_dir = os.path.join(self.path, "segments", name)
+        os.makedirs(segment_dir)
+        for column, values in columns.items():
+            np.save(os.path.join(segment_dir, column + ".npy"), values)
+
+        timestamps = columns["time"]
+        lat, lon = columns["latitude"], columns["longitude"]
+        return {
+            "name": name,
+            "count": len(timestamps),
+            "time": [float(np.min(timestamps)), float(np.max(timestamps))],
+            "bbox": [float(np.min(lat)), float(np.min(lon)), float(np.max(lat)), float(np.max(lon))],
+            "serials": sorted(set(s.decode("utf-8", "replace").rstrip("\0") for s in columns["serial_number"])),
+            "geo": ["%i,%i" % tuple(b) for b in np.unique(np.floor(np.stack((lat, lon), axis=1) / GEO_BUCKET_DEG), axis=0)],
+        }
+
+    def compact(self, period="hour"):
+        """Merge the segments of every past hour or day into one, returns the number of segments merged.
+
+        Segments spanning two periods stay as they are. Only one process
+        compacts at a time, another one returns 0 right away."""
+        length = COMPACT_PERIODS[period]
+        current = time.time() * 1000 // length
+
+        lock = open(os.path.join(self.path, "compact.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return 0
+
+        merged = 0
+        try:
+            groups = {}
+            for info in self.manifest()["segments"]:
+                first, last = (t // length for t in info["time"])
+                if first == last and first < current:
+                    groups.setdefault(first, []).append(info)
+
+            for infos in groups.values():
+                if len(infos) < 2:
+                    continue
+                segments = [self._load_segment(info["name"]) for info in infos]
+                columns = {column: np.concatenate([segment[column] for segment in segments]) for column in segments[0]}
+                order = np.argsort(columns["time"], kind="stable")
+                info = self._save_segment({column: values[order] for column, values in columns.items()})
+                with self._manifest_log() as log:
+                    log.append({"add": info, "remove": [old["name"] for old in infos]})
+                for old in infos:
+                    shutil.rmtree(os.path.join(self.path, "segments", old["name"]))
+                merged += len(infos)
+
+            if merged:
+                # one line per remaining segment
+                with self._manifest_log() as log:
+                    log.rewrite([{"add": info} for info in replay(log.entries())])
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        return merged
+
+    def _manifest_log(self):
+        return _ManifestLog(os.path.join(self.path, MANIFEST))
+
+    def manifest(self):
+        """Segments and the serial number and lat-lon bucket indices pointing to them"""
+        manifest = {"segments": replay(_ManifestLog(os.path.join(self.path, MANIFEST)).entries()), "serial_index": {}, "geo_index": {}}
+        for info in manifest["segments"]:
+            for serial in info["serials"]:
+                manifest["serial_index"].setdefault(serial, []).append(info["name"])
+            for bucket in info["geo"]:
+                manifest["geo_index"].setdefault(bucket, []).append(info["name"])
+        return manifest
+
+    def query(self, serial=None, t_start=None, t_end=None, bbox=None, crc_ok=True):
+        """Return columns of all packets matching serial, time range [ms] and bbox (lat0, lon0, lat1, lon1)"""
+        try:
+            return self._query(serial, t_start, t_end, bbox, crc_ok)
+        except FileNotFoundError:
+            # segments merged by compact() in the meantime, they are in the new manifest
+            return self._query(serial, t_start, t_end, bbox, crc_ok)
+
+    def _query(self, serial, t_start, t_end, bbox, crc_ok):
+        manifest = self.manifest()
+        candidates = set(s["name"] for s in manifest["segments"])
+
+        # narrow down the segments with the time ranges and indices first
+        if serial is not None:
+            candidates &= set(manifest["serial_index"].get(serial, []))
+        if t_start is not None or t_end is not None:
+            lo = t_start if t_start is not None else -np.inf
+            hi = t_end if t_end is not None else np.inf
+            candidates &= set(s["name"] for s in manifest["segments"] if s["time"][0] <= hi and s["time"][1] >= lo)
+        if bbox is not None:
+            lat0, lon0, lat1, lon1 = np.floor(np.array(bbox) / GEO_BUCKET_DEG)
+            geo_candidates = set()
+            for b, names in manifest["geo_index"].items():
+                lat, lon = (int(v) for v in b.split(","))
+                if lat0 <= lat <= lat1 and lon0 <= lon <= lon1:
+                    geo_candidates.update(names)
+            candidates &= geo_candidates
+
+        result = {}
+        for info in manifest["segments"]:
+            if info["name"] not in candidates:
+                continue
+            segment = self._load_segment(info["name"])
+
+            mask = np.ones(info["count"], dtype=bool)
+            if crc_ok:
+                mask &= segment["crc-ok"]
+            if serial is not None:
+                mask &= np.char.rstrip(segment["serial_number"], b"\0") == serial.encode()
+            if t_start is not None:
+                mask &= segment["time"] >= t_start
+            if t_end is not None:
+                mask &= segment["time"] <= t_end
+            if bbox is not None:
+                mask &= (segment["latitude"] >= bbox[0]) & (segment["latitude"] <= bbox[2])
+                mask &= (segment["longitude"] >= bbox[1]) & (segment["longitude"] <= bbox[3])
+
+            for column, values in segment.items():
+                result.setdefault(column, []).append(values[mask])
+
+        return {column: np.concatenate(values) for column, values in result.items()}
+
+    def _load_segment(self, name):
+        segment_dir = os.path.join(self.path, "segments", name)
+        return {f[:-4]: np.load(os.path.join(segment_dir, f), mmap_mode="r")
+                for f in os.listdir(segment_dir) if f.endswith(".npy")}
+
+
+def replay(entries):
+    """Manifest entries of the segments in the store after the log entries, oldest first"""
+    segments = {}
+    for entry in entries:
+        for name in entry.get("remove", []):
+            segments.pop(name, None)
+        if "add" in entry:
+            segments[entry["add"]["name"]] = entry["add"]
+    return list(segments.values())
+
+
+class _ManifestLog:
+    """The manifest log, appended to (or rewritten) under an exclusive lock"""
+    def __init__(self, path):
+        self.path = path
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as fd:
+            for line in fd:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # line still being appended by another process
+                    break
+        return entries
+
+    def append(self, entry):
+        with open(self.path, "a") as fd:
+            fd.write(json.dumps(entry) + "\n")
+
+    def rewrite(self, entries):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fd:
+            for entry in entries:
+                fd.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.path)
+
+    def __enter__(self):
+        self.lock = open(self.path + ".lock", "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+
+def parse_time(value):
+    """ms since epoch from a number or an ISO date (local time)"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp() * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--store', required=True, help="Store directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    imp = sub.add_parser("import", help="Import a decoded bits file (time column = gps_time)")
+    imp.add_argument('-f', '--file', required=True, help="Decoded bits file")
+
+    query = sub.add_parser("query", help="Query packets")
+    query.add_argument('--serial', help="Serial number")
+    query.add_argument('--from', dest="t_start", type=parse_time, help="Start time (ms or ISO date)")
+    query.add_argument('--to', dest="t_end", type=parse_time, help="End time (ms or ISO date)")
+    query.add_argument('--bbox', type=lambda s: [float(v) for v in s.split(",")], help="lat0,lon0,lat1,lon1")
+    query.add_argument('--all', default=False, action="store_true", help="Include packets with CRC errors")
+
+    compact = sub.add_parser("compact", help="Merge the segments of every past hour or day into one")
+    compact.add_argument('-p', '--period', default="hour", choices=list(COMPACT_PERIODS), help="Merge per (default: hour)")
+    args = parser.parse_args()
+
+    store = TrackStore(args.store)
+
+    if args.command == "import":
+        records = read_packets(args.file)
+        raw = np.asarray(records).view(np.uint8).reshape(len(records), records.dtype.itemsize)
+        for i in range(0, len(records), 1 << 20):
+            chunk = raw[i:i + (1 << 20)]
+            store.append_records(chunk, records["gps_time"][i:i + (1 << 20)])
+        print("Imported %i packets" % len(records))
+        return
+
+    if args.command == "compact":
+        print("Merged %i segments, %i left" % (store.compact(args.period), len(store.manifest()["segments"])))
+        return
+
+    result = store.query(args.serial, args.t_start, args.t_end, args.bbox, crc_ok=not args.all)
+    for i in range(len(result.get("time", []))):
+        print("%s %s %f %f %.2f" % (datetime.fromtimestamp(result["time"][i] / 1000).isoformat(),
+              result["serial_number"][i].decode("utf-8", "replace").rstrip("\0"),
+              result["latitude"][i], result["longitude"][i], result["height"][i]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""Stand-in for the parts of the UHD Python API the live receiver uses
+
+Streams a capture file (looped) in real time, with the same metadata as
+UHD: every block has its device time stamp, a host that falls behind by
+more than BUFFER_TIME gets an overflow and loses samples, and a stream
+that ended times out. What makes hopping slow on a real radio takes time
+here as well: an untimed retune blocks for TUNE_TIME, a num_done stream
+starts STREAM_START_TIME after the command, and for SETTLE_TIME after
+every retune the samples are noise. The times are rough B205-mini values.
+
+Run the live receiver with --mock <capture> to use it, or ./uhd_mock.py
+to compare the duty cycle of the receive modes without the pipeline.
+"""
+
+import sys
+import time
+import argparse
+import itertools
+import types as _types
+import numpy as np
+from capture_file import CaptureFile
+
+# blocking time of an untimed set_rx_freq, LO lock included [s]
+TUNE_TIME = 2e-3
+# from a stream_now num_done command to the first sample [s]
+STREAM_START_TIME = 3e-3
+# samples after a retune are garbage this long [s]
+SETTLE_TIME = 1e-3
+# samples the device buffers before it overflows [s]
+BUFFER_TIME = 20e-3
+# at most this much of the capture is looped [s]
+MAX_SOURCE_TIME = 1.0
+
+
+class TimeSpec:
+    def __init__(self, secs=0.0):
+        self.secs = float(secs)
+
+    def get_real_secs(self):
+        return self.secs
+
+    def __add__(self, secs):
+        return TimeSpec(self.secs + float(secs))
+
+
+StreamMode = _types.SimpleNamespace(start_cont="start_cont", stop_cont="stop_cont", num_done="num_done", num_more="num_more")
+
+class StreamCMD:
+    def __init__(self, mode):
+        self.stream_mode = mode
+        self.num_samps = 0
+        self.stream_now = True
+        self.time_spec = TimeSpec()
+
+class RXMetadata:
+    def __init__(self):
+        self.time_spec = TimeSpec()
+        self.has_time_spec = False
+        self.error_code = "ERROR_CODE_NONE"
+
+    def strerror(self):
+        return self.error_code
+
+class StreamArgs:
+    def __init__(self, cpu_format, otw_format):
+        self.cpu_format = cpu_format
+        self.otw_format = otw_format
+        self.channels = []
+
+class TuneRequest:
+    def __init__(self, target_freq):
+        self.target_freq = target_freq
+
+
+class RXStreamer:
+    """Samples of the device, paced by its clock"""
+    def __init__(self, device):
+        self.device = device
+        # device time of the next sample, None while not streaming
+        self.next_time = None
+        # samples left of a num_done command, None for continuous streaming
+        self.remaining = None
+
+    def issue_stream_cmd(self, cmd):
+        if cmd.stream_mode == StreamMode.stop_cont:
+            self.next_time = None
+            return
+        start = self.device.now() + STREAM_START_TIME if cmd.stream_now else cmd.time_spec.get_real_secs()
+        self.next_time = max(start, self.device.now())
+        self.remaining = cmd.num_samps if cmd.stream_mode == StreamMode.num_done else None
+
+    def recv(self, buffer, metadata, timeout=0.1):
+        metadata.error_code = "ERROR_CODE_NONE"
+        if self.next_time is None or self.remaining == 0:
+            time.sleep(timeout)
+            metadata.error_code = "ERROR_CODE_TIMEOUT"
+            return 0
+
+        fs = self.device.sample_rate
+        count = buffer.shape[1] if self.remaining is None else min(buffer.shape[1], self.remaining)
+        end = self.next_time + count / fs
+        now = self.device.now()
+        if now - end > BUFFER_TIME:
+            # host too slow, the device buffer ran over: everything up to now is lost
+            lost = int((now - self.next_time) * fs)
+            if self.remaining is not None:
+                lost = min(lost, self.remaining)
+                self.remaining -= lost
+            self.next_time += lost / fs
+            metadata.error_code = "ERROR_CODE_OVERFLOW"
+            return 0
+        if end > now:
+            time.sleep(end - now)
+
+        buffer[0, :count] = self.device.samples(self.next_time, count)
+        metadata.time_spec = TimeSpec(self.next_time)
+        metadata.has_time_spec = True
+        self.next_time = end
+        if self.remaining is not None:
+            self.remaining -= count
+        return count
+
+
+class MultiUSRP:
+    """One device with one RX channel, the source capture instead of an antenna"""
+    def __init__(self, args="", source=None):
+        self.sample_rate = 50e6
+        self.source = source
+        self.samples_source = None
+        self.start = time.monotonic()
+        # (device time, center frequency) of the recent retunes, oldest first
+        self.tunes = []
+        self.command_time = None
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def get_time_now(self):
+        return TimeSpec(self.now())
+
+    def set_rx_antenna(self, antenna, chan=0):
+        pass
+
+    def set_rx_gain(self, gain, chan=0):
+        pass
+
+    def set_rx_agc(self, enable, chan=0):
+        pass
+
+    def set_rx_rate(self, rate, chan=0):
+        self.sample_rate = rate
+        self.samples_source = None
+
+    def get_rx_rate(self, chan=0):
+        return self.sample_rate
+
+    def get_rx_stream(self, stream_args):
+        return RXStreamer(self)
+
+    def set_command_time(self, time_spec, mboard=0):
+        self.command_time = time_spec.get_real_secs()
+
+    def clear_command_time(self, mboard=0):
+        self.command_time = None
+
+    def set_rx_freq(self, tune_request, chan=0):
+        freq = getattr(tune_request, "target_freq", tune_request)
+        if self.command_time is None:
+            time.sleep(TUNE_TIME)
+            self.tunes.append((self.now(), freq))
+        else:
+            self.tunes.append((self.command_time, freq))
+            self.tunes.sort(key=lambda tune: tune[0])
+        return True
+
+    def samples(self, start_time, count):
+        """count samples from device time start_time on, noise while settling after a retune"""
+        if self.samples_source is None:
+            capture = CaptureFile(self.source, sample_rate=self.sample_rate)
+            self.samples_source = capture.read(0, min(len(capture), int(MAX_SOURCE_TIME * self.sample_rate)))
+            self.noise_level = np.std(self.samples_source)
+        first = int(round(start_time * self.sample_rate))
+        samples = self.samples_source[(first + np.arange(count)) % len(self.samples_source)]
+
+        # retunes long ago do not matter any more
+        self.tunes = [tune for tune in self.tunes if tune[0] + SETTLE_TIME >= start_time]
+        for tune_time, _ in self.tunes:
+            settle_start = max(int(round(tune_time * self.sample_rate)) - first, 0)
+            settle_end = min(int(round((tune_time + SETTLE_TIME) * self.sample_rate)) - first, count)
+            if settle_start < settle_end:
+                n = settle_end - settle_start
+                samples[settle_start:settle_end] = self.noise_level * (np.random.standard_normal(n) + 1j * np.random.standard_normal(n))
+        return samples
+
+
+usrp = _types.SimpleNamespace(MultiUSRP=MultiUSRP, StreamArgs=StreamArgs)
+types = _types.SimpleNamespace(RXMetadata=RXMetadata, StreamCMD=StreamCMD, StreamMode=StreamMode, TimeSpec=TimeSpec, TuneRequest=TuneRequest)
+libpyuhd = _types.SimpleNamespace(types=_types.SimpleNamespace(tune_request=TuneRequest))
+
+
+def duty_cycle(capture, sample_rate, duration, dwells, continuous, settle_time):
+    """Share of the time covered by received samples when receiving dwells like the live receiver,
+    and the number of overflows"""
+    import droneid_receiver_live as live
+    live.uhd = sys.modules[__name__]
+    metrics = live.live_metrics()
+
+    device = usrp.MultiUSRP(source=capture)
+    num_samps, metadata, streamer, recv_buffer = live.set_sdr(device, sample_rate, duration)
+    frequencies = itertools.cycle(f * 1e6 for f in live.FREQUENCIES)
+    if continuous:
+        receiver = live.ContinuousReceiver(device, streamer, metadata, sample_rate, duration, settle_time, metrics)
+        receiver.tune(next(frequencies))
+        receiver.start()
+
+    received = 0
+    start = None
+    # the clock starts with the end of the first dwell, after starting the stream
+    for _ in range(dwells + 1):
+        if continuous:
+            if not receiver.schedule:
+                # skipped dwells, one ahead again
+                receiver.tune(next(frequencies))
+            receiver.tune(next(frequencies))
+            samples = receiver.receive()
+            samples = samples[0] if samples is not None else None
+        else:
+            device.set_rx_freq(libpyuhd.types.tune_request(next(frequencies)), 0)
+            samples = live.receive_samples(num_samps, metadata, streamer, recv_buffer, metrics)
+        if start is None:
+            start = time.monotonic()
+        elif samples is not None:
+            received += len(samples)
+    elapsed = time.monotonic() - start
+    if continuous:
+        receiver.stop()
+
+    return received / (elapsed * sample_rate), metrics.value("droneid_rx_overflows_total")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Duty cycle of the live receiver's receive modes on the mock radio")
+    parser.add_argument('-i', '--input-file', required=True, help="Capture the mock radio streams")
+    parser.add_argument('-s', '--sample-rate', default=50e6, type=float, help="Sample rate")
+    parser.add_argument('-t', '--duration', default=0.1, type=float, help="Time of receiving samples per band")
+    parser.add_argument('-n', '--dwells', default=20, type=int, help="Dwells per mode")
+    parser.add_argument('--settle', default=None, type=float, help="Samples dropped after a retune with continuous streaming [s] (default: as the live receiver)")
+    args = parser.parse_args()
+
+    if args.settle is None:
+        from droneid_receiver_live import SETTLE_TIME
+        args.settle = SETTLE_TIME
+    for continuous in (False, True):
+        duty, overflows = duty_cycle(args.input_file, args.sample_rate, args.duration, args.dwells, continuous, args.settle)
+        print("%-10s duty cycle %5.1f%%, %i overflows" % ("continuous" if continuous else "num_done", 100 * duty, overflows))
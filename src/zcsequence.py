@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from helpers import NCARRIERS, tfft
+from helpers import NFFT, tfft
 
 def zcsequence_t(u: int, seq_length: int, q: int=0) -> np.array:
     """
@@ -29,8 +29,8 @@ def zcsequence_t(u: int, seq_length: int, q: int=0) -> np.array:
 def zcsequence(u: int, seq_length: int, q: int=0) -> np.array:
     return zcsequence_t(u, seq_length, q)
 
-def zcsequence_f(root: int, seq_length:int):
+def zcsequence_f(root: int, seq_length:int, nfft: int=NFFT):
     zcseq_t = zcsequence_t(root, seq_length)
-    zcseq_f = tfft(zcseq_t)
-    zcseq_f[NCARRIERS//2] = 0
+    zcseq_f = tfft(zcseq_t, nfft, seq_length)
+    zcseq_f[seq_length//2] = 0
     return zcseq_f
\ No newline at end of file